@@ -3,7 +3,12 @@
 
 shopt -s nullglob
 
-# Run from experiment folder. Enter TS ID as Argument $1 (eg. TS_01).
+NOVADIR=$(dirname "$(readlink -f "$0")")
+EXPDIR=$(pwd)
+
+# Run from experiment folder. Enter TS ID as Argument $1 (eg. TS_01), or several TS IDs (eg. TS_01 TS_02 TS_03) to correct them together.
+# The slabs of all tilt series are corrected by nova_run_jobs.sh, which starts the next slab as soon as one finishes. The number of slabs
+# corrected at the same time and the memory they may use can be set with NOVA_JOBS and NOVA_MEMORY (in MB), see nova_run_jobs.sh.
 
 # Script prompts for Thickness as $thick (in px), Pixel Size (in nm) as $angpix and Z step as $stepsize (in nm).
 
@@ -16,38 +21,42 @@ read stepsize
 echo "Enter pixel size in nm"
 read angpix
 
-cd $1/novaCTF
+COMFILES=()
+
+for TS in "$@"; do
+
+	cd $TS/novaCTF
 
-# Setup CTF correction files and run in parallel (N at a time)
+	# Setup CTF correction files of every tilt series
 
-for FILE in *.txt_*; do
+	for FILE in *.txt_*; do
 	
-	ID=$(echo "$FILE" | cut -d '_' -f 3)
+		ID=$(echo "$FILE" | cut -d '_' -f 3)
 	
-	rm "setup_ctfcorr.com_$ID"	
-	touch "setup_ctfcorr.com_$ID"	
+		rm "setup_ctfcorr.com_$ID"	
+		touch "setup_ctfcorr.com_$ID"	
 	
-	echo "Algorithm ctfCorrection" >> "setup_ctfcorr.com_$ID"
-	echo "InputProjections $1-ali_ali.mrc" >> "setup_ctfcorr.com_$ID"	
-	echo "DefocusFile $FILE" >> "setup_ctfcorr.com_$ID"
-	echo "OutputFile corrected_stack.mrc_$ID" >> "setup_ctfcorr.com_$ID"
-	echo "TILTFILE $1-ali.tlt" >> "setup_ctfcorr.com_$ID"
-	echo "CorrectionType multiplication" >> "setup_ctfcorr.com_$ID"
-	echo "DefocusFileFormat ctffind4" >> "setup_ctfcorr.com_$ID"
-	echo "PixelSize $angpix" >> "setup_ctfcorr.com_$ID"
-	echo "DefocusStep $stepsize" >> "setup_ctfcorr.com_$ID"
-	echo "AmplitudeContrast 0.07" >> "setup_ctfcorr.com_$ID"
-	echo "Cs 2.7" >> "setup_ctfcorr.com_$ID"
-	echo "Volt 300" >> "setup_ctfcorr.com_$ID"
-	echo "CorrectAstigmatism 1" >> "setup_ctfcorr.com_$ID"
+		echo "Algorithm ctfCorrection" >> "setup_ctfcorr.com_$ID"
+		echo "InputProjections $TS-ali_ali.mrc" >> "setup_ctfcorr.com_$ID"	
+		echo "DefocusFile $FILE" >> "setup_ctfcorr.com_$ID"
+		echo "OutputFile corrected_stack.mrc_$ID" >> "setup_ctfcorr.com_$ID"
+		echo "TILTFILE $TS-ali.tlt" >> "setup_ctfcorr.com_$ID"
+		echo "CorrectionType multiplication" >> "setup_ctfcorr.com_$ID"
+		echo "DefocusFileFormat ctffind4" >> "setup_ctfcorr.com_$ID"
+		echo "PixelSize $angpix" >> "setup_ctfcorr.com_$ID"
+		echo "DefocusStep $stepsize" >> "setup_ctfcorr.com_$ID"
+		echo "AmplitudeContrast 0.07" >> "setup_ctfcorr.com_$ID"
+		echo "Cs 2.7" >> "setup_ctfcorr.com_$ID"
+		echo "Volt 300" >> "setup_ctfcorr.com_$ID"
+		echo "CorrectAstigmatism 1" >> "setup_ctfcorr.com_$ID"
 	
-done
+	done
 
-N=8
+	COMFILES+=("$EXPDIR/$TS/novaCTF/"*ctfcorr.com_*)
+	cd "$EXPDIR"
 
-for FILE in *ctfcorr.com_*; do
-	((i=i%N)); ((i++==0)) && wait	
-	novaCTF -param $FILE &
 done
 
-wait
+# Run CTF correction of all slabs in parallel
+
+"$NOVADIR/nova_run_jobs.sh" --timings nova_correct_timings.txt "${COMFILES[@]}"
@@ -3,6 +3,8 @@
 
 shopt -s nullglob
 
+NOVADIR=$(dirname "$(readlink -f "$0")")
+
 # Run from experiment folder. Enter TS ID as Argument $1 (eg. TS_01).
 
 # Script prompts for Thickness as $thick (in px), Pixel Size (in nm) as $angpix and Z step as $stepsize (in nm). N is the degree of parallelization. 
@@ -46,12 +48,7 @@ done
 
 N=3
 
-for FILE in setup_filter.com_*; do
-	((i=i%N)); ((i++==0)) && wait	
-	novaCTF -param $FILE &
-done
-
-wait
+"$NOVADIR/nova_run_jobs.sh" --jobs $N --timings nova_filter_timings.txt setup_filter.com_*
 
 # Setup and run reconstruction
 
@@ -0,0 +1,106 @@
+#! /bin/bash
+# Runs novaCTF on many com-files with a dynamic pool of workers. (c) Benedikt Wimmer 04/2021
+
+shopt -s nullglob
+
+# Usage: nova_run_jobs.sh [--jobs N] [--memory MB] [--timings FILE] com-file [com-file ...]
+# Every com-file is run in its own folder, so com-files of several tilt series (TS_01/novaCTF/setup_ctfcorr.com_1 ...)
+# can be run together. A new job is started as soon as any running job finishes, as long as fewer than N jobs run and
+# the memory of the running jobs stays within the budget. The memory of a job is estimated as twice the size of its
+# InputProjections file. A job is always started if nothing else is running.
+# N defaults to the number of cores and the memory budget to the available memory (in MB), they can also be set with
+# the environment variables NOVA_JOBS and NOVA_MEMORY. NOVACTF sets the novaCTF program (eg. a stub for testing).
+# The time of every job is written to the timings file (default: nova_timings.txt in the current folder).
+
+jobs=${NOVA_JOBS:-$(nproc)}
+memory=${NOVA_MEMORY:-$(awk '/MemAvailable/ {print int($2/1024)}' /proc/meminfo)}
+timings="nova_timings.txt"
+novactf=${NOVACTF:-novaCTF}
+
+while [ $# -gt 0 ]; do
+	case "$1" in
+		--jobs) jobs=$2; shift 2 ;;
+		--memory) memory=$2; shift 2 ;;
+		--timings) timings=$2; shift 2 ;;
+		*) break ;;
+	esac
+done
+
+if [ $# -eq 0 ]; then
+	echo "No com-files to run"
+	exit 0
+fi
+
+timings=$(readlink -f "$timings")
+rm -f "$timings"
+touch "$timings"
+
+# Memory (in MB) of the job of a com-file
+job_memory () {
+	local dir=$(dirname "$1")
+	local input=$(awk '$1 == "InputProjections" {print $2}' "$1")
+	if [ -f "$dir/$input" ]; then
+		echo $(( $(stat -c %s "$dir/$input") * 2 / 1048576 ))
+	else
+		echo 0
+	fi
+}
+
+# Runs one com-file in its folder and appends: com-file, exit status, seconds, start time
+run_job () {
+	local start=$(date +%s.%N)
+	(cd "$(dirname "$1")" && $novactf -param "$(basename "$1")")
+	local status=$?
+	local end=$(date +%s.%N)
+	echo "$1 $status $(awk -v s=$start -v e=$end 'BEGIN {printf "%.2f", e - s}') $start" >> "$timings"
+}
+
+# Removes finished jobs from the running ones
+reap_jobs () {
+	local pid
+	for pid in "${!running[@]}"; do
+		if ! kill -0 $pid 2> /dev/null; then
+			used=$((used - running[$pid]))
+			unset 'running[$pid]'
+		fi
+	done
+}
+
+declare -A running
+used=0
+total=$#
+started=0
+runstart=$(date +%s.%N)
+
+echo "Running $total novaCTF jobs, at most $jobs at a time within $memory MB"
+
+for FILE in "$@"; do
+	need=$(job_memory "$FILE")
+
+	# Waiting for jobs to finish until there is a free worker and enough memory
+	reap_jobs
+	while [ ${#running[@]} -gt 0 ] && { [ ${#running[@]} -ge $jobs ] || [ $((used + need)) -gt $memory ]; }; do
+		wait -n
+		reap_jobs
+	done
+
+	run_job "$FILE" &
+	running[$!]=$need
+	used=$((used + need))
+	started=$((started + 1))
+	echo "Started $FILE ($started of $total)"
+done
+
+wait
+
+runend=$(date +%s.%N)
+failed=$(awk '$2 != 0' "$timings" | wc -l)
+awk -v wall=$(awk -v s=$runstart -v e=$runend 'BEGIN {print e - s}') '{ sum += $3; if ($3 > max) { max = $3; slowest = $1 } }
+	END { printf "%d jobs in %.1f s, %.1f s per job, slowest %s (%.1f s)\n", NR, wall, sum / NR, slowest, max }' "$timings"
+echo "Job times were written to $timings"
+
+if [ $failed -gt 0 ]; then
+	echo "$failed novaCTF jobs failed:"
+	awk '$2 != 0 {print $1}' "$timings"
+	exit 1
+fi
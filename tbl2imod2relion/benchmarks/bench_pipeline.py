@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# Benchmark of relion_STA_updated.py on synthetic data.
+# Generates a project with all_tomograms.star and, for every tomogram, a small .mrcs tilt stack, .tlt, .order
+# and .coords file (and optionally the CTFFIND results), replaces the IMOD and RELION programs by stubs,
+# runs the script and reports the time of every stage (from run_report.json), particles/s and files/s.
+# The data only depend on the options and --seed, so runs of different versions of the code can be compared.
+#
+# Usage: python benchmarks/bench_pipeline.py --tomograms 10 --particles 10000
+#        python benchmarks/bench_pipeline.py --tomograms 200 --particles 1000000 --set NumberOfWorkers=8 --set DefocusQuantization=500
+# Options of the script are set with --set Name=Value (Python syntax), e.g. --set CtfStarPerTomogram=True.
+
+import os, sys, re, json, time, random, shutil, struct, tempfile, argparse, subprocess, collections
+
+CODEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOMOSIZE = [3838, 3708, 3000]
+PIXELSIZE = 1.755
+
+# Stubs for the external programs, written with the interpreter running the benchmark
+STUB_CTFFIND = '''import sys, zlib
+args = sys.argv[1:]
+inname = args[args.index('--i') + 1]
+outname = args[args.index('--o') + 1]
+names = [line.split()[0] for line in open(inname) if line.strip() and not line.startswith(('data_', 'loop_', '_'))]
+outfile = open(outname, 'w')
+outfile.write('data_\\n\\nloop_\\n_rlnMicrographName #1\\n_rlnCtfImage #2\\n_rlnDefocusU #3\\n_rlnDefocusV #4\\n_rlnDefocusAngle #5\\n')
+for name in names:
+    defocus = 30000 + zlib.crc32(name.split('_image')[-1].encode()) % 5000 + 0.123456
+    outfile.write('%s %s:mrc %.6f %.6f %.6f\\n' % (name, name.replace('.mrc', '.ctf'), defocus, defocus - 150.5, 12.3))
+outfile.close()
+'''
+
+STUB_NEWSTACK = '''import sys, struct
+args = sys.argv[1:]
+section = int(args[1])
+infile = open(args[2], 'rb')
+header = bytearray(infile.read(1024))
+nx, ny, nz, mode = struct.unpack('<4i', bytes(header[0:16]))
+infile.seek(1024 + struct.unpack('<i', bytes(header[92:96]))[0] + section * nx * ny * 4)
+data = infile.read(nx * ny * 4)
+infile.close()
+header[8:12] = struct.pack('<i', 1)
+header[92:96] = struct.pack('<i', 0)
+open(args[3], 'wb').write(bytes(header) + data)
+'''
+
+STUB_RECONSTRUCT = '''import sys, struct
+args = sys.argv[1:]
+box = int(args[args.index('--reconstruct_ctf') + 1])
+header = bytearray(1024)
+header[0:16] = struct.pack('<4i', box, box, box, 2)
+header[28:40] = struct.pack('<3i', box, box, box)
+header[208:212] = b'MAP '
+open(args[args.index('--o') + 1], 'wb').write(bytes(header) + bytes(bytearray(box * box * box * 4)))
+'''
+
+
+#
+def write_stub(stubdir, name, code):
+    filename = os.path.join(stubdir, name)
+    stubfile = open(filename, 'w')
+    stubfile.write('#!' + sys.executable + '\n' + code)
+    stubfile.close()
+    os.chmod(filename, 0o755)
+    return filename
+#
+
+#
+def split_counts(total, parts):
+    # total split into parts numbers that differ by at most 1
+    return [total // parts + (1 if part < total % parts else 0) for part in range(0, parts)]
+#
+
+#
+def write_stack(filename, ntilts, imagesize, rng):
+    header = bytearray(1024)
+    header[0:16] = struct.pack('<4i', imagesize, imagesize, ntilts, 2)
+    header[28:40] = struct.pack('<3i', imagesize, imagesize, ntilts)
+    header[40:52] = struct.pack('<3f', imagesize * PIXELSIZE, imagesize * PIXELSIZE, ntilts * PIXELSIZE)
+    header[64:76] = struct.pack('<3i', 1, 2, 3)
+    header[208:212] = b'MAP '
+    header[212:216] = b'\x44\x44\x00\x00'
+    values = [rng.gauss(0.0, 1.0) for j in range(0, imagesize * imagesize * ntilts)]
+    stackfile = open(filename, 'wb')
+    stackfile.write(bytes(header))
+    stackfile.write(struct.pack('<' + str(len(values)) + 'f', *values))
+    stackfile.close()
+#
+
+#
+def generate_project(projectdir, ntomograms, nparticles, ntilts, imagesize, ctffind, seed):
+    # Synthetic project, returns the tomogram names
+    rng = random.Random(seed)
+    tilts = [-60.0 + 120.0 * j / max(1, ntilts - 1) for j in range(0, ntilts)]
+    # Dose symmetric tilt order starting at 0 degrees
+    order = sorted(tilts, key=lambda tilt: (abs(tilt), tilt < 0))
+
+    names = ['TS_' + str("%03d" % (tomonum+1)) for tomonum in range(0, ntomograms)]
+    starfile = open(os.path.join(projectdir, 'all_tomograms.star'), 'w')
+    starfile.write('data_\n\nloop_\n_rlnMicrographName #1\n')
+    for name in names:
+        starfile.write(name + '/' + name + '.mrc\n')
+    starfile.close()
+
+    for name, count in zip(names, split_counts(nparticles, ntomograms)):
+        tomodir = os.path.join(projectdir, name)
+        os.makedirs(tomodir)
+        offset = rng.uniform(-0.2, 0.2)
+        tomotilts = [float(str("%.2f" % (tilt + offset))) for tilt in tilts]
+        tltfile = open(os.path.join(tomodir, name + '.tlt'), 'w')
+        tltfile.writelines([str("%7.2f" % tilt) + '\n' for tilt in tomotilts])
+        tltfile.close()
+        orderfile = open(os.path.join(tomodir, name + '.order'), 'w')
+        orderfile.writelines([str("%g %g" % (tilt, 3.0 * j)) + '\n' for j, tilt in enumerate(order)])
+        orderfile.close()
+        coordsfile = open(os.path.join(tomodir, name + '.coords'), 'w')
+        coordsfile.writelines([str("%.2f %.2f %.2f" % (rng.uniform(0, TOMOSIZE[0]), rng.uniform(0, TOMOSIZE[1]), rng.uniform(800, 2200))) + '\n' for j in range(0, count)])
+        coordsfile.close()
+        write_stack(os.path.join(tomodir, name + '.mrcs'), ntilts, imagesize, rng)
+
+        # CTFFIND results as relion_run_ctffind writes them, for runs with ReRunCtffindSkip = True
+        if ctffind:
+            os.makedirs(os.path.join(tomodir, 'ctffind'))
+            ctffindfile = open(os.path.join(tomodir, 'ctffind', name + '_ctffind.star'), 'w')
+            ctffindfile.write('data_\n\nloop_\n_rlnMicrographName #1\n_rlnCtfImage #2\n_rlnDefocusU #3\n_rlnDefocusV #4\n_rlnDefocusAngle #5\n')
+            for j in range(0, ntilts):
+                image = name + '/ctffind/' + name + '_image' + str(tomotilts[j]) + '_' + str(j) + '.mrc'
+                defocus = rng.uniform(30000, 35000)
+                ctffindfile.write(image + ' ' + image.replace('.mrc', '.ctf') + ':mrc ' + str("%.6f %.6f %.6f" % (defocus, defocus - 150.5, 12.3)) + '\n')
+            ctffindfile.close()
+    return names
+#
+
+#
+def configure_script(scriptname, outname, settings):
+    # Copy of relion_STA_updated.py with the given settings replaced in the INPUT section
+    text = open(scriptname, 'r').read()
+    for name in settings:
+        pattern = re.compile('^' + name + ' = .*$', re.M)
+        if pattern.search(text) is None:
+            raise ValueError('No setting ' + name + ' in ' + scriptname)
+        text = pattern.sub(lambda match: name + ' = ' + settings[name], text, count=1)
+    outfile = open(outname, 'w')
+    outfile.write(text)
+    outfile.close()
+#
+
+#
+def count_files(directory):
+    nfiles = 0
+    nbytes = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            nfiles = nfiles + 1
+            nbytes = nbytes + os.path.getsize(os.path.join(dirpath, filename))
+    return nfiles, nbytes
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark relion_STA_updated.py on synthetic data')
+    parser.add_argument('--tomograms', type=int, default=10, help='number of tomograms (1 to 200)')
+    parser.add_argument('--particles', type=int, default=10000, help='number of particles, split over the tomograms (1000 to 1000000)')
+    parser.add_argument('--tilts', type=int, default=41, help='tilt images per tomogram')
+    parser.add_argument('--image-size', type=int, default=32, help='size of the synthetic tilt images (in px)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic data')
+    parser.add_argument('--precomputed-ctffind', action='store_true', help='write the CTFFIND results with the data and skip CTFFIND')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='setting of relion_STA_updated.py, can be repeated')
+    parser.add_argument('--reconstruct', type=int, metavar='BOX', help='also run do_all_reconstruct_ctfs.sh with this box size and a stub relion_reconstruct')
+    parser.add_argument('--python', default=sys.executable, help='Python 2 interpreter for relion_STA_updated.py')
+    parser.add_argument('--workdir', help='directory for the project (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the project directory')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+    elif not os.path.exists(workdir):
+        os.makedirs(workdir)
+    projectdir = os.path.join(workdir, 'project')
+    stubdir = os.path.join(workdir, 'stubs')
+    codedir = os.path.join(workdir, 'code')
+    for directory in (projectdir, stubdir, codedir):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+
+    start = time.time()
+    generate_project(projectdir, args.tomograms, args.particles, args.tilts, args.image_size, args.precomputed_ctffind, args.seed)
+    print('Generated ' + str(args.tomograms) + ' tomograms with ' + str(args.particles) + ' particles in ' + str("%.2f" % (time.time() - start)) + ' s')
+
+    settings = {}
+    settings['PathToWrapper'] = repr(write_stub(stubdir, 'relion_run_ctffind', STUB_CTFFIND))
+    settings['TomoSize'] = repr(TOMOSIZE)
+    settings['PixelSize'] = repr(PIXELSIZE)
+    settings['WriteRunReport'] = 'True'
+    if args.precomputed_ctffind:
+        settings['ReRunCtffindSkip'] = 'True'
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        settings[name.strip()] = value.strip()
+    write_stub(stubdir, 'newstack', STUB_NEWSTACK)
+    write_stub(stubdir, 'relion_reconstruct', STUB_RECONSTRUCT)
+
+    # The helper modules are copied next to the configured script, do_all_reconstruct_ctfs.sh calls them from there
+    for filename in os.listdir(CODEDIR):
+        if filename.endswith('.py'):
+            shutil.copy(os.path.join(CODEDIR, filename), codedir)
+    scriptname = os.path.join(codedir, 'relion_STA_updated.py')
+    configure_script(os.path.join(CODEDIR, 'relion_STA_updated.py'), scriptname, settings)
+
+    environment = dict(os.environ)
+    environment['PATH'] = stubdir + os.pathsep + os.path.dirname(args.python) + os.pathsep + environment.get('PATH', '')
+    logname = os.path.join(workdir, 'run.log')
+    logfile = open(logname, 'w')
+    nfiles_before, nbytes_before = count_files(projectdir)
+    start = time.time()
+    returncode = subprocess.call([args.python, scriptname], cwd=projectdir, stdout=logfile, stderr=subprocess.STDOUT, env=environment)
+    wall = time.time() - start
+    logfile.close()
+    if returncode != 0:
+        print('relion_STA_updated.py failed, see ' + logname)
+        return 1
+    nfiles, nbytes = count_files(projectdir)
+    nfiles = nfiles - nfiles_before
+    nbytes = nbytes - nbytes_before
+
+    report = json.load(open(os.path.join(projectdir, 'run_report.json'), 'r'), object_pairs_hook=collections.OrderedDict)
+    results = {'tomograms': args.tomograms, 'particles': args.particles, 'tilts': args.tilts, 'seed': args.seed, 'settings': settings,
+               'wall': wall, 'files': nfiles, 'bytes': nbytes, 'particles_per_second': args.particles / wall, 'files_per_second': nfiles / wall,
+               'stages': report['stages']}
+
+    print(str("%-20s %10s %10s %10s %10s" % ('stage', 'wall (s)', 'cpu (s)', 'commands', 'files')))
+    for name in report['stages']:
+        stage = report['stages'][name]
+        print(str("%-20s %10.2f %10.2f %10d %10d" % (name, stage['wall'], stage['cpu'], stage['subprocesses'], stage['files'])))
+    print('Total: ' + str("%.2f" % wall) + ' s, ' + str(nfiles) + ' files (' + str("%.1f" % (nbytes / 1e6)) + ' MB), ' +
+          str("%.0f" % results['particles_per_second']) + ' particles/s, ' + str("%.0f" % results['files_per_second']) + ' files/s')
+
+    if args.reconstruct is not None:
+        start = time.time()
+        returncode = subprocess.call(['/bin/sh', os.path.join(projectdir, 'do_all_reconstruct_ctfs.sh'), str(args.reconstruct)], cwd=projectdir,
+                                     stdout=open(os.path.join(workdir, 'reconstruct.log'), 'w'), stderr=subprocess.STDOUT, env=environment)
+        results['reconstruct_wall'] = time.time() - start
+        print('do_all_reconstruct_ctfs.sh: ' + str("%.2f" % results['reconstruct_wall']) + ' s' + ('' if returncode == 0 else ' (failed)'))
+
+    if args.output is not None:
+        outfile = open(args.output, 'w')
+        json.dump(results, outfile, indent=1, sort_keys=True)
+        outfile.close()
+
+    if args.keep:
+        print('Project kept in ' + workdir)
+    elif args.workdir is None:
+        shutil.rmtree(workdir)
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Benchmark of starfile.py on a large sub-tomogram particle .star file.
+# Writes a particles_subtomo.star-like file with --rows rows (default 1,000,000) through StarWriter,
+# reads it back with read_star and with the line-by-line parser of the original relion_STA_updated.py,
+# and times a subset selection and a merge on the column table.
+#
+# Usage: python benchmarks/bench_starfile.py [--rows 1000000] [--keep]
+
+import os, sys, time, tempfile, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import starfile
+
+LABELS = ['_rlnMicrographName', '_rlnCoordinateX', '_rlnCoordinateY', '_rlnCoordinateZ', '_rlnImageName', '_rlnCtfImage']
+
+
+#
+def line_by_line(filename, label):
+    # The parsing loop of read_relion_star, for comparison
+    values = []
+    j = -1
+    column = None
+    for line in open(filename, 'r'):
+        if line.isspace():
+            continue
+        fields = line.split()
+        if fields[0][0] == 'd' or fields[0][0] == 'l':
+            continue
+        j = j + 1
+        if fields[0] == label:
+            column = j
+            continue
+        if fields[0][0] == '_':
+            continue
+        values.append(fields[column])
+    return values
+#
+
+#
+def timed(label, function, *args):
+    start = time.time()
+    result = function(*args)
+    print(label + ': ' + str("%.2f" % (time.time() - start)) + ' s')
+    return result
+#
+
+#
+def write_particles(filename, nrows):
+    writer = starfile.StarWriter(filename)
+    writer.begin_block('', LABELS)
+    for row in range(0, nrows):
+        tomo = 'TS_' + str("%02d" % (row // 10000)) + '/TS_' + str("%02d" % (row // 10000))
+        writer.write_row([tomo + '.mrc', row % 3838, row % 3708, row % 3000,
+                          'Particles/' + tomo + '_subtomo' + str("%06d" % row) + '.mrc',
+                          'Particles/' + tomo + '_ctf' + str("%06d" % row) + '.mrc'])
+    writer.close()
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark STAR file reading and writing')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of particles')
+    parser.add_argument('--keep', action='store_true', help='keep the .star files')
+    args = parser.parse_args(argv)
+
+    scratchdir = tempfile.mkdtemp(prefix='bench_starfile_')
+    filename = os.path.join(scratchdir, 'particles_subtomo.star')
+    mergedname = os.path.join(scratchdir, 'particles_merged.star')
+
+    timed('Writing ' + str(args.rows) + ' rows with StarWriter', write_particles, filename, args.rows)
+    print('File size: ' + str("%.1f" % (os.path.getsize(filename) / 1e6)) + ' MB')
+    timed('Reading one column line by line', line_by_line, filename, '_rlnImageName')
+    table = timed('Reading all columns with first_table', starfile.first_table, filename)
+    tomograms = table.column('_rlnMicrographName')
+    subset = timed('Selecting the particles of one tomogram', table.rows, tomograms == tomograms[-1])
+    print('Selected ' + str(len(subset)) + ' of ' + str(len(table)) + ' particles')
+    timed('Writing the table and the subset as one file', starfile.write_star, mergedname, [table, subset])
+
+    if args.keep:
+        print('Files kept in ' + scratchdir)
+    else:
+        os.remove(filename)
+        os.remove(mergedname)
+        os.rmdir(scratchdir)
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Fourier cropping of tilt images for CTFFIND (CtffindFourierCrop = True in relion_STA_updated.py).
+# CTFFIND only fits the power spectrum up to HighResLimit, so the frequencies beyond it do not need to be read.
+# Every tilt image is cut down in Fourier space to the frequencies below a Nyquist slightly beyond HighResLimit
+# and written at the larger pixel size. The power spectrum below that frequency is not changed. The pixel size
+# (DStep for relion_run_ctffind) grows by the crop factor and the tile size of CTFFIND (--Box) shrinks by it, so the
+# spectrum CTFFIND fits has the same frequency spacing as without cropping and is only cut off beyond the new Nyquist.
+# The sizes are rounded to even numbers, so the pixel size along y can differ from the one along x by up to
+# 1 / (2 x size) (0.03 % for a 1500 px image), well below the defocus step of CTFFIND.
+#
+# Usage: ctf_crop.py TS_01.mrcs TS_01_image --angpix 1.755 --res 10 [--size 1024] [--box 256]
+# writes TS_01_image<N>.mrc for every section N of the stack and prints the new pixel size and CTFFIND box size.
+
+import sys, argparse
+
+import numpy as np
+
+import mrcio
+
+# Nyquist of the cropped images relative to HighResLimit, so the fit does not reach the edge of the spectrum
+NYQUIST_MARGIN = 1.1
+
+
+#
+def crop_shape(shape, pixelsize, highreslimit, size=0):
+    # Shape (ny, nx) of the cropped images, for images of shape (ny, nx) with pixelsize (in A). The longer side is size
+    # if size > 0, otherwise the images are cropped so their Nyquist frequency is NYQUIST_MARGIN beyond highreslimit.
+    # Images are never padded, the shape is at most the original shape. A size whose Nyquist frequency is below
+    # highreslimit (CTFFIND could not fit up to it) raises ValueError.
+    ny, nx = shape
+    if size > 0:
+        factor = max(ny, nx) / float(size)
+    else:
+        factor = highreslimit / (2.0 * NYQUIST_MARGIN * pixelsize)
+    if factor <= 1.0:
+        return ny, nx
+    outshape = (min(ny, 2 * int(round(ny / factor / 2.0))), min(nx, 2 * int(round(nx / factor / 2.0))))
+    if 2.0 * cropped_pixel_size(shape, outshape, pixelsize) > highreslimit:
+        raise ValueError('Cropped to ' + str(outshape[1]) + ' x ' + str(outshape[0]) + ' px the images have a Nyquist of ' + str("%.2f" % (2.0 * cropped_pixel_size(shape, outshape, pixelsize)))
+                         + ' A, coarser than the highest resolution of the fit (' + str(highreslimit) + ' A), use a larger crop size')
+    return outshape
+#
+
+#
+def cropped_pixel_size(shape, outshape, pixelsize):
+    # Pixel size of the cropped images (along x)
+    return pixelsize * shape[1] / float(outshape[1])
+#
+
+#
+def cropped_box_size(boxsize, shape, outshape):
+    # CTFFIND tile size (in px, even) for the cropped images that covers the same area as boxsize on the original
+    # images, so the fitted spectrum keeps its frequency spacing. At most the shorter side of the cropped images.
+    if tuple(outshape) == tuple(shape):
+        return boxsize
+    return min(2 * int(round(boxsize * outshape[1] / float(shape[1]) / 2.0)), min(outshape) // 2 * 2)
+#
+
+#
+def fourier_crop(image, outshape):
+    # Keeps the frequencies of image that fit into outshape (ny, nx, both even). The result has the same mean
+    # and the same power spectrum at those frequencies, as float32.
+    ny, nx = image.shape
+    outny, outnx = outshape
+    if (outny, outnx) == (ny, nx):
+        return np.asarray(image, dtype=np.float32)
+    spectrum = np.fft.rfft2(np.asarray(image, dtype=np.float32))
+    cropped = np.empty((outny, outnx // 2 + 1), dtype=spectrum.dtype)
+    cropped[:outny // 2] = spectrum[:outny // 2, :outnx // 2 + 1]
+    cropped[outny // 2:] = spectrum[ny - outny // 2:, :outnx // 2 + 1]
+    image = np.fft.irfft2(cropped, s=(outny, outnx))
+    image *= float(outny * outnx) / (ny * nx)
+    return image.astype(np.float32)
+#
+
+#
+def iter_crop_sections(stackname, outnames, outshape, pixelsize, sections=None):
+    # Like mrcio.iter_write_sections, but every section is Fourier cropped to outshape and written with pixelsize.
+    # The full size images are never written.
+    header, stack = mrcio.open_mrc(stackname)
+    if sections is None:
+        sections = range(0, len(outnames))
+    for section, outname in zip(sections, outnames):
+        if section < 0 or section >= header['nz']:
+            raise IndexError('Section ' + str(section) + ' does not exist in ' + stackname + ' with ' + str(header['nz']) + ' sections')
+        mrcio.write_mrc(outname, fourier_crop(stack[section], outshape), template=header, pixelsize=pixelsize)
+        yield outname
+    del stack
+#
+
+#
+def crop_file(filename, outshape, pixelsize):
+    # Fourier crops a single image file in place (e.g. a tilt image extracted by newstack)
+    header, image = mrcio.open_mrc(filename)
+    cropped = fourier_crop(image.reshape(header['ny'], header['nx']), outshape)
+    del image
+    mrcio.write_mrc(filename, cropped, template=header, pixelsize=pixelsize)
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fourier crop the tilt images of a stack for CTFFIND')
+    parser.add_argument('stack', help='tilt series stack (.mrc or .mrcs)')
+    parser.add_argument('outroot', help='images are written as <outroot><section>.mrc')
+    parser.add_argument('--angpix', type=float, required=True, help='pixel size of the stack (in A)')
+    parser.add_argument('--res', type=float, default=10.0, help='highest resolution used for the CTF fit (in A)')
+    parser.add_argument('--size', type=int, default=0, help='size of the longer side of the cropped images (in px), instead of --res')
+    parser.add_argument('--box', type=int, default=256, help='CTFFIND box size (in px) for the original images')
+    args = parser.parse_args(argv)
+
+    header = mrcio.read_header(args.stack)
+    shape = (header['ny'], header['nx'])
+    outshape = crop_shape(shape, args.angpix, args.res, args.size)
+    outpixelsize = cropped_pixel_size(shape, outshape, args.angpix)
+    outnames = [args.outroot + str(section) + '.mrc' for section in range(0, header['nz'])]
+    for outname in iter_crop_sections(args.stack, outnames, outshape, outpixelsize):
+        pass
+    print(str(len(outnames)) + ' images cropped from ' + str(shape[1]) + ' x ' + str(shape[0]) + ' to ' + str(outshape[1]) + ' x ' + str(outshape[0]) + ' px, pixel size ' + str("%.4f" % outpixelsize) + ' A, CTFFIND box size ' + str(cropped_box_size(args.box, shape, outshape)) + ' px')
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# Stacks of 3D CTF volumes (CtfVolumeStack = True in relion_STA_updated.py).
+# All 3D CTF volumes of a tomogram go into one <Tomogram>_ctf.mrcs instead of one .mrc file per particle, and
+# particles refer to their volume as N@<Tomogram>_ctf.mrcs (N counted from 1) in _rlnCtfImage.
+# The stack follows the MRC2014 convention for a stack of volumes: ISPG 401, NZ = volumes x box and MZ = box.
+# It is created at full size in one go (the file is extended without writing the zeros), after that every
+# volume is written straight into its slot through a memory map, so the stack is never held in memory and
+# several processes can fill different slots of the same stack at the same time.
+# Reading a volume is zero-copy: read_volume('12@TS_01_ctf.mrcs') returns a view of the memory-mapped file.
+# RELION versions that read every .mrcs file as a stack of 2D images would take N@<Tomogram>_ctf.mrcs as a single
+# section. For those, 'unpack' writes the volumes of a particle .star file back into one .mrc file each
+# (<Tomogram>_ctfNNNNNN.mrc next to the stack) and writes a copy of the .star file that refers to them.
+#
+# Usage: ctf_stack.py create Particles/TS_01/TS_01_ctf.mrcs NumberOfVolumes --box SubtomogramSize --angpix PixelSize
+#        ctf_stack.py put Particles/TS_01/TS_01_ctf.mrcs NumberOfVolumes TS_01_ctf000001.mrc [...] [--remove]
+#        ctf_stack.py unpack particles_subtomo.star particles_subtomo_unpacked.star
+
+import os, sys, socket, struct, argparse
+
+import numpy as np
+
+import mrcio
+import starfile
+
+# MRC space group number of a stack of volumes
+VOLUME_STACK_ISPG = 401
+
+
+#
+def stack_header(nslots, boxsize, pixelsize):
+    # Header of a stack of nslots float32 volumes of size boxsize^3
+    raw = mrcio.make_header(np.zeros((1, boxsize, boxsize), dtype=np.float32), pixelsize=pixelsize, ispg=VOLUME_STACK_ISPG, mz=boxsize)
+    struct.pack_into('<i', raw, 8, nslots * boxsize)
+    return raw
+#
+
+#
+def create_stack(filename, nslots, boxsize, pixelsize=1.0):
+    # Creates an empty stack unless it exists already. The stack is written to a scratch file and linked into
+    # place, so processes creating the same stack at the same time all end up with the one that was linked first.
+    if os.path.exists(filename):
+        if stack_shape(filename) != (nslots, boxsize):
+            raise ValueError(filename + ' exists with a different number of volumes or box size, delete it first')
+        return False
+    scratchname = filename + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+    scratchfile = open(scratchname, 'wb')
+    scratchfile.write(bytes(stack_header(nslots, boxsize, pixelsize)))
+    scratchfile.truncate(mrcio.HEADER_BYTES + nslots * boxsize**3 * 4)
+    scratchfile.close()
+    try:
+        os.link(scratchname, filename)
+    except OSError:
+        pass
+    os.remove(scratchname)
+    return True
+#
+
+#
+def stack_shape(filename):
+    # Number of slots and box size of a stack
+    header = mrcio.read_header(filename)
+    boxsize = header['nx']
+    if header['mz'] <= 0 or header['mz'] != boxsize:
+        return header['nz'] // max(1, boxsize), boxsize
+    return header['nz'] // header['mz'], boxsize
+#
+
+#
+def open_stack(filename, mode='r'):
+    # Memory map of a stack with shape (slots, box, box, box). Use mode='r+' to write volumes into it.
+    header, data = mrcio.open_mrc(filename, mode=mode)
+    nslots, boxsize = stack_shape(filename)
+    return data.reshape(nslots, boxsize, boxsize, boxsize)
+#
+
+#
+def parse_reference(reference):
+    # 'N@file.mrcs' -> (file.mrcs, N-1), a plain file name gives slot None
+    if '@' not in reference:
+        return reference, None
+    slot, filename = reference.split('@', 1)
+    return filename, int(slot) - 1
+#
+
+#
+def read_volume(reference):
+    # One volume of a stack ('N@file.mrcs') or a single volume file, without copying it
+    filename, slot = parse_reference(reference)
+    if slot is None:
+        header, data = mrcio.open_mrc(filename)
+        return data
+    return open_stack(filename)[slot]
+#
+
+#
+def write_volumes(filename, slots, volumes):
+    # Writes volumes into the given slots (counted from 0) of an existing stack
+    stack = open_stack(filename, mode='r+')
+    for slot, volume in zip(slots, volumes):
+        if slot < 0 or slot >= len(stack):
+            raise IndexError('Slot ' + str(slot+1) + ' does not exist in ' + filename + ' with ' + str(len(stack)) + ' volumes')
+        stack[slot] = volume
+    stack.flush()
+    del stack
+#
+
+#
+def written_slots(filename):
+    # Which slots of a stack have been written. Empty slots are all zero, while a 3D CTF volume is never zero at
+    # its origin (the amplitude contrast), so only the center voxel of each slot is read.
+    stack = open_stack(filename)
+    center = stack.shape[1] // 2
+    written = np.asarray(stack[:, center, center, center]) != 0
+    del stack
+    return written
+#
+
+#
+def volume_slot(name):
+    # Slot of a 3D CTF volume from its name: <Tomogram>_ctfNNNNNN or <Tomogram>_ctfgroupNNNNNN is slot NNNNNN-1,
+    # <Tomogram>_ctf (all particles share one volume without CTF correction) is slot 0
+    root = os.path.splitext(os.path.basename(name))[0]
+    digits = len(root) - len(root.rstrip('0123456789'))
+    if digits == 0:
+        return 0
+    return int(root[len(root)-digits:]) - 1
+#
+
+#
+def unpacked_name(reference):
+    # Single volume file for 'N@<Tomogram>_ctf.mrcs': <Tomogram>_ctfNNNNNN.mrc in the folder of the stack
+    filename, slot = parse_reference(reference)
+    return os.path.splitext(filename)[0] + str("%06d" % (slot+1)) + '.mrc'
+#
+
+#
+def unpack_star(starname, outname):
+    # Writes every volume of a stack that the particles of starname use (_rlnCtfImage N@stack) into its own file
+    # and writes starname with the new names to outname. Returns the number of volumes written.
+    table = starfile.first_table(starname)
+    references = table.column('_rlnCtfImage')
+    written = {}
+    for reference in references:
+        if '@' not in reference or reference in written:
+            continue
+        filename, slot = parse_reference(reference)
+        written[reference] = unpacked_name(reference)
+        mrcio.write_mrc(written[reference], read_volume(reference), pixelsize=mrcio.pixel_size(mrcio.read_header(filename)))
+    table.columns['_rlnCtfImage'] = np.array([written.get(reference, reference) for reference in references])
+    starfile.write_star(outname, [table])
+    return len(written)
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create stacks of 3D CTF volumes and put volumes into them')
+    subparsers = parser.add_subparsers(dest='command')
+    createparser = subparsers.add_parser('create', help='create an empty stack')
+    createparser.add_argument('stack', help='.mrcs stack')
+    createparser.add_argument('slots', type=int, help='number of volumes')
+    createparser.add_argument('--box', type=int, required=True, help='box size (in px)')
+    createparser.add_argument('--angpix', type=float, default=1.0, help='pixel size (in A)')
+    putparser = subparsers.add_parser('put', help='put volume files into their slots (from their names)')
+    putparser.add_argument('stack', help='.mrcs stack, created if it does not exist')
+    putparser.add_argument('slots', type=int, help='number of volumes of the stack')
+    putparser.add_argument('volumes', nargs='+', help='volume files named <Tomogram>_ctfNNNNNN.mrc')
+    putparser.add_argument('--remove', action='store_true', help='delete the volume files afterwards')
+    unpackparser = subparsers.add_parser('unpack', help='write the volumes a particle .star file uses into single .mrc files')
+    unpackparser.add_argument('star', help='particle .star file with N@<Tomogram>_ctf.mrcs in _rlnCtfImage')
+    unpackparser.add_argument('output', help='copy of the .star file that refers to the single volume files')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        create_stack(args.stack, args.slots, args.box, args.angpix)
+    if args.command == 'put':
+        header, first = mrcio.open_mrc(args.volumes[0])
+        create_stack(args.stack, args.slots, header['nx'], mrcio.pixel_size(header))
+        for volumename in args.volumes:
+            header, volume = mrcio.open_mrc(volumename)
+            write_volumes(args.stack, [volume_slot(volumename)], [volume])
+            del volume
+            if args.remove:
+                os.remove(volumename)
+    if args.command == 'unpack':
+        nvolumes = unpack_star(args.star, args.output)
+        print('Wrote ' + str(nvolumes) + ' volumes into single files, ' + args.output + ' refers to them')
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
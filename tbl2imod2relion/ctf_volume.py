@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# Native NumPy replacement for 'relion_reconstruct --reconstruct_ctf' on the 3D CTF model .star files
+# written by relion_STA_updated.py.
+# The 3D CTF model of a particle is the sum of the 2D CTFs of its tilt images, each inserted as a central
+# slice at its tilt angle (rot = psi = 0) with trilinear interpolation, as RELION's backprojector does it.
+# Voxels hit by more than one slice are divided by the summed interpolation weight.
+# The slice geometry only depends on the tilt angles and the box size, so it is set up once and the
+# volumes of many particles are computed together with one scatter-add per batch.
+# Volumes are centered (origin at box/2), which is the layout RELION expects for _rlnCtfImage.
+#
+# Usage: ctf_volume.py --box SubtomogramSize --angpix PixelSize Particles/TS_01/TS_01_ctf000001.star [...]
+# Per-particle .star files give <name>.mrc, per-tomogram .star files give one <block>.mrc per data block.
+# With --stack the volumes are written into their slots of a stack of volumes (see ctf_stack.py) instead of single files.
+# Like relion_reconstruct, the last (unlabelled) tilt scale column is ignored, --tilt-scale multiplies every slice by it.
+
+import os, sys, argparse
+
+import numpy as np
+
+import mrcio
+import ctf_stack
+import starfile
+
+# Upper limit on the number of values scattered at once, sets how many particles are put in one batch
+MAX_BATCH_VALUES = 2**24
+
+
+#
+def electron_wavelength(voltage):
+    # Relativistic electron wavelength (in A) for an acceleration voltage in kV
+    volts = voltage * 1e3
+    return 12.2643247 / np.sqrt(volts * (1. + volts * 0.978466e-6))
+#
+
+#
+def read_ctf_tables(filename):
+    # Reads the tilt tables of a 3D CTF model .star file (one or several data blocks).
+    # Returns a list of (blockname, table) where table is a dictionary of per-tilt arrays.
+    tables = []
+    for blockname, startable in starfile.read_star(filename).items():
+        table = {}
+        for label in startable.labels:
+            table[label] = startable.floats(label)
+        # The tilt scale factor is written as an extra column without a label
+        if len(startable.unlabelled) > 0:
+            table['scale'] = startable.unlabelled[0].astype(np.float64)
+        else:
+            table['scale'] = np.ones(len(startable))
+        tables.append((blockname, table))
+    return tables
+#
+
+#
+def slice_geometry(tilts, boxsize):
+    # Sets up the trilinear insertion of one central slice per tilt into a boxsize^3 Fourier volume.
+    # Returns the 2D frequency (in 1/px, squared), the tilt index and, for the 8 neighbouring voxels
+    # of every slice sample, the flat voxel index, interpolation weight and sample index.
+    half = boxsize // 2
+    freqs = np.arange(-half, boxsize - half)
+    fy, fx = np.meshgrid(freqs, freqs, indexing='ij')
+    inside = (fx**2 + fy**2) < half**2
+    fx = fx[inside].astype(np.float64)
+    fy = fy[inside].astype(np.float64)
+
+    ntilts = len(tilts)
+    nsamples = len(fx)
+    sample_tilt = np.repeat(np.arange(ntilts), nsamples)
+    sample_u2 = np.tile(fx**2 + fy**2, ntilts)
+
+    # Rotating the slice around Y: (x, y, 0) -> (x cos(tilt), y, -x sin(tilt))
+    tilt_radians = np.radians(np.asarray(tilts, dtype=np.float64))
+    x3 = (fx[None, :] * np.cos(tilt_radians)[:, None]).ravel() + half
+    y3 = np.tile(fy, ntilts) + half
+    z3 = (-fx[None, :] * np.sin(tilt_radians)[:, None]).ravel() + half
+
+    x0 = np.floor(x3).astype(np.int64)
+    y0 = np.floor(y3).astype(np.int64)
+    z0 = np.floor(z3).astype(np.int64)
+    dx = x3 - x0
+    dy = y3 - y0
+    dz = z3 - z0
+
+    indices = []
+    weights = []
+    sources = []
+    sample_index = np.arange(len(x3))
+    for cz in (0, 1):
+        for cy in (0, 1):
+            for cx in (0, 1):
+                weight = (dx if cx else 1 - dx) * (dy if cy else 1 - dy) * (dz if cz else 1 - dz)
+                xi = x0 + cx
+                yi = y0 + cy
+                zi = z0 + cz
+                valid = (weight > 0) & (xi >= 0) & (xi < boxsize) & (yi >= 0) & (yi < boxsize) & (zi >= 0) & (zi < boxsize)
+                indices.append(((zi * boxsize + yi) * boxsize + xi)[valid])
+                weights.append(weight[valid])
+                sources.append(sample_index[valid])
+
+    geometry = {}
+    geometry['boxsize'] = boxsize
+    geometry['tilts'] = np.asarray(tilts, dtype=np.float64)
+    geometry['sample_u2'] = sample_u2
+    geometry['sample_tilt'] = sample_tilt
+    geometry['index'] = np.concatenate(indices)
+    geometry['weight'] = np.concatenate(weights)
+    geometry['source'] = np.concatenate(sources)
+    geometry['weight_sum'] = np.bincount(geometry['index'], geometry['weight'], minlength=boxsize**3)
+    return geometry
+#
+
+#
+def ctf_slices(geometry, defoci, angpix, voltage, cs, ampcontrast, bfactors, scales):
+    # 2D CTF values of all slice samples for a batch of particles, defoci is (particles, tilts) in A.
+    # Same convention as RELION: CTF = -sin(K1*deltaf*u^2 + K2*u^4 - K3) * exp(-B*u^2/4) * scale, with
+    # deltaf = -defocus for underfocus, so that the CTF at the origin is the amplitude contrast.
+    wavelength = electron_wavelength(voltage)
+    k1 = np.pi * wavelength
+    k2 = np.pi / 2 * cs * 1e7 * wavelength**3
+    k3 = np.arctan(ampcontrast / np.sqrt(1 - ampcontrast**2))
+
+    boxangstrom = geometry['boxsize'] * angpix
+    u2 = geometry['sample_u2'] / boxangstrom**2
+    tilt = geometry['sample_tilt']
+    deltaf = -np.asarray(defoci, dtype=np.float64)[:, tilt]
+    ctf = -np.sin(k1 * deltaf * u2[None, :] + k2 * u2[None, :]**2 - k3)
+    ctf *= (np.exp(-np.asarray(bfactors)[tilt] / 4. * u2) * np.asarray(scales)[tilt])[None, :]
+    return ctf
+#
+
+#
+def ctf_volumes(geometry, defoci, angpix, voltage, cs, ampcontrast, bfactors, scales):
+    # 3D CTF volumes of a batch of particles as an array of shape (particles, box, box, box)
+    boxsize = geometry['boxsize']
+    nvoxels = boxsize**3
+    nparticles = len(defoci)
+    ctf = ctf_slices(geometry, defoci, angpix, voltage, cs, ampcontrast, bfactors, scales)
+
+    values = ctf[:, geometry['source']] * geometry['weight'][None, :]
+    flat = geometry['index'][None, :] + (np.arange(nparticles, dtype=np.int64) * nvoxels)[:, None]
+    data = np.bincount(flat.ravel(), values.ravel(), minlength=nparticles * nvoxels).reshape(nparticles, nvoxels)
+
+    weight = np.where(geometry['weight_sum'] > 1., geometry['weight_sum'], 1.)
+    data /= weight[None, :]
+    return data.reshape(nparticles, boxsize, boxsize, boxsize).astype(np.float32)
+#
+
+#
+def table_parameters(table):
+    # voltage, Cs, amplitude contrast, per-tilt B-factors and per-tilt scales of a tilt table
+    return (table['_rlnVoltage'][0], table['_rlnSphericalAberration'][0], table['_rlnAmplitudeContrast'][0],
+            table['_rlnBfactor'], table['scale'])
+#
+
+#
+def batch_size(geometry):
+    return max(1, MAX_BATCH_VALUES // max(1, len(geometry['index'])))
+#
+
+#
+def compare_volumes(volume, reference):
+    # Correlation coefficient and largest absolute difference between two volumes
+    volume = np.asarray(volume, dtype=np.float64).ravel()
+    reference = np.asarray(reference, dtype=np.float64).ravel()
+    correlation = np.corrcoef(volume, reference)[0, 1]
+    return correlation, np.abs(volume - reference).max()
+#
+
+#
+def output_names(starname, tables):
+    # Per-particle .star files (single data_images block) give <name>.mrc, other blocks <block>.mrc
+    if len(tables) == 1 and tables[0][0] == 'images':
+        return [os.path.splitext(starname)[0] + '.mrc']
+    return [os.path.join(os.path.dirname(starname), blockname + '.mrc') for blockname, table in tables]
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute 3D CTF volumes from 3D CTF model .star files')
+    parser.add_argument('ctfstars', nargs='+', help='3D CTF model .star files')
+    parser.add_argument('--box', type=int, required=True, help='sub-tomogram box size (in px)')
+    parser.add_argument('--angpix', type=float, required=True, help='pixel size (in A)')
+    parser.add_argument('--tilt-scale', action='store_true', help='multiply the slices by the tilt scale column (relion_reconstruct ignores it)')
+    parser.add_argument('--blocks', nargs='+', help='only compute the volumes of these data blocks')
+    parser.add_argument('--reference', help='compare the first volume to this volume (e.g. from relion_reconstruct) instead of writing it')
+    parser.add_argument('--min-correlation', type=float, default=0.99, help='correlation with --reference required to pass')
+    parser.add_argument('--stack', help='write the volumes into this stack of volumes, in the slots given by their names')
+    parser.add_argument('--stack-size', type=int, help='number of volumes of the stack, if it has to be created')
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for starname in args.ctfstars:
+        tables = read_ctf_tables(starname)
+        for (blockname, table), outname in zip(tables, output_names(starname, tables)):
+            if args.blocks is not None and blockname not in set(args.blocks):
+                continue
+            if not args.tilt_scale:
+                table['scale'] = np.ones(len(table['scale']))
+            jobs.append((outname, table))
+
+    if args.reference is not None:
+        outname, table = jobs[0]
+        volume = ctf_volumes(slice_geometry(table['_rlnAngleTilt'], args.box), [table['_rlnDefocusU']], args.angpix, *table_parameters(table))[0]
+        header, reference = mrcio.open_mrc(args.reference)
+        correlation, maxdiff = compare_volumes(volume, reference)
+        print('Correlation with ' + args.reference + ': ' + str(correlation) + ', largest difference: ' + str(maxdiff))
+        if correlation < args.min_correlation:
+            return 1
+        return 0
+
+    # Particles that only differ in defocus are computed together, the slice geometry is shared by all with the same tilts
+    groups = {}
+    grouporder = []
+    for outname, table in jobs:
+        key = (tuple(table['_rlnAngleTilt']), ) + tuple(tuple(np.ravel(value)) for value in table_parameters(table))
+        if key not in groups:
+            groups[key] = []
+            grouporder.append(key)
+        groups[key].append((outname, table))
+
+    if args.stack is not None:
+        ctf_stack.create_stack(args.stack, args.stack_size, args.box, args.angpix)
+
+    geometries = {}
+    nwritten = 0
+    for key in grouporder:
+        group = groups[key]
+        tilts = key[0]
+        if tilts not in geometries:
+            geometries[tilts] = slice_geometry(tilts, args.box)
+        geometry = geometries[tilts]
+        step = batch_size(geometry)
+        for first in range(0, len(group), step):
+            batch = group[first:first+step]
+            defoci = [table['_rlnDefocusU'] for outname, table in batch]
+            volumes = ctf_volumes(geometry, defoci, args.angpix, *table_parameters(batch[0][1]))
+            if args.stack is not None:
+                ctf_stack.write_volumes(args.stack, [ctf_stack.volume_slot(outname) for outname, table in batch], volumes)
+                nwritten = nwritten + len(batch)
+                continue
+            for (outname, table), volume in zip(batch, volumes):
+                mrcio.write_mrc(outname, volume, pixelsize=args.angpix)
+                nwritten = nwritten + 1
+
+    print('Wrote ' + str(nwritten) + ' 3D CTF volumes')
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Cache of CTFFIND results shared between projects (CtffindCacheDir in relion_STA_updated.py).
+# A result is stored under the sha1 of the data of the tilt image and of all CTFFIND parameters (Cs, voltage,
+# amplitude contrast, pixel size, box, defocus range and step, astigmatism, resolution limits, CTFFIND program),
+# so a tilt image that was fitted before with the same parameters is found again in any project, whatever
+# its file name. Every entry is a small JSON file with the row of relion_run_ctffind's output .star file, plus a
+# copy of the diagnostic power spectrum if there is one:
+#   <CtffindCacheDir>/ab/abcdef....json and abcdef....ctf
+# Entries are written to a scratch file and renamed, so several processes can use the same cache. The cache
+# is kept below a maximum size by deleting the entries that were used least recently.
+#
+# Usage: ctffind_cache.py info /shared/ctffind_cache
+#        ctffind_cache.py evict /shared/ctffind_cache --max-size 5000    (in MB)
+
+import os, sys, json, socket, shutil, hashlib, argparse
+
+import mrcio
+
+ENTRY_SUFFIX = '.json'
+DIAGNOSTIC_SUFFIX = '.ctf'
+
+
+#
+def image_key(imagename, parameters):
+    # sha1 of the image dimensions, data type and data (not the rest of the header) and of the CTFFIND parameters
+    header = mrcio.read_header(imagename)
+    digest = hashlib.sha1()
+    digest.update(parameters.encode('utf-8'))
+    digest.update(str([header['nx'], header['ny'], header['nz'], header['mode']]).encode('utf-8'))
+    imagefile = open(imagename, 'rb')
+    imagefile.seek(mrcio.data_offset(header))
+    while True:
+        chunk = imagefile.read(1 << 20)
+        if not chunk:
+            break
+        digest.update(chunk)
+    imagefile.close()
+    return digest.hexdigest()
+#
+
+#
+def entry_name(cachedir, key):
+    return os.path.join(cachedir, key[:2], key + ENTRY_SUFFIX)
+#
+
+#
+def lookup(cachedir, key):
+    # The cached entry ({'labels': [...], 'values': [...], 'root': ...}) or None. A hit marks the entry as recently used.
+    name = entry_name(cachedir, key)
+    try:
+        entryfile = open(name, 'r')
+        entry = json.load(entryfile)
+        entryfile.close()
+        os.utime(name, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return entry
+#
+
+#
+def _write_atomic(filename, writer):
+    scratchname = filename + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+    writer(scratchname)
+    os.rename(scratchname, filename)
+#
+
+#
+def store(cachedir, key, labels, values, imageroot):
+    # Stores the output row of a tilt image (values for labels), imageroot is the image name without extension.
+    # The diagnostic spectrum imageroot.ctf is stored with it if it exists.
+    name = entry_name(cachedir, key)
+    if not os.path.exists(os.path.dirname(name)):
+        try:
+            os.makedirs(os.path.dirname(name))
+        except OSError:
+            pass
+    entry = {'labels': list(labels), 'values': [str(value) for value in values], 'root': imageroot}
+    if os.path.exists(imageroot + DIAGNOSTIC_SUFFIX):
+        _write_atomic(os.path.splitext(name)[0] + DIAGNOSTIC_SUFFIX, lambda scratchname: shutil.copyfile(imageroot + DIAGNOSTIC_SUFFIX, scratchname))
+    _write_atomic(name, lambda scratchname: _write_json(scratchname, entry))
+#
+
+#
+def _write_json(filename, data):
+    jsonfile = open(filename, 'w')
+    json.dump(data, jsonfile)
+    jsonfile.close()
+#
+
+#
+def restore(cachedir, key, entry, imageroot):
+    # The output row of a cached entry for the tilt image imageroot, with the file names of the image it was fitted on
+    # replaced. The diagnostic spectrum is copied to imageroot.ctf.
+    diagnosticname = os.path.splitext(entry_name(cachedir, key))[0] + DIAGNOSTIC_SUFFIX
+    if os.path.exists(diagnosticname):
+        shutil.copyfile(diagnosticname, imageroot + DIAGNOSTIC_SUFFIX)
+    oldroot = entry['root']
+    return [imageroot + value[len(oldroot):] if value.startswith(oldroot) else value for value in entry['values']]
+#
+
+#
+def cache_files(cachedir):
+    # Entries of the cache as (last use, bytes, [files]), the diagnostic spectrum counted with its entry
+    entries = []
+    if not os.path.isdir(cachedir):
+        return entries
+    for subdir in sorted(os.listdir(cachedir)):
+        subdir = os.path.join(cachedir, subdir)
+        if not os.path.isdir(subdir):
+            continue
+        for name in os.listdir(subdir):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            files = [os.path.join(subdir, name), os.path.join(subdir, name[:-len(ENTRY_SUFFIX)] + DIAGNOSTIC_SUFFIX)]
+            files = [filename for filename in files if os.path.exists(filename)]
+            try:
+                entries.append((os.path.getmtime(files[0]), sum([os.path.getsize(filename) for filename in files]), files))
+            except (IndexError, OSError):
+                continue
+    return entries
+#
+
+#
+def evict(cachedir, maxbytes):
+    # Deletes the least recently used entries until the cache is at most maxbytes, returns the number deleted
+    entries = cache_files(cachedir)
+    total = sum([entry[1] for entry in entries])
+    removed = 0
+    for lastuse, size, files in sorted(entries):
+        if total <= maxbytes:
+            break
+        for filename in files:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        total = total - size
+        removed = removed + 1
+    return removed
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and clean up the cache of CTFFIND results')
+    subparsers = parser.add_subparsers(dest='command')
+    infoparser = subparsers.add_parser('info', help='number of entries and size of the cache')
+    infoparser.add_argument('cachedir', help='cache folder (CtffindCacheDir)')
+    evictparser = subparsers.add_parser('evict', help='delete the least recently used entries')
+    evictparser.add_argument('cachedir', help='cache folder (CtffindCacheDir)')
+    evictparser.add_argument('--max-size', type=float, required=True, help='size to keep (in MB)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'evict':
+        removed = evict(args.cachedir, args.max_size * 1e6)
+        print('Deleted ' + str(removed) + ' entries')
+    entries = cache_files(args.cachedir)
+    print(str(len(entries)) + ' entries, ' + str("%.1f" % (sum([entry[1] for entry in entries]) / 1e6)) + ' MB in ' + args.cachedir)
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Python version of matlabHelpers/FSC_plot.m for comparing many refinements at once.
+# Computes the FSC of the two half-maps of every run, writes one table per run and a summary with the resolution at
+# FSC = 0.143 and 0.5 ('not resolved' if the FSC is below the threshold from the first shell on), and plots all
+# curves in one graph (if matplotlib is installed).
+# The Fourier shell of every voxel only depends on the box size, it is computed once per box size (before the
+# workers start, so they all share it) and reused for every pair of half-maps. The half-maps are memory-mapped,
+# and the pairs are transformed by a pool of processes.
+#
+# Usage: fsc_plot.py Refine3D/job010 Refine3D/job021 ...      (run_half1_class001_unfil.mrc and run_half2_... of each job)
+#        fsc_plot.py 'mixed defocus=half1.mrc:half2.mrc' ...   (name=half-map 1:half-map 2)
+#        [--angpix 5] [--mask mask.mrc] [--o fsc] [--workers 8]
+
+import os, sys, argparse, multiprocessing
+
+import numpy as np
+
+import mrcio
+
+# Half-maps of a RELION Refine3D job
+HALF_MAP_NAMES = ('run_half1_class001_unfil.mrc', 'run_half2_class001_unfil.mrc')
+
+# Shell index and weights of the half of Fourier space stored by rfftn, by box size
+_shells = {}
+
+
+#
+def shell_index(boxsize):
+    # Fourier shell (rounded radius in px) of every voxel of an rfftn of a boxsize^3 map, and the weight of each voxel
+    # (2 for the voxels that stand for themselves and their Friedel mate, 1 for the planes kx = 0 and kx = Nyquist).
+    if boxsize not in _shells:
+        frequencies = np.fft.fftfreq(boxsize) * boxsize
+        kz = frequencies[:, np.newaxis, np.newaxis]
+        ky = frequencies[np.newaxis, :, np.newaxis]
+        kx = np.arange(0, boxsize // 2 + 1)[np.newaxis, np.newaxis, :]
+        shells = np.rint(np.sqrt(kz**2 + ky**2 + kx**2)).astype(np.int32)
+        selfmates = (kx == 0) | ((kx == boxsize // 2) & (boxsize % 2 == 0))
+        weights = np.where(selfmates, 1.0, 2.0) * np.ones(shells.shape)
+        _shells[boxsize] = (shells.ravel(), weights.ravel())
+    return _shells[boxsize]
+#
+
+#
+def fsc_curve(half1, half2, mask=None):
+    # FSC of two maps for the shells 0 ... boxsize/2
+    boxsize = half1.shape[0]
+    shells, weights = shell_index(boxsize)
+    nshells = boxsize // 2 + 1
+    if mask is not None:
+        half1 = half1 * mask
+        half2 = half2 * mask
+    f1 = np.fft.rfftn(half1).ravel()
+    f2 = np.fft.rfftn(half2).ravel()
+    numerator = np.bincount(shells, weights=weights * (f1 * f2.conj()).real, minlength=nshells)
+    power1 = np.bincount(shells, weights=weights * (f1.real**2 + f1.imag**2), minlength=nshells)
+    power2 = np.bincount(shells, weights=weights * (f2.real**2 + f2.imag**2), minlength=nshells)
+    denominator = np.sqrt(power1 * power2)[:nshells]
+    fsc = np.zeros(nshells)
+    nonzero = denominator > 0
+    fsc[nonzero] = numerator[:nshells][nonzero] / denominator[nonzero]
+    return fsc
+#
+
+#
+def resolution_at(fsc, boxsize, pixelsize, threshold):
+    # Resolution (in A) where the FSC first drops below threshold, between shells by linear interpolation.
+    # Nyquist if it never does, None (not resolved) if it is below threshold at shell 1 already: a crossing before
+    # shell 1 would be a resolution coarser than the box.
+    if len(fsc) < 2 or fsc[1] < threshold:
+        return None
+    for shell in range(2, len(fsc)):
+        if fsc[shell] < threshold:
+            previous = fsc[shell - 1]
+            crossing = shell - 1 + (previous - threshold) / (previous - fsc[shell]) if previous != fsc[shell] else shell
+            return boxsize * pixelsize / crossing
+    return 2.0 * pixelsize
+#
+
+#
+def format_resolution(resolution):
+    if resolution is None:
+        return 'not resolved'
+    return str("%.2f" % resolution)
+#
+
+#
+def parse_run(text):
+    # 'name=half1.mrc:half2.mrc', 'half1.mrc:half2.mrc' or a Refine3D job folder -> (name, half1, half2)
+    name = None
+    if '=' in text:
+        name, text = text.split('=', 1)
+    if ':' in text:
+        half1, half2 = text.split(':', 1)
+    else:
+        half1, half2 = [os.path.join(text, halfname) for halfname in HALF_MAP_NAMES]
+    if name is None:
+        name = os.path.normpath(text).replace('/', '_').replace(':', '_')
+    return name, half1, half2
+#
+
+#
+def compute_run(job):
+    # FSC of one pair of half-maps
+    name, half1name, half2name, pixelsize, maskname = job
+    header1, half1 = mrcio.open_mrc(half1name)
+    header2, half2 = mrcio.open_mrc(half2name)
+    if half1.shape != half2.shape or half1.shape[0] != half1.shape[1] or half1.shape[0] != half1.shape[2]:
+        raise ValueError('The half-maps of ' + name + ' are not cubes of the same size')
+    if pixelsize is None:
+        pixelsize = mrcio.pixel_size(header1)
+    mask = None
+    if maskname is not None:
+        maskheader, mask = mrcio.open_mrc(maskname)
+    fsc = fsc_curve(half1, half2, mask)
+    del half1, half2, mask
+    return name, fsc, header1['nx'], pixelsize
+#
+
+#
+def write_table(filename, fsc, boxsize, pixelsize):
+    # Shell, spatial frequency (1/A), resolution (A) and FSC of every shell
+    tablefile = open(filename, 'w')
+    tablefile.write('# shell\tfrequency_1/A\tresolution_A\tFSC\n')
+    for shell in range(0, len(fsc)):
+        frequency = shell / (boxsize * pixelsize)
+        resolution = 1.0 / frequency if shell > 0 else float('inf')
+        tablefile.write(str(shell) + '\t' + str("%.5f" % frequency) + '\t' + str("%.2f" % resolution) + '\t' + str("%.5f" % fsc[shell]) + '\n')
+    tablefile.close()
+#
+
+#
+def plot_curves(filename, results):
+    # All FSC curves over spatial frequency in one graph, with the 0.5 and 0.143 thresholds
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure(figsize=(8, 5))
+    axes = figure.add_subplot(111)
+    for name, fsc, boxsize, pixelsize in results:
+        axes.plot(np.arange(0, len(fsc)) / (boxsize * pixelsize), fsc, linewidth=2, label=name)
+    axes.axhline(0.5, linestyle='--', color='grey', label='FSC = 0.5')
+    axes.axhline(0.143, linestyle='--', color='black', label='FSC = 0.143')
+    axes.axhline(0.0, color='black', linewidth=0.5)
+    axes.set_ylim(-0.05, 1.01)
+    axes.set_xlabel('Spatial frequency [1/A]', fontweight='bold')
+    axes.set_ylabel('Correlation coefficient', fontweight='bold')
+    axes.legend()
+    figure.savefig(filename, dpi=150)
+    plt.close(figure)
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FSC curves and resolution of the half-maps of many refinements')
+    parser.add_argument('runs', nargs='+', help='Refine3D job folders or [name=]half1.mrc:half2.mrc')
+    parser.add_argument('--angpix', type=float, help='pixel size (in A), default from the header of the half-maps')
+    parser.add_argument('--mask', help='mask applied to both half-maps (same box size as all runs)')
+    parser.add_argument('--o', dest='output', default='fsc', help='output prefix: <o>_<run>.txt, <o>_summary.txt and <o>.png')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of processes')
+    args = parser.parse_args(argv)
+
+    runs = [parse_run(text) for text in args.runs]
+    jobs = [(name, half1, half2, args.angpix, args.mask) for name, half1, half2 in runs]
+
+    # The shells of every box size are computed before the workers are started, so they inherit them
+    for boxsize in sorted(set([mrcio.read_header(half1)['nx'] for name, half1, half2 in runs])):
+        shell_index(boxsize)
+
+    if args.workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.workers, len(jobs)))
+        results = pool.map(compute_run, jobs, 1)
+        pool.close()
+        pool.join()
+    else:
+        results = [compute_run(job) for job in jobs]
+
+    summaryname = args.output + '_summary.txt'
+    summaryfile = open(summaryname, 'w')
+    summaryfile.write('# run\tbox_px\tpixel_A\tresolution_0.143_A\tresolution_0.5_A\n')
+    for name, fsc, boxsize, pixelsize in results:
+        write_table(args.output + '_' + name + '.txt', fsc, boxsize, pixelsize)
+        resolution = resolution_at(fsc, boxsize, pixelsize, 0.143)
+        summaryfile.write(name + '\t' + str(boxsize) + '\t' + str("%.3f" % pixelsize) + '\t' + format_resolution(resolution) + '\t' + format_resolution(resolution_at(fsc, boxsize, pixelsize, 0.5)) + '\n')
+        if resolution is None:
+            print(name + ' is not resolved, its FSC is below 0.143 from the first shell on')
+        else:
+            print('The estimated resolution for ' + name + ' is ' + str("%.2f" % resolution) + ' A')
+    summaryfile.close()
+    print('FSC tables and resolutions written to ' + args.output + '_*.txt')
+
+    try:
+        plot_curves(args.output + '.png', results)
+        print('FSC curves plotted in ' + args.output + '.png')
+    except ImportError:
+        print('matplotlib is not installed, the FSC curves were not plotted')
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
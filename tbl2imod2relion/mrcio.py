@@ -0,0 +1,181 @@
+# Minimal memory-mapped MRC reader/writer used by relion_STA_updated.py.
+# Only the parts of the MRC2014 header needed to slice stacks and write images/volumes are handled.
+# Reading is zero-copy: the data block of a file is mapped with numpy.memmap, so a section of a
+# stack is only read from disk when it is actually used.
+
+import struct
+
+import numpy as np
+
+HEADER_BYTES = 1024
+
+# Byte offsets of the 4-byte character fields (EXTTYP, MAP and the machine stamp) among the numeric words of the first 224 bytes
+CHARACTER_WORDS = (104, 208, 212)
+NUMERIC_HEADER_BYTES = 224
+
+# MRC data modes supported here
+MODE_DTYPES = {0: np.int8, 1: np.int16, 2: np.float32, 6: np.uint16, 12: np.float16}
+
+
+#
+def read_header(filename):
+    # Parses the main header of an MRC file into a dictionary. The raw bytes are kept as a template
+    # for writing out images with the same labels and pixel size.
+    mrcfile = open(filename, 'rb')
+    raw = mrcfile.read(HEADER_BYTES)
+    mrcfile.close()
+    if len(raw) < HEADER_BYTES:
+        raise IOError('File is too short to be an MRC file: ' + filename)
+
+    # Machine stamp 0x11 0x11 is big endian, everything else is treated as little endian
+    if raw[212:213] == b'\x11':
+        endian = '>'
+    else:
+        endian = '<'
+
+    header = {}
+    header['endian'] = endian
+    header['nx'], header['ny'], header['nz'], header['mode'] = struct.unpack(endian + '4i', raw[0:16])
+    header['mx'], header['my'], header['mz'] = struct.unpack(endian + '3i', raw[28:40])
+    header['cella'] = struct.unpack(endian + '3f', raw[40:52])
+    header['ispg'] = struct.unpack(endian + 'i', raw[88:92])[0]
+    header['nsymbt'] = struct.unpack(endian + 'i', raw[92:96])[0]
+    header['raw'] = raw
+
+    if header['mode'] not in MODE_DTYPES:
+        raise IOError('Unsupported MRC mode ' + str(header['mode']) + ' in ' + filename)
+    return header
+#
+
+#
+def pixel_size(header):
+    # Pixel size (in A) along X as stored in the header, 0.0 if not set
+    if header['mx'] == 0:
+        return 0.0
+    return header['cella'][0] / header['mx']
+#
+
+#
+def data_offset(header):
+    return HEADER_BYTES + header['nsymbt']
+#
+
+#
+def data_dtype(header):
+    return np.dtype(MODE_DTYPES[header['mode']]).newbyteorder(header['endian'])
+#
+
+#
+def open_mrc(filename, mode='r'):
+    # Returns the header and a (nz, ny, nx) memory map of the data. Use mode='r+' to modify in place.
+    header = read_header(filename)
+    data = np.memmap(filename, dtype=data_dtype(header), mode=mode, offset=data_offset(header),
+                     shape=(header['nz'], header['ny'], header['nx']))
+    return header, data
+#
+
+#
+def little_endian_raw(header):
+    # The raw header bytes with all numeric words little endian, labels and character fields as they are
+    raw = bytearray(header['raw'][:HEADER_BYTES])
+    if header['endian'] == '>':
+        for offset in range(0, NUMERIC_HEADER_BYTES, 4):
+            if offset not in CHARACTER_WORDS:
+                raw[offset:offset+4] = raw[offset:offset+4][::-1]
+    return raw
+#
+
+#
+def make_header(data, template=None, pixelsize=None, ispg=None, mz=None):
+    # Builds a header for data (2D or 3D array) with up-to-date dimensions and statistics.
+    # Labels and pixel size are taken from template (a header from read_header) if given.
+    if data.ndim == 2:
+        nz = 1
+        ny, nx = data.shape
+    else:
+        nz, ny, nx = data.shape
+    mode = None
+    for key in MODE_DTYPES:
+        if np.dtype(MODE_DTYPES[key]) == data.dtype.newbyteorder('='):
+            mode = key
+    if mode is None:
+        raise ValueError('Cannot write data of type ' + str(data.dtype) + ' to an MRC file')
+    if mz is None:
+        mz = nz
+
+    if template is not None:
+        raw = little_endian_raw(template)
+        if pixelsize is None:
+            pixelsize = pixel_size(template)
+        if ispg is None:
+            ispg = template['ispg']
+    else:
+        raw = bytearray(HEADER_BYTES)
+        struct.pack_into('<3i', raw, 64, 1, 2, 3)
+        raw[208:212] = b'MAP '
+    if pixelsize is None:
+        pixelsize = 1.0
+    if ispg is None:
+        ispg = 0
+
+    # Everything is written little endian
+    raw[212:216] = b'\x44\x44\x00\x00'
+    struct.pack_into('<4i', raw, 0, nx, ny, nz, mode)
+    struct.pack_into('<3i', raw, 16, 0, 0, 0)
+    struct.pack_into('<3i', raw, 28, nx, ny, mz)
+    struct.pack_into('<3f', raw, 40, nx * pixelsize, ny * pixelsize, mz * pixelsize)
+    struct.pack_into('<3f', raw, 52, 90.0, 90.0, 90.0)
+    struct.pack_into('<i', raw, 88, ispg)
+    # The extended header is not copied
+    struct.pack_into('<i', raw, 92, 0)
+    set_statistics(raw, data)
+    return raw
+#
+
+#
+def set_statistics(raw, data):
+    # Writes min, max, mean and rms of data into the header bytes
+    if data.size > 0:
+        values = np.asarray(data, dtype=np.float64)
+        stats = (values.min(), values.max(), values.mean())
+        rms = values.std()
+    else:
+        stats = (0.0, 0.0, 0.0)
+        rms = 0.0
+    struct.pack_into('<3f', raw, 76, stats[0], stats[1], stats[2])
+    struct.pack_into('<f', raw, 216, rms)
+#
+
+#
+def write_mrc(filename, data, template=None, pixelsize=None):
+    # Writes a 2D image or a 3D volume as a single MRC file
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))
+    raw = make_header(data, template=template, pixelsize=pixelsize)
+    outfile = open(filename, 'wb')
+    outfile.write(raw)
+    outfile.write(data.tobytes())
+    outfile.close()
+#
+
+#
+def iter_write_sections(stackname, outnames, sections=None):
+    # Writes sections of an image stack into single-image MRC files in one pass over the stack and
+    # yields each file name as soon as it has been written, so it can be processed further right away.
+    # sections defaults to 0, 1, 2, ...
+    header, stack = open_mrc(stackname)
+    if sections is None:
+        sections = range(0, len(outnames))
+    for section, outname in zip(sections, outnames):
+        if section < 0 or section >= header['nz']:
+            raise IndexError('Section ' + str(section) + ' does not exist in ' + stackname + ' with ' + str(header['nz']) + ' sections')
+        write_mrc(outname, stack[section], template=header)
+        yield outname
+    del stack
+#
+
+#
+def write_sections(stackname, outnames, sections=None):
+    # Same as iter_write_sections, replaces one 'newstack -secs i' call per image
+    for outname in iter_write_sections(stackname, outnames, sections):
+        pass
+#
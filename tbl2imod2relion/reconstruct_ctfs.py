@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Reconstructs the 3D CTF volumes of all particles of one tomogram from the per-tomogram .star file
+# written by relion_STA_updated.py with CtfStarPerTomogram = True.
+# Every data block of that file (data_<Tomogram>_ctfNNNNNN) holds the tilt table of one particle.
+# Each block is written to a scratch .star file on local disk, handed to relion_reconstruct and
+# deleted again, the volume is written as <Tomogram>_ctfNNNNNN.mrc next to the per-tomogram .star file,
+# or with --stack into its slot of a stack of volumes (see ctf_stack.py).
+#
+# Usage: reconstruct_ctfs.py Particles/TS_01/TS_01_ctf.star SubtomogramSize PixelSize
+
+import os, sys, shutil, subprocess, tempfile, argparse
+
+import ctf_stack
+import mrcio
+import starfile
+
+
+#
+def reconstruct_block(table, outname, boxsize, angpix, scratchdir, executable='relion_reconstruct'):
+    # Runs relion_reconstruct for the tilt table (StarTable) of one particle, returns the exit code
+    scratchname = os.path.join(scratchdir, table.name + '.star')
+    writer = starfile.StarWriter(scratchname)
+    writer.write_table(table, 'images')
+    writer.close()
+    command = [executable, '--i', scratchname, '--o', outname, '--reconstruct_ctf', str(boxsize), '--angpix', str(angpix)]
+    returncode = subprocess.call(command)
+    os.remove(scratchname)
+    return returncode
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reconstruct all 3D CTF volumes of a per-tomogram CTF .star file')
+    parser.add_argument('ctfstar', help='per-tomogram .star file with one data block per particle')
+    parser.add_argument('boxsize', help='sub-tomogram box size (in px)')
+    parser.add_argument('angpix', help='pixel size (in A)')
+    parser.add_argument('--executable', default='relion_reconstruct', help='relion_reconstruct binary to use')
+    parser.add_argument('--blocks', nargs='+', help='only reconstruct these data blocks')
+    parser.add_argument('--stack', help='write the volumes into this stack of volumes, in the slots given by the block names')
+    parser.add_argument('--stack-size', type=int, help='number of volumes of the stack, if it has to be created')
+    args = parser.parse_args(argv)
+
+    outdir = os.path.dirname(args.ctfstar)
+    scratchdir = tempfile.mkdtemp(prefix='reconstruct_ctfs_')
+    failed = []
+    try:
+        if args.stack is not None:
+            ctf_stack.create_stack(args.stack, args.stack_size, int(args.boxsize), float(args.angpix))
+        for blockname, table in starfile.read_star(args.ctfstar).items():
+            if args.blocks is not None and blockname not in set(args.blocks):
+                continue
+            outname = os.path.join(outdir, blockname + '.mrc')
+            if args.stack is not None:
+                outname = os.path.join(scratchdir, blockname + '.mrc')
+            if reconstruct_block(table, outname, args.boxsize, args.angpix, scratchdir, args.executable) != 0:
+                failed.append(blockname)
+                continue
+            # The volume is moved into its slot of the stack
+            if args.stack is not None:
+                header, volume = mrcio.open_mrc(outname)
+                ctf_stack.write_volumes(args.stack, [ctf_stack.volume_slot(blockname)], [volume])
+                del volume
+                os.remove(outname)
+    finally:
+        shutil.rmtree(scratchdir)
+
+    if len(failed) > 0:
+        print('relion_reconstruct failed for ' + str(len(failed)) + ' particles: ' + ' '.join(failed))
+        return 1
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
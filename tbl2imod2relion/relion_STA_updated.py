@@ -12,7 +12,9 @@ print 'It fixes compatibility with sbgrid and newer versions of imod'
 print 'Please run using Python2 and Relion 1.4 set in .sbgrid.conf'
 print '-----'
 
-import os, sys, commands, math, time, stat, glob, shutil
+import sys
+
+import sta_pipeline
 
 ######### INPUT #########################################
 
@@ -25,12 +27,41 @@ RootName = 'subtomo'
 ## Skip CTF correction. The 3D CTF model will have no CTF modulations, but will still use the Tilt and Bfactor weighting.
 SkipCTFCorrection = False
 
+## Write the tilt tables of all particles of a tomogram into one .star file (one data block per particle) instead of one .star file per particle.
+## do_all_reconstruct_ctfs.sh then calls reconstruct_ctfs.py once per tomogram to reconstruct the 3D CTF volumes.
+CtfStarPerTomogram = False
+
+## Program for the 3D CTF volumes in do_all_reconstruct_ctfs.sh: 'relion' (relion_reconstruct --reconstruct_ctf for every volume)
+## or 'numpy' (ctf_volume.py, computes the volumes of many particles at once without starting RELION)
+CtfVolumeEngine = 'relion'
+
+## Write the 3D CTF volumes of each tomogram into one stack Particles/<Tomogram>/<Tomogram>_ctf.mrcs instead of one .mrc file per volume,
+## particles refer to their volume as N@<Tomogram>_ctf.mrcs. Needs CtfVolumeEngine = 'numpy' or CtfStarPerTomogram = True.
+## The refinement then needs a RELION that reads volumes from stacks of volumes. Others read N@file.mrcs as one 2D section:
+## for those, write the volumes into single files with 'ctf_stack.py unpack particles_<RootName>.star <unpacked .star file>'.
+CtfVolumeStack = False
+
+## Only redo what changed since the last run: tilt images are only extracted and fitted again if the stack, tilt angles or CTFFIND
+## parameters changed, and only new or changed 3D CTF volumes are written and added to do_all_reconstruct_ctfs.sh.
+## What each tomogram was made from is recorded in <Tomogram>/ctffind/<Tomogram>_manifest.json.
+IncrementalUpdate = False
+
 ## Enter full Tomogram Size in Pixel. Input requires imod convention: Beam along Z, Tilt around Y.
 TomoSize = [3838, 3708, 3000]
 
 ## Enter calibrated Pixel Size (in A).
 PixelSize = 1.755
 
+## Keep the tilt angles, tilt order and dose, CTFFIND defoci, particle coordinates and tomogram dimensions of all tomograms in
+## tomogram_metadata.sqlite. The text files are only read again when they change, re-runs query the index instead.
+## With NumberOfWorkers > 1 the workers write to the index at the same time, which needs working file locks (not NFS).
+UseMetadataIndex = False
+
+## Take the size and pixel size of each tomogram from the header of its .mrc file (needs UseMetadataIndex = True), so that tomograms
+## of different sizes can be processed together. The tomogram has to follow the imod convention above. TomoSize and PixelSize are
+## used for tomograms whose .mrc file is not found, PixelSize also for headers without a pixel size.
+TomoSizeFromHeader = False
+
 ## CTFFIND CTF estimation input
 #################################
 # Microscope voltage in kV
@@ -67,6 +98,21 @@ Astigmatism = 2000
 OnlyDoUnfinishedCTFs = False
 # Skip running CTFFIND but re-run the rest of the setup script? True will skip running CTFFIND because it was run previously.
 ReRunCtffindSkip = False
+# Number of tilt images fitted by CTFFIND at the same time. With more than 1, every tilt image is fitted on its own as soon as it has been extracted.
+CtffindWorkers = 1
+# Extract the tilt images from the .mrcs stack directly in python (one pass over the stack) instead of one IMOD newstack call per image
+ExtractTiltsInProcess = True
+# Fourier crop the tilt images so that their Nyquist frequency is just beyond HighResLimit before CTFFIND reads them. CTFFIND is given the
+# larger pixel size (DStep) and a BoxSize smaller by the same factor, so it fits the same spectrum but reads and transforms several times fewer pixels.
+CtffindFourierCrop = False
+# Size (in px) of the longer side of the cropped tilt images, instead of the size from HighResLimit (0 uses HighResLimit).
+# It must be at least BoxSize, and its Nyquist frequency must reach HighResLimit.
+CtffindCropSize = 0
+# Folder for a cache of CTFFIND results that can be shared between projects (e.g. /shared/ctffind_cache, '' for no cache). Tilt images that were
+# fitted before with the same CTFFIND parameters (same image data, whatever the file name) are taken from the cache and not fitted again.
+CtffindCacheDir = ''
+# Maximum size of the CTFFIND cache (in MB), the least recently used results are deleted when it gets larger
+CtffindCacheSize = 10000
 #################################
 
 ## Other options to improve CTF accuracy
@@ -76,471 +122,57 @@ UseOnlyLowerTiltDefoci = False
 UseOnlyLowerTiltDefociLimit = 30.0
 ## 3D CTF model weighting B-factor per e-/A2
 Bfactor = 4.0
+## Tolerance (in A) for the defocus of particles to share one 3D CTF volume. Particles whose defocus in every tilt image rounds
+## to the same multiple of this value are given the same volume (<Tomogram>_ctfgroupNNNNNN.mrc). 0 gives every particle its own volume.
+DefocusQuantization = 0
 #################################
 
-###########################################################
-
-
-
-######## FUNCTIONS ########################################
-#print 'functions'
-
-#
-def ensure_dir(f):
-    d = os.path.dirname(f)
-    if not os.path.exists(d):
-        #print 'Making directory'
-        os.makedirs(d)
-#
-
-# To read the STAR files. Please note that this STAR file parser is only meant for setting up the sub-tomogram averaging scripts.
-# RELION has a more comprehensive parser in the main code.
-#
-def read_relion_star(filename):
-    starfile=open(filename, 'r')
-    j=-1
-    micnames=[]
-    defociu=[]
-    defociv=[]
-
-    for line in starfile:
-        #print line
-        emptycheck = line.isspace()
-        if(emptycheck):
-            #print 'empty line found'
-            continue
-
-        fields = line.split()
-        firstfield = fields[0]
-        if firstfield[0] == 'd':
-            #print 'data_ line found'
-            continue
-        if firstfield[0] == 'l':
-            #print 'loop_ line found'
-            continue
-        j=j+1
+## Parallelization
+#################################
+# Number of tomograms processed at the same time (1 processes them one after the other)
+NumberOfWorkers = 1
+# Number of 3D CTF volumes reconstructed at the same time by do_all_reconstruct_ctfs.sh. With more than 1, the reconstruction commands are written to
+# reconstruct_ctfs_jobs.sh and do_all_reconstruct_ctfs.sh runs them with run_ctf_jobs.py, which skips volumes that were already written,
+# retries failed commands and reports progress. Failed commands are listed in reconstruct_ctfs_jobs.sh.failed.
+ReconstructWorkers = 1
+# Number of reconstruction commands run one after the other by each of the ReconstructWorkers (fewer processes for many small volumes)
+ReconstructChunk = 10
+# Split the particles into this many shards, for refinement and 3D CTF reconstruction on several nodes. Every shard gets a folder
+# Shards/shard_NNN/ with its own particle .star file, do_all_reconstruct_ctfs.sh and manifest.json, in addition to the global files.
+# 'sta_shards.py merge Shards particles_<RootName>.star' puts the particle .star files of the shards back together.
+NumberOfShards = 1
+# 'particles' (shards of equal particle count) or 'tomogram' (all particles of a tomogram in the same shard)
+ShardBy = 'particles'
+#################################
 
-        if firstfield == '_rlnMicrographName':
-            imgnamecolumn = j
-            continue
-        if firstfield == '_rlnDefocusU':
-            defocusucolumn = j
-            continue
-        if firstfield == '_rlnDefocusV':
-            defocusvcolumn = j
-            continue
-        #if firstfield == '_rlnCtfFigureOfMerit':
-        #  ctffigureofmeritcolumn = j
-        #  continue
-        if firstfield[0] == '_':
-            continue
+## Run report
+#################################
+# Write wall and CPU time, external commands, files written, particles and tilt images of every stage to run_report.json
+WriteRunReport = True
+# Run every tomogram under cProfile and write the statistics to profile_<Tomogram>.prof (read with python -m pstats)
+ProfileTomograms = False
+#################################
 
-        micnames.append(fields[imgnamecolumn])
+###########################################################
 
-        if 'defocusucolumn' in locals():
-            defociu.append(fields[defocusucolumn])
-            defociv.append(fields[defocusvcolumn])
 
-    starfile.close()
-    if len(defociu) > 0:
-            return micnames,defociu,defociv
-    if len(defociu) == 0:
-            return micnames
-#
-#########################################################
 
 ######## RUNNING THE SCRIPT #################
+# All steps are in sta_pipeline.py, which can also be imported to set up many projects from one python process
 
 #################################
-print 'Running the script'
-
-# This is to ensure that each entered variable has the correct form
-Voltage = float(Voltage)
-Cs = float(Cs)
-Magnification = float(Magnification)
-DPixSize = float(DPixSize)
-PixelSize = float(PixelSize)
-PathToCtffind = str(PathToCtffind)
-PathToWrapper = str(PathToWrapper)
-BoxSize = float(BoxSize)
-LowResLimit = float(LowResLimit)
-HighResLimit = float(HighResLimit)
-LowDefocusLimit = float(LowDefocusLimit)
-HighDefocusLimit = float(HighDefocusLimit)
-DefocusStep = float(DefocusStep)
-AmpContrast = float(AmpContrast)
-Astigmatism = float(Astigmatism)
-UseOnlyLowerTiltDefociLimit = float(UseOnlyLowerTiltDefociLimit)
-Bfactor = float(Bfactor)
-
-# If you do not want CTF correction, and only want to have a weighted missing wedge
-if SkipCTFCorrection == True:
-    Cs = 0.0
-    AmpContrast = 1.0
-    UseTrialsForCtffind = False
-    UseOnlyLowerTiltDefoci = False
-#sys.exit()
-
-# Text file containing all RELION commands
-reliontextfile = open('relion_subtomo_commands.txt', 'w')
-
-## Looping through the micrographs
-ScriptDir = os.getcwd() + '/'
-print ScriptDir
-
-micnames = read_relion_star(TomogramStarFileName)
-print micnames
-
-# Shell script to do 3D CTF model reconstruction
-ctfreconstmastername = ScriptDir + 'do_all_reconstruct_ctfs.sh'
-ctfreconstmasterfile = open(ctfreconstmastername, 'w')
-os.chmod(ctfreconstmastername, stat.S_IRWXU)
-
-#
-# This is the master STAR file for refinement later on
-subtomostarname = ScriptDir + 'particles_' + RootName + '.star'
-subtomostarfile = open(subtomostarname, 'w')
-
-# writing out the header of the list star file
-subtomostarfile.write('data_' + '\n' + '\n')
-subtomostarfile.write('loop_' + '\n')
-subtomostarfile.write('_rlnMicrographName #1' + '\n')
-subtomostarfile.write('_rlnCoordinateX #2' + '\n')
-subtomostarfile.write('_rlnCoordinateY #3'+ '\n')
-subtomostarfile.write('_rlnCoordinateZ #4' + '\n')
-subtomostarfile.write('_rlnImageName #5' + '\n')
-subtomostarfile.write('_rlnCtfImage #6' +'\n')
-#
-
-for mic in micnames:
-    # Parsing the micrograph names
-    micsplit = os.path.splitext(mic)
-    microot = micsplit[0]
-    dirsplit = microot.split('/')
-    MicDirName = ""
-    for dircount in range(0,(len(dirsplit)-1)):
-        MicDirName = MicDirName + dirsplit[dircount]
-        MicDirName = MicDirName + '/'
-    MicRootName = dirsplit[len(dirsplit)-1]
-
-    print 'Processing ' + MicRootName + ' found in ' + MicDirName
-
-    # Parsing the metadata files
-    micname = MicDirName + MicRootName + '.mrc'
-    stackname = MicDirName + MicRootName + '.mrcs'
-    ordername = MicDirName + MicRootName + '.order'
-    coordsname = MicDirName + MicRootName + '.coords'
-    alitiltname = MicDirName + MicRootName + '.tlt'
-    print micname, stackname, ordername, coordsname, alitiltname
-
-    #
-    #sys.exit()
-
-    ##### Running CTFFIND on all images of the tilt series  ##########
-
-    CtffindDirName = 'ctffind/'
-    OutputDir = ScriptDir + MicDirName + CtffindDirName
-    newstackroot = MicDirName + CtffindDirName + MicRootName +  '_image'
-    #print OutputDir
-
-    ## Making a new directory to output the results of CTFFIND
-    ensure_dir(OutputDir)
-
-    ## Extracting the tilt information with the IMOD command extracttilts
-    if not os.path.exists(alitiltname):
-        extracttile_scratchname = OutputDir + 'extracttilt_output.txt'
-        print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Using IMOD extracttilts to get tilt angles' + '\n'
-        exttltline = 'extracttilts -InputFile ' + stackname + ' -tilts -OutputFile ' + OutputDir +  'tiltangles.txt > ' + extracttile_scratchname +  '\n'
-        print(exttltline)
-        os.system(exttltline)
-        os.remove(extracttile_scratchname)
-    if os.path.exists(alitiltname):
-        outtiltnametemp = OutputDir + 'tiltangles.txt'
-        shutil.copyfile(alitiltname,outtiltnametemp)
-
-    #sys.exit()
-
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Tilt values extracted ' + '\n'
-
-    ##
-    tiltanglesfilename = OutputDir + 'tiltangles.txt'
-    tiltfile = open(tiltanglesfilename, 'r')
-    ctffindstarname = OutputDir + MicRootName + '_images.star'
-    ctffindstarfile = open(ctffindstarname, 'w')
-    ctffindstarfile.write('data_' + '\n' + '\n')
-    ctffindstarfile.write('loop_' + '\n')
-    ctffindstarfile.write('_rlnMicrographName #1' + '\n')
-
-    exttilts=[]
-
-    i=-1
-    for line in tiltfile:
-        #print 'hello'
-        pair = line.split()
-        #print pair
-        i=i+1
-        # Tilt of the stage for the current image
-        tilt = float(pair[0])
-        #roundtilt = round(tilt)
-        exttilts.append(tilt)
-
-        # extracting each image using the IMOD command newstack
-        print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Extracting tilt series image ' + '\n'
-        newstack_scratchname = OutputDir + 'temp_newstack_out.txt'
-        extracted_image_name = newstackroot + str(tilt) + '_' + str(i) + '.mrc'
-        newstackline = 'newstack -secs ' + str(i) + ' ' + stackname + ' ' +  extracted_image_name + ' > ' + newstack_scratchname +'\n'
-        print(newstackline)
-        ctffindstarfile.write(extracted_image_name + '\n')
-        os.system(newstackline)
-        os.remove(newstack_scratchname)
-
-    ctffindstarfile.close()
-
-    # running CTFFIND using the RELION command relion_run_ctffind
-    # RELION 1.4
-    if SkipCTFCorrection == False:
-        outputstarname =  OutputDir + MicRootName +  '_ctffind.star'
-        outputstarname_read = outputstarname
-
-        print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Running relion_run_ctffind ' + '\n'
-
-        relion_ctffindline = PathToWrapper + ' --i ' + ctffindstarname + ' --o ' + outputstarname + ' --CS ' + str(Cs) + ' --HT ' + str(Voltage) +  ' --ctfWin -1 --AmpCnst ' + str(AmpContrast) +  ' --DStep ' + str(DPixSize) +  ' --XMAG ' + str(Magnification) + ' --Box ' + str(BoxSize) +  ' --dFMin ' + str(LowDefocusLimit) + ' --dFMax ' + str(HighDefocusLimit) + ' --FStep ' + str(DefocusStep) + ' --dAst ' + str(Astigmatism) + ' --ResMin ' + str(LowResLimit) + ' --ResMax ' + str(HighResLimit) + ' --ctffind_exe \"' + PathToCtffind + ' --old-school-input\"'
-
-            # If some are unfinished
-        if OnlyDoUnfinishedCTFs == True:
-            relion_ctffindline = relion_ctffindline + ' --only_do_unfinished'
-            print(relion_ctffindline)
-        if ReRunCtffindSkip == False:
-            os.system(relion_ctffindline)
-            #
-            reliontextfile.write(relion_ctffindline + '\n')
-
-        print ':: RELION sub-tomogram averaging :: ' + '\n' + 'CTF Parameters of all tilt series images were estimated using RELION\'s  relion_run_ctffind ' + '\n'
-        print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Parameters have been saved in ' + outputstarname_read + '\n'
-
-    if SkipCTFCorrection == True:
-        outputstarname_read =  OutputDir + MicRootName +  '_ctffind.star'
-        ctffindoutstarfile = open(outputstarname_read, 'w')
-        ctffindoutstarfile.write('data_' + '\n' + '\n')
-        ctffindoutstarfile.write('loop_' + '\n')
-        ctffindoutstarfile.write('_rlnMicrographName #1' + '\n')
-        ctffindoutstarfile.write('_rlnDefocusU #2' + '\n')
-        ctffindoutstarfile.write('_rlnDefocusV #3' + '\n')
-
-        micnames = read_relion_star(ctffindstarname)
-            #print micnames
-        for kk in range(0,len(micnames)):
-            coline = micnames[kk] + '\t' + '0.000' + '\t' + '0.000' + '\n'
-            ctffindoutstarfile.write(coline)
-
-        ctffindoutstarfile.close()
-
-    tiltfile.close()
-
-    #sys.exit()
-
-    ##### Making .star files for each 3D CTF Volume #################
-    RelionPartName = 'Particles/'
-    RelionPartDir = ScriptDir + RelionPartName
-    RelionRecDir = RelionPartDir + MicDirName
-    RelionRecFileName =  RelionPartName + MicDirName + MicRootName + '_rec_CTF_volumes.sh'
-    RelionRecFileName_for_script =  MicRootName + '_rec_CTF_volumes.sh'
-
-    ## Making a new directory to output the results of CTFFIND
-    ensure_dir(RelionRecDir)
-
-    coordfile = open(coordsname, 'r')
-    relionfile = open(RelionRecFileName, 'w')
-
-    # Getting the tilt order
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Reading tilt series order file for dose dependent B-Factor weighting ' + '\n'
-    tiltorderfile = open(ordername, 'r')
-    tiltorder=[]
-    accumulated_dose=[]
-
-    for line in tiltorderfile:
-        emptycheck = line.isspace()
-        if(emptycheck):
-            #print 'empty line found'
-            continue
-        pair=line.split()
-        tiltorder.append(float(pair[0]))
-        accumulated_dose.append(float(pair[1]))
-
-    #print tiltorder, accumulated_dose
-    tiltorderfile.close()
-    #
-
-    # Reading the output of CTFFIND
-    micnames, avgdefoci, defocusv = read_relion_star(outputstarname_read)
-    final_avgdefoci=[]
-
-    print 'Using actual tilt images for CTF estimation' + '\n'
-    final_avgdefoci = avgdefoci
-    #print 'DEBUG', final_avgdefoci, exttilts
-
-    # If Higher tilts do not give reliable CTF estimations, then the lower tilts are used for CTF estimation
-    if UseOnlyLowerTiltDefoci == True:
-        print 'Using only lower tilts for CTF correction with the upper limit of ' + str(UseOnlyLowerTiltDefociLimit) + '\n'
-
-        ct = 0.0
-        td = 0.0
-
-        for ii in range(0, len(final_avgdefoci)):
-            #print exttilts[ii], final_avgdefoci[ii]
-            if abs(exttilts[ii]) < UseOnlyLowerTiltDefociLimit:
-                td = td + float(final_avgdefoci[ii])
-                ct=ct+1
-                avg_lower_tilt_defocus = td/ct
-
-        print 'Average defocus from the lower tilt images below ' + str(UseOnlyLowerTiltDefociLimit) + ' is ' + str(avg_lower_tilt_defocus) + '\n'
-
-        for ii in range(0, len(final_avgdefoci)):
-            #print exttilts[ii], final_avgdefoci[ii]
-            if abs(exttilts[ii]) > UseOnlyLowerTiltDefociLimit:
-                final_avgdefoci[ii] = avg_lower_tilt_defocus
-                #print 'DEBUG2', final_avgdefoci
-            print len(final_avgdefoci)
-            #print exttilts
-            #print avgdefoci
-            #print len(exttilts), len(tiltorder)
-        #sys.exit()
-
-        if len(tiltorder) != len(exttilts):
-            print ':: RELION sub-tomogram averaging :: ' + '\n' + 'The number of images in the aligned stack file and the tilt order file are different. Exiting'
-            sys.exit()
-
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'The number of images in the CTFFIND output file and the tilt order file are the same. Continuing.'
-
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Writing out .star files to make 3D CTF volumes ' + '\n'
-
-    # PixelSize calculation
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Using Hardcoded Pixel Size (in A)' + '\n'
-    print PixelSize
-
-    # Using hardcoded header Size for Tomogram Size
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Using Hardcoded Tomogram Size (in px) ' + '\n'
-    print TomoSize
-    xlimit = float(TomoSize[0])
-    zlimit = float(TomoSize[2])
-
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'Writing out .star files to make 3D CTF volumes ' + '\n'
-    subtomonum=0
-    for line in coordfile:
-        subtomonum = subtomonum+1
-        cols = line.split()
-        # Coordinates of the sub-tomogram in the tomogram
-        X = float(cols[0])
-        Y = float(cols[1])
-        Z = float(cols[2])
-
-        # Output 3D CTF volume and .star file
-        if SkipCTFCorrection == False:
-            outstarname = RelionPartName + MicDirName + MicRootName + '_ctf' + str("%06d" % subtomonum) + '.star'
-            #outstarname_for_rec_script = MicRootName + '_ctf' + str("%06d" % subtomonum) + '.star'
-            outctfname = RelionPartName + MicDirName + MicRootName + '_ctf' + str("%06d" % subtomonum) + '.mrc'
-            #outctfname_for_rec_script = MicRootName + '_ctf' + str("%06d" % subtomonum) + '.mrc'
-            outfile = open(outstarname, 'w')
-
-        if SkipCTFCorrection == True and subtomonum == 1:
-            outstarname = RelionPartName + MicDirName + MicRootName + '_ctf.star'
-            outctfname = RelionPartName + MicDirName + MicRootName + '_ctf.mrc'
-            outfile = open(outstarname, 'w')
-
-        # Writing out the header of the ctf star file
-        if not outfile.closed:
-            outfile.write('data_images' + '\n')
-            outfile.write('loop_' + '\n')
-            outfile.write('_rlnDefocusU #1 ' + '\n')
-            outfile.write('_rlnVoltage #2 ' + '\n')
-            outfile.write('_rlnSphericalAberration #3 ' + '\n')
-            outfile.write('_rlnAmplitudeContrast #4 ' + '\n')
-            outfile.write('_rlnAngleRot #5 ' + '\n')
-            outfile.write('_rlnAngleTilt #6' + '\n')
-            outfile.write('_rlnAnglePsi #7 ' + '\n')
-            outfile.write('_rlnBfactor #8 ' + '\n')
-
-        for j in range(0,len(exttilts)):
-            avgdefocus = float(final_avgdefoci[j])
-            tilt_radians = (exttilts[j]*math.pi/180)
-            tilt_degrees = exttilts[j]
-            #print tilt_radians, tilt_degrees
-
-            xtomo = float(X - (xlimit/2) )*PixelSize
-            ztomo = float(Z - (zlimit/2) )*PixelSize
-            #print xtomo, ztomo
-
-            # Calculating the height difference of the particle from the tilt axis
-            ximg = (xtomo*(math.cos(tilt_radians))) + (ztomo*(math.sin(tilt_radians)))
-            deltaD = ximg*math.sin(tilt_radians)
-            ptcldefocus = avgdefocus + deltaD
-
-            if SkipCTFCorrection == True:
-                ptcldefocus = avgdefocus        # Should be 0.000
-                #print ptcldefocus
-            #
-
-            # Now weighting the 3D CTF model using the tilt dependent scale factor and the dose dependent B-Factor
-            tiltscale = math.cos(abs(tilt_radians))
-            #print tiltscale
-
-            tiltstep = (max(exttilts) - min(exttilts))/(len(exttilts)-1)
-            besttiltdiff = tiltstep + 0.5
-
-            for k in range(0,len(tiltorder)):
-
-                tiltdiff = abs(tilt_degrees-tiltorder[k])
-
-                if tiltdiff < (tiltstep+0.25):
-                    if tiltdiff < besttiltdiff:
-                        besttiltdiff = tiltdiff
-                        accumulated_dose_current = accumulated_dose[k]
-
-            doseweight = accumulated_dose_current * Bfactor
-            #print exttilts, tiltorder, accumulated_dose, besttiltdiff, accumulated_dose_current
-            #print doseweight
-            #
-
-            # Writing parameters in the .star file for each 2D slice of the 3D CTF model volume
-            ang_rot = '0.0'
-            ang_psi = '0.0'
-            if not outfile.closed:
-                ctfline =  str("%.2f" % ptcldefocus) + '\t' + str(Voltage) + '\t' + str(Cs) + '\t' + str(AmpContrast) + '\t' + ang_rot + '\t' + str(tilt_degrees) + '\t' + ang_psi + '\t' + str(doseweight) + '\t' + str("%.2f" % tiltscale) + '\n'
-                outfile.write(ctfline)
-
-        # This is for parallilzation of the CTF reconstructions
-        if not outfile.closed:
-            reconstructline2 = 'relion_reconstruct --i ' + outstarname + ' --o ' + outctfname + ' --reconstruct_ctf ' + '$1' + ' --angpix ' + str("%.2f" % PixelSize) + '\n'
-            ctfreconstmasterfile.write(reconstructline2)
-
-        # writing the .star file for refinement
-        currentsubtomoname = RelionPartName+ MicDirName +  MicRootName + '_' + RootName + str("%06d" % subtomonum) + '.mrc'
-        subtomostarline = micname + '\t' + str(X) + '\t' + str(Y) + '\t' + str(Z) + '\t' + currentsubtomoname + '\t' + outctfname + '\n'
-        subtomostarfile.write(subtomostarline)
-
-        outfile.close()
-
-    relionfile.close()
-
-    #ctfreconstmasterfile.write('cd ' + RelionPartName + MicDirName + '\n')
-    #ctfreconstmasterfile.write( RelionRecFileName_for_script + ' $1''\n')
-    #ctfreconstmasterfile.write('cd ' + ScriptDir + '\n')
-
-    os.chmod(RelionRecFileName, stat.S_IRWXU)
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + '.star files to make 3D CTF volumes were written out in ' + RelionRecDir + '\n'
-    print ':: RELION sub-tomogram averaging :: ' + '\n' + 'shell script to reconstruct the 3D CTF volumes is ' + RelionRecFileName + '\n'
-
-#sys.exit()
-
-##### Making .star files for each 3D CTF Volume #################
-
-subtomostarfile.close()
-ctfreconstmasterfile.close()
-reliontextfile.close()
-
-print ':: RELION sub-tomogram averaging :: '
-print 'Please extract sub-tomograms using the RELION GUI. Remember to use the same subtomoname as you gave in this script'
-print 'Please run the 3D CTF model volume reconstructions using the .sh scripts written in the working directory'
-print 'run this script from the command line with the command '
-print 'do_all_reconstruct_ctfs.sh SubtomogramSize '
-print 'STAR file to use for refinement (after sub-tomogram extraction and 3D CTF volume reconstruction) was written in ' + subtomostarname
+if __name__ == '__main__':
+    print 'Running the script'
+    Config = sta_pipeline.StaConfig.from_namespace(globals())
+    try:
+        Project = sta_pipeline.process_project(Config)
+    except ValueError as error:
+        print ':: RELION sub-tomogram averaging :: ' + '\n' + str(error) + ' Exiting'
+        sys.exit()
+
+    print ':: RELION sub-tomogram averaging :: '
+    print 'Please extract sub-tomograms using the RELION GUI. Remember to use the same subtomoname as you gave in this script'
+    print 'Please run the 3D CTF model volume reconstructions using the .sh scripts written in the working directory'
+    print 'run this script from the command line with the command '
+    print 'do_all_reconstruct_ctfs.sh SubtomogramSize '
+    print 'STAR file to use for refinement (after sub-tomogram extraction and 3D CTF volume reconstruction) was written in ' + Project['particle_star']
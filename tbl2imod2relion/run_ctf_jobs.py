@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# Runs the 3D CTF volume reconstructions of do_all_reconstruct_ctfs.sh (or any file with one command per line)
+# with several workers instead of one after the other.
+# Consecutive commands are put together into batches of --chunk commands, so that one shell is started per
+# batch instead of per volume. Volumes that were already written (a complete MRC file of the right box size
+# at the --o path of relion_reconstruct) are not reconstructed again, so an interrupted run can simply be restarted.
+# Commands that fail or do not write a complete volume are retried on their own up to --retries times,
+# the ones still failing are written to <jobfile>.failed.
+# Lines without an --o output (e.g. reconstruct_ctfs.py or ctf_volume.py calls) are always run.
+#
+# Usage: run_ctf_jobs.py do_all_reconstruct_ctfs.sh SubtomogramSize --workers 8
+# To test without RELION: run_ctf_jobs.py do_all_reconstruct_ctfs.sh 64 --relion-reconstruct ./stub_reconstruct.sh
+
+import os, sys, time, shutil, subprocess, tempfile, argparse
+from multiprocessing.pool import ThreadPool
+
+import mrcio
+
+
+#
+def read_jobs(filename, boxsize, executable=None):
+    # Commands of a job file with $1 replaced by the box size, blank lines and comments are left out
+    jobs = []
+    jobfile = open(filename, 'r')
+    for line in jobfile:
+        command = line.strip()
+        if len(command) == 0 or command[0] == '#':
+            continue
+        command = command.replace('${1}', str(boxsize)).replace('$1', str(boxsize))
+        if executable is not None and command.split()[0] == 'relion_reconstruct':
+            command = executable + command[len('relion_reconstruct'):]
+        jobs.append(command)
+    jobfile.close()
+    return jobs
+#
+
+#
+def job_output(command):
+    # Volume written by a command (the argument of --o), None if there is none
+    fields = command.split()
+    for j in range(0, len(fields)-1):
+        if fields[j] == '--o':
+            return fields[j+1]
+    return None
+#
+
+#
+def valid_output(filename, boxsize=None):
+    # True if filename is a complete MRC volume, of size boxsize^3 if given
+    if filename is None or not os.path.exists(filename):
+        return False
+    try:
+        header = mrcio.read_header(filename)
+    except IOError:
+        return False
+    if boxsize is not None and (header['nx'], header['ny'], header['nz']) != (boxsize, boxsize, boxsize):
+        return False
+    expected = mrcio.data_offset(header) + header['nx'] * header['ny'] * header['nz'] * mrcio.data_dtype(header).itemsize
+    return os.path.getsize(filename) == expected
+#
+
+#
+def run_batch(batch, scratchdir, logname):
+    # Runs a batch of (index, command) in one shell, returns (index, exit code) for every command
+    statusname = os.path.join(scratchdir, 'status_' + str(batch[0][0]))
+    script = ''
+    for index, command in batch:
+        script = script + command + '\n' + 'echo ' + str(index) + ' $? >> ' + statusname + '\n'
+    logfile = open(logname, 'a')
+    subprocess.call(['/bin/sh', '-c', script], stdout=logfile, stderr=subprocess.STDOUT)
+    logfile.close()
+
+    returncodes = dict((index, 1) for index, command in batch)
+    if os.path.exists(statusname):
+        statusfile = open(statusname, 'r')
+        for line in statusfile:
+            fields = line.split()
+            returncodes[int(fields[0])] = int(fields[1])
+        statusfile.close()
+        os.remove(statusname)
+    return [(index, returncodes[index]) for index, command in batch]
+#
+
+#
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return str("%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60))
+#
+
+#
+def run_jobs(jobs, boxsize, workers=1, chunk=1, retries=2, logname='run_ctf_jobs.log', skip_existing=True):
+    # Runs all jobs, returns the list of commands that failed after all retries
+    outputs = [job_output(command) for command in jobs]
+    pending = []
+    for index in range(0, len(jobs)):
+        if skip_existing and valid_output(outputs[index], boxsize):
+            continue
+        pending.append(index)
+    nskipped = len(jobs) - len(pending)
+    if nskipped > 0:
+        print('Skipping ' + str(nskipped) + ' of ' + str(len(jobs)) + ' jobs whose volumes already exist')
+
+    scratchdir = tempfile.mkdtemp(prefix='run_ctf_jobs_')
+    pool = ThreadPool(workers)
+    failed = []
+    attempt = 0
+    try:
+        while len(pending) > 0:
+            # Retries are run on their own, so one bad command does not fail a whole batch again
+            if attempt > 0:
+                print('Retrying ' + str(len(pending)) + ' failed jobs (attempt ' + str(attempt+1) + ' of ' + str(retries+1) + ')')
+                step = 1
+            else:
+                step = chunk
+            batches = [[(index, jobs[index]) for index in pending[first:first+step]] for first in range(0, len(pending), step)]
+
+            failed = []
+            ndone = 0
+            start = time.time()
+            for results in pool.imap_unordered(lambda batch: run_batch(batch, scratchdir, logname), batches):
+                for index, returncode in results:
+                    ndone = ndone + 1
+                    if returncode != 0 or (outputs[index] is not None and not valid_output(outputs[index], boxsize)):
+                        failed.append(index)
+                elapsed = time.time() - start
+                rate = ndone / max(elapsed, 1e-6)
+                eta = (len(pending) - ndone) / rate
+                print(str(ndone) + ' / ' + str(len(pending)) + ' jobs done, ' + str(len(failed)) + ' failed, ' + str("%.2f" % rate) + ' jobs/s, ETA ' + format_seconds(eta))
+                sys.stdout.flush()
+
+            attempt = attempt + 1
+            pending = sorted(failed)
+            if attempt > retries:
+                break
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(scratchdir)
+    return [jobs[index] for index in sorted(failed)]
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the 3D CTF volume reconstructions of do_all_reconstruct_ctfs.sh in parallel')
+    parser.add_argument('jobfile', help='file with one command per line, e.g. do_all_reconstruct_ctfs.sh')
+    parser.add_argument('boxsize', type=int, help='sub-tomogram box size (in px), replaces $1')
+    parser.add_argument('--workers', type=int, default=1, help='number of commands run at the same time')
+    parser.add_argument('--chunk', type=int, default=1, help='number of commands run one after the other by one worker process')
+    parser.add_argument('--retries', type=int, default=2, help='number of times a failed command is run again')
+    parser.add_argument('--no-skip', action='store_true', help='also reconstruct volumes that already exist')
+    parser.add_argument('--log', help='file for the output of the commands (default: <jobfile>.log)')
+    parser.add_argument('--relion-reconstruct', help='run this program instead of relion_reconstruct, e.g. a stub for testing')
+    args = parser.parse_args(argv)
+
+    logname = args.log
+    if logname is None:
+        logname = args.jobfile + '.log'
+    jobs = read_jobs(args.jobfile, args.boxsize, args.relion_reconstruct)
+    print('Running ' + str(len(jobs)) + ' jobs from ' + args.jobfile + ' with ' + str(args.workers) + ' workers, output in ' + logname)
+
+    start = time.time()
+    failed = run_jobs(jobs, args.boxsize, max(1, args.workers), max(1, args.chunk), max(0, args.retries), logname, not args.no_skip)
+    print('Finished in ' + format_seconds(time.time() - start))
+
+    failedname = args.jobfile + '.failed'
+    if len(failed) > 0:
+        failedfile = open(failedname, 'w')
+        failedfile.writelines([command + '\n' for command in failed])
+        failedfile.close()
+        print(str(len(failed)) + ' jobs failed, they were written to ' + failedname)
+        return 1
+    if os.path.exists(failedname):
+        os.remove(failedname)
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
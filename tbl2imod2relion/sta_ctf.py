@@ -0,0 +1,129 @@
+# Vectorized 3D CTF model parameters for relion_STA_updated.py.
+# All particles of a tomogram share the tilt angles, doses and CTFFIND defoci, so everything
+# that only depends on the tilt is computed once per tomogram and the per-particle defocus
+# offsets are computed for all particles x tilts in one broadcast.
+# The text written out is identical to the per-particle loop of the original script.
+
+import math
+
+import numpy as np
+
+import starfile
+
+# Header of the .star file for each 3D CTF volume (after the data_ line)
+CTF_LOOP_HEADER = ('loop_' + '\n' +
+                   '_rlnDefocusU #1 ' + '\n' +
+                   '_rlnVoltage #2 ' + '\n' +
+                   '_rlnSphericalAberration #3 ' + '\n' +
+                   '_rlnAmplitudeContrast #4 ' + '\n' +
+                   '_rlnAngleRot #5 ' + '\n' +
+                   '_rlnAngleTilt #6' + '\n' +
+                   '_rlnAnglePsi #7 ' + '\n' +
+                   '_rlnBfactor #8 ' + '\n')
+
+
+#
+def load_coords(filename):
+    # Reads X, Y, Z of all particles in a .coords file as a (N, 3) array
+    coords = np.loadtxt(filename, usecols=(0, 1, 2), ndmin=2)
+    return coords.reshape(-1, 3)
+#
+
+#
+def tilt_doses(exttilts, tiltorder, accumulated_dose):
+    # For each tilt, the accumulated dose of the closest tilt in the .order file.
+    # Tilts without a match within one tilt step keep the dose of the previous tilt, as before.
+    if len(exttilts) > 1:
+        tiltstep = (max(exttilts) - min(exttilts))/(len(exttilts)-1)
+    else:
+        tiltstep = 0.0
+
+    doses = []
+    accumulated_dose_current = None
+    for tilt_degrees in exttilts:
+        besttiltdiff = tiltstep + 0.5
+        for k in range(0, len(tiltorder)):
+            tiltdiff = abs(tilt_degrees-tiltorder[k])
+            if tiltdiff < (tiltstep+0.25):
+                if tiltdiff < besttiltdiff:
+                    besttiltdiff = tiltdiff
+                    accumulated_dose_current = accumulated_dose[k]
+        if accumulated_dose_current is None:
+            raise ValueError('No entry in the tilt order file matches tilt ' + str(tilt_degrees))
+        doses.append(accumulated_dose_current)
+    return doses
+#
+
+#
+def tilt_trig(exttilts):
+    # sin and cos of all tilts, evaluated with math to keep the original rounding
+    tilt_radians = [tilt*math.pi/180 for tilt in exttilts]
+    sintilt = np.array([math.sin(t) for t in tilt_radians])
+    costilt = np.array([math.cos(t) for t in tilt_radians])
+    return sintilt, costilt
+#
+
+#
+def particle_defoci(coords, exttilts, defoci, tomosize, pixelsize):
+    # Defocus of every particle (rows) in every tilt image (columns).
+    # The height of the particle above the tilt axis shifts the defocus of the tilt image by deltaD.
+    xlimit = float(tomosize[0])
+    zlimit = float(tomosize[2])
+    avgdefoci = np.array([float(d) for d in defoci])
+    sintilt, costilt = tilt_trig(exttilts)
+
+    xtomo = (coords[:, 0] - (xlimit/2))*pixelsize
+    ztomo = (coords[:, 2] - (zlimit/2))*pixelsize
+
+    ximg = (xtomo[:, None]*costilt[None, :]) + (ztomo[:, None]*sintilt[None, :])
+    deltaD = ximg*sintilt[None, :]
+    return avgdefoci[None, :] + deltaD
+#
+
+#
+def quantize_defoci(ptcldefoci, tolerance):
+    # Rounds the defocus profiles of all particles to multiples of tolerance and finds the distinct ones.
+    # Returns the distinct profiles, in the order in which they first appear, and the profile index of every particle.
+    steps = np.round(np.asarray(ptcldefoci) / tolerance)
+    if len(steps) == 0:
+        return steps, []
+    unique, first, inverse = np.unique(steps, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    return unique[order] * tolerance, rank[inverse.ravel()].tolist()
+#
+
+#
+def ctf_line_suffixes(exttilts, doses, voltage, cs, ampcontrast, bfactor):
+    # Everything after the defocus column of a ctf .star line only depends on the tilt
+    ang_rot = '0.0'
+    ang_psi = '0.0'
+    suffixes = []
+    for j in range(0, len(exttilts)):
+        tilt_degrees = exttilts[j]
+        tilt_radians = (tilt_degrees*math.pi/180)
+        tiltscale = math.cos(abs(tilt_radians))
+        doseweight = doses[j] * bfactor
+        suffixes.append('\t' + str(voltage) + '\t' + str(cs) + '\t' + str(ampcontrast) + '\t' + ang_rot + '\t' + str(tilt_degrees) + '\t' + ang_psi + '\t' + str(doseweight) + '\t' + str("%.2f" % tiltscale) + '\n')
+    return suffixes
+#
+
+#
+def ctf_table(ptcldefoci, suffixes):
+    # The ctf .star lines (tilt table) of one particle
+    return ''.join(['%.2f' % d + s for d, s in zip(ptcldefoci, suffixes)])
+#
+
+#
+def ctf_star_block(blockname, table):
+    # One data block with the tilt table of one particle
+    return 'data_' + blockname + '\n' + CTF_LOOP_HEADER + table
+#
+
+#
+def write_ctf_star(filename, table):
+    writer = starfile.StarWriter(filename)
+    writer.write_text(ctf_star_block('images', table))
+    writer.close()
+#
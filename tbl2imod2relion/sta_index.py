@@ -0,0 +1,171 @@
+# Per-project metadata index (SQLite) for relion_STA_updated.py (UseMetadataIndex = True).
+# The tilt angles, tilt order and accumulated dose, CTFFIND defoci, particle coordinates and the dimensions
+# and pixel size of every tomogram (from its MRC header) are read from their text files once and stored in
+# tomogram_metadata.sqlite. A file is only read again if its content changed, everything else is queried.
+# Tomograms processed by several pool workers at the same time share the index, SQLite locks it while writing.
+# Tomograms are identified by the name of their reconstruction relative to the project folder (e.g. TS_01/TS_01.mrc),
+# so tomograms with the same name in different folders are kept apart.
+#
+# Query from python:  index = sta_index.open_index('tomogram_metadata.sqlite')
+#                     coords = sta_index.particle_coords(index, 'TS_01/TS_01.mrc')
+# or with the sqlite3 shell: SELECT tomogram, COUNT(*) FROM particles GROUP BY tomogram;
+
+import os, sqlite3
+
+import numpy as np
+
+import mrcio
+import sta_ctf
+import sta_manifest
+import starfile
+
+# Stored as user_version in the index. An index written with another schema is emptied and filled again,
+# everything in it can be read again from the text files.
+SCHEMA_VERSION = 2
+
+TABLES = ('tomograms', 'sources', 'tilts', 'tilt_order', 'defoci', 'particles')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS tomograms (micname TEXT PRIMARY KEY, nx INTEGER, ny INTEGER, nz INTEGER, pixelsize REAL)',
+    'CREATE TABLE IF NOT EXISTS sources (tomogram TEXT, kind TEXT, filename TEXT, signature TEXT, PRIMARY KEY (tomogram, kind))',
+    'CREATE TABLE IF NOT EXISTS tilts (tomogram TEXT, idx INTEGER, angle REAL, PRIMARY KEY (tomogram, idx))',
+    'CREATE TABLE IF NOT EXISTS tilt_order (tomogram TEXT, idx INTEGER, angle REAL, dose REAL, PRIMARY KEY (tomogram, idx))',
+    'CREATE TABLE IF NOT EXISTS defoci (tomogram TEXT, idx INTEGER, defocusu REAL, defocusv REAL, PRIMARY KEY (tomogram, idx))',
+    'CREATE TABLE IF NOT EXISTS particles (tomogram TEXT, idx INTEGER, x REAL, y REAL, z REAL, PRIMARY KEY (tomogram, idx))',
+)
+
+
+#
+def open_index(filename):
+    # Opens (and creates if needed) the index, waits up to 10 minutes for other processes writing to it.
+    # The schema is checked in one exclusive transaction, so workers opening the index at the same time do not
+    # both rebuild it.
+    index = sqlite3.connect(filename, timeout=600)
+    index.isolation_level = None
+    index.execute('BEGIN EXCLUSIVE')
+    try:
+        if index.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            for table in TABLES:
+                index.execute('DROP TABLE IF EXISTS ' + table)
+            index.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+        for statement in SCHEMA:
+            index.execute(statement)
+        index.execute('COMMIT')
+    except:
+        index.execute('ROLLBACK')
+        raise
+    index.isolation_level = ''
+    return index
+#
+
+#
+def _source_changed(index, tomogram, kind, filename, signature):
+    row = index.execute('SELECT filename, signature FROM sources WHERE tomogram = ? AND kind = ?', (tomogram, kind)).fetchone()
+    return row is None or row[0] != filename or row[1] != signature
+#
+
+#
+def _replace_rows(index, table, tomogram, kind, filename, signature, rows):
+    # Replaces the rows of one tomogram in table and records what they were read from, in one transaction
+    with index:
+        index.execute('DELETE FROM ' + table + ' WHERE tomogram = ?', (tomogram,))
+        if len(rows) > 0:
+            placeholders = ', '.join(['?'] * (len(rows[0]) + 1))
+            index.executemany('INSERT INTO ' + table + ' VALUES (' + placeholders + ')', [(tomogram, ) + tuple(row) for row in rows])
+        index.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (tomogram, kind, filename, signature))
+#
+
+#
+def ingest_tomogram(index, micname, tiltname, ordername, coordsname):
+    # Reads the tilt angles, tilt order, coordinates and tomogram header of the tomogram micname if they changed
+    # since they were last read. Returns the kinds of files that were read.
+    ingested = []
+    tomogram = micname
+
+    signature = str(sta_manifest.file_sha1(tiltname))
+    if _source_changed(index, tomogram, 'tilts', tiltname, signature):
+        tiltfile = open(tiltname, 'r')
+        angles = [float(line.split()[0]) for line in tiltfile if not line.isspace()]
+        tiltfile.close()
+        _replace_rows(index, 'tilts', tomogram, 'tilts', tiltname, signature, [(j, angles[j]) for j in range(0, len(angles))])
+        ingested.append('tilts')
+
+    signature = str(sta_manifest.file_sha1(ordername))
+    if _source_changed(index, tomogram, 'order', ordername, signature):
+        rows = []
+        orderfile = open(ordername, 'r')
+        for line in orderfile:
+            if line.isspace():
+                continue
+            pair = line.split()
+            rows.append((len(rows), float(pair[0]), float(pair[1])))
+        orderfile.close()
+        _replace_rows(index, 'tilt_order', tomogram, 'order', ordername, signature, rows)
+        ingested.append('order')
+
+    signature = str(sta_manifest.file_sha1(coordsname))
+    if _source_changed(index, tomogram, 'coords', coordsname, signature):
+        coords = sta_ctf.load_coords(coordsname).tolist()
+        _replace_rows(index, 'particles', tomogram, 'coords', coordsname, signature, [(j, ) + tuple(coords[j]) for j in range(0, len(coords))])
+        ingested.append('coords')
+
+    # Dimensions and pixel size of the tomogram, if the reconstruction is there
+    signature = str(sta_manifest.file_signature(micname))
+    if _source_changed(index, tomogram, 'header', micname, signature):
+        nx = ny = nz = pixelsize = None
+        if os.path.exists(micname):
+            header = mrcio.read_header(micname)
+            nx, ny, nz = header['nx'], header['ny'], header['nz']
+            pixelsize = mrcio.pixel_size(header)
+        with index:
+            index.execute('INSERT OR REPLACE INTO tomograms VALUES (?, ?, ?, ?, ?)', (micname, nx, ny, nz, pixelsize))
+            index.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (tomogram, 'header', micname, signature))
+        ingested.append('header')
+    return ingested
+#
+
+#
+def ingest_defoci(index, tomogram, ctffindstarname):
+    # Reads the defoci of all tilt images from the output of relion_run_ctffind if it changed
+    signature = str(sta_manifest.file_sha1(ctffindstarname))
+    if not _source_changed(index, tomogram, 'defoci', ctffindstarname, signature):
+        return False
+    table = starfile.first_table(ctffindstarname)
+    defocusu = table.floats('_rlnDefocusU').tolist()
+    defocusv = table.floats('_rlnDefocusV').tolist()
+    _replace_rows(index, 'defoci', tomogram, 'defoci', ctffindstarname, signature, [(j, defocusu[j], defocusv[j]) for j in range(0, len(defocusu))])
+    return True
+#
+
+#
+def tilt_angles(index, tomogram):
+    return [row[0] for row in index.execute('SELECT angle FROM tilts WHERE tomogram = ? ORDER BY idx', (tomogram,))]
+#
+
+#
+def tilt_order(index, tomogram):
+    # Tilt angles in the order they were recorded and the accumulated dose of each
+    rows = index.execute('SELECT angle, dose FROM tilt_order WHERE tomogram = ? ORDER BY idx', (tomogram,)).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+#
+
+#
+def tilt_defoci(index, tomogram):
+    return [row[0] for row in index.execute('SELECT defocusu FROM defoci WHERE tomogram = ? ORDER BY idx', (tomogram,))]
+#
+
+#
+def particle_coords(index, tomogram):
+    # X, Y, Z of all particles of a tomogram as a (N, 3) array, like sta_ctf.load_coords
+    rows = index.execute('SELECT x, y, z FROM particles WHERE tomogram = ? ORDER BY idx', (tomogram,)).fetchall()
+    return np.array(rows, dtype=np.float64).reshape(-1, 3)
+#
+
+#
+def tomogram_geometry(index, micname):
+    # [nx, ny, nz] and pixel size from the header of the tomogram, None if the tomogram was not found
+    row = index.execute('SELECT nx, ny, nz, pixelsize FROM tomograms WHERE micname = ?', (micname,)).fetchone()
+    if row is None or row[0] is None:
+        return None, None
+    return [row[0], row[1], row[2]], row[3]
+#
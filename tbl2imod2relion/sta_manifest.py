@@ -0,0 +1,63 @@
+# Per-tomogram manifest for incremental runs of relion_STA_updated.py (IncrementalUpdate = True).
+# The manifest is a small JSON file that records what the outputs of a tomogram were made from:
+# the stack and tilt angles for the extracted images, the CTFFIND command line for the defocus fits,
+# the pixel size and CTF parameters of the 3D CTF volumes, and a hash of the tilt table of every volume
+# (which covers the .coords and .order files and the CTFFIND defoci).
+# A re-run compares against it and only redoes the steps and volumes whose inputs changed.
+
+import os, json, hashlib
+
+
+#
+def text_sha1(text):
+    return hashlib.sha1(text.encode('utf-8') if not isinstance(text, bytes) else text).hexdigest()
+#
+
+#
+def file_sha1(filename):
+    # sha1 of the content of a file, None if it does not exist
+    if not os.path.exists(filename):
+        return None
+    digest = hashlib.sha1()
+    hashfile = open(filename, 'rb')
+    while True:
+        chunk = hashfile.read(1 << 20)
+        if not chunk:
+            break
+        digest.update(chunk)
+    hashfile.close()
+    return digest.hexdigest()
+#
+
+#
+def file_signature(filename):
+    # Size and modification time of a file, a cheap stand-in for the hash of large files like stacks
+    if not os.path.exists(filename):
+        return None
+    filestat = os.stat(filename)
+    return [filestat.st_size, filestat.st_mtime]
+#
+
+#
+def read_manifest(filename):
+    # Returns an empty manifest if there is none yet or it cannot be read
+    if not os.path.exists(filename):
+        return {}
+    try:
+        manifestfile = open(filename, 'r')
+        manifest = json.load(manifestfile)
+        manifestfile.close()
+    except ValueError:
+        return {}
+    return manifest
+#
+
+#
+def write_manifest(filename, manifest):
+    # Written to a scratch file first, so an interrupted run never leaves a half-written manifest
+    scratchname = filename + '.tmp'
+    manifestfile = open(scratchname, 'w')
+    json.dump(manifest, manifestfile, indent=1, sort_keys=True)
+    manifestfile.close()
+    os.rename(scratchname, filename)
+#
@@ -0,0 +1,1079 @@
+# Library version of relion_STA_updated.py, for running the setup of many projects from one python process.
+# All settings of the INPUT section of relion_STA_updated.py are attributes of a StaConfig, with the same names
+# and defaults. process_tomogram() runs all steps for one tomogram and process_project() for all tomograms of
+# a project, both return what they did instead of only writing it out:
+#
+#   import sta_pipeline
+#   config = sta_pipeline.StaConfig(TomoSize=[3838, 3708, 3000], PixelSize=1.755, ProjectDir='/data/project1')
+#   result = sta_pipeline.process_project(config)
+#   print(result['particle_star'], len(result['tomograms']))
+#
+# The metadata index of a project (UseMetadataIndex = True) stays open between the tomograms and projects handled
+# by a process, so a long-lived process queries it instead of opening it again for every tomogram.
+#
+# Usage: sta_pipeline.py ProjectDir [ProjectDir ...] [--config settings.json] [--set Name=Value ...]
+# runs the setup for several projects one after the other with the same settings.
+
+from __future__ import print_function
+
+import os, sys, time, stat, json, errno, shutil, argparse, collections, multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import ctf_crop
+import ctf_stack
+import ctffind_cache
+import mrcio
+import sta_ctf
+import sta_index
+import sta_manifest
+import sta_shards
+import sta_timing
+import starfile
+
+# Folder of this module and the helper scripts that the written shell scripts call
+CODE_DIR = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+# Seconds to wait for the tomogram workers. Only there so the wait can be interrupted with Ctrl-C (a get() without
+# timeout cannot be in Python 2), no run takes this long.
+POOL_TIMEOUT = 30 * 24 * 3600
+
+# All settings with their defaults, see the INPUT section of relion_STA_updated.py for what they do.
+# ProjectDir is the folder the tomogram STAR file and all outputs are relative to (None is the current folder).
+DEFAULTS = collections.OrderedDict([
+    ('ProjectDir', None),
+    ('TomogramStarFileName', './all_tomograms.star'),
+    ('RootName', 'subtomo'),
+    ('SkipCTFCorrection', False),
+    ('CtfStarPerTomogram', False),
+    ('CtfVolumeEngine', 'relion'),
+    ('CtfVolumeStack', False),
+    ('IncrementalUpdate', False),
+    ('TomoSize', [3838, 3708, 3000]),
+    ('PixelSize', 1.755),
+    ('UseMetadataIndex', False),
+    ('TomoSizeFromHeader', False),
+    ('Voltage', 300),
+    ('Cs', 2.7),
+    ('Magnification', 81000),
+    ('DPixSize', 14.2155),
+    ('PathToCtffind', '/programs/x86_64-linux/ctffind4/4.1.14-c7/bin/ctffind'),
+    ('PathToWrapper', '/programs/x86_64-linux/relion/1.4/bin/relion_run_ctffind'),
+    ('OnlyDoUnfinishedCTFs', False),
+    ('BoxSize', 256),
+    ('LowResLimit', 50),
+    ('HighResLimit', 10),
+    ('LowDefocusLimit', 20000),
+    ('HighDefocusLimit', 60000),
+    ('DefocusStep', 1000),
+    ('AmpContrast', 0.07),
+    ('Astigmatism', 2000),
+    ('ReRunCtffindSkip', False),
+    ('CtffindWorkers', 1),
+    ('ExtractTiltsInProcess', True),
+    ('CtffindFourierCrop', False),
+    ('CtffindCropSize', 0),
+    ('CtffindCacheDir', ''),
+    ('CtffindCacheSize', 10000),
+    ('UseOnlyLowerTiltDefoci', False),
+    ('UseOnlyLowerTiltDefociLimit', 30.0),
+    ('Bfactor', 4.0),
+    ('DefocusQuantization', 0),
+    ('NumberOfWorkers', 1),
+    ('ReconstructWorkers', 1),
+    ('ReconstructChunk', 10),
+    ('NumberOfShards', 1),
+    ('ShardBy', 'particles'),
+    ('WriteRunReport', True),
+    ('ProfileTomograms', False),
+])
+
+# Settings that have to be numbers
+FLOAT_SETTINGS = ['Voltage', 'Cs', 'Magnification', 'DPixSize', 'PixelSize', 'BoxSize', 'LowResLimit', 'HighResLimit', 'LowDefocusLimit',
+                  'HighDefocusLimit', 'DefocusStep', 'AmpContrast', 'Astigmatism', 'UseOnlyLowerTiltDefociLimit', 'Bfactor', 'DefocusQuantization', 'CtffindCacheSize']
+INT_SETTINGS = ['CtffindWorkers', 'CtffindCropSize', 'NumberOfWorkers', 'ReconstructWorkers', 'ReconstructChunk', 'NumberOfShards']
+
+# Rows of the CTFFIND .star files written here are space separated, like the ones relion_run_ctffind writes
+CTFFIND_SEPARATOR = ' '
+
+# Open metadata indexes of this process, by file name
+_metadata_indexes = {}
+
+
+#
+class StaConfig(object):
+
+    def __init__(self, **settings):
+        for name in DEFAULTS:
+            value = DEFAULTS[name]
+            if isinstance(value, list):
+                value = list(value)
+            setattr(self, name, value)
+        self.update(**settings)
+
+    def update(self, **settings):
+        for name in settings:
+            if name not in DEFAULTS:
+                raise ValueError('Unknown setting ' + name)
+            setattr(self, name, settings[name])
+        return self
+
+    def copy(self, **settings):
+        return StaConfig(**self.settings()).update(**settings)
+
+    def settings(self):
+        return collections.OrderedDict((name, getattr(self, name)) for name in DEFAULTS)
+
+    @classmethod
+    def from_namespace(cls, namespace):
+        # Config from the variables of a script (e.g. globals() of relion_STA_updated.py), other names are ignored
+        return cls(**dict((name, namespace[name]) for name in DEFAULTS if name in namespace))
+
+    def normalized(self):
+        # Copy with every setting in the correct form, and the CTF settings used without CTF correction
+        config = self.copy()
+        for name in FLOAT_SETTINGS:
+            setattr(config, name, float(getattr(config, name)))
+        for name in INT_SETTINGS:
+            setattr(config, name, int(getattr(config, name)))
+        config.PathToCtffind = str(config.PathToCtffind)
+        config.PathToWrapper = str(config.PathToWrapper)
+        # A relative ProjectDir is taken from the current folder now, not from the folder the steps later change into
+        if config.ProjectDir is not None:
+            config.ProjectDir = os.path.abspath(config.ProjectDir)
+
+        # Only the helper scripts can write into stacks of volumes, relion_reconstruct writes single files
+        if config.CtfVolumeStack == True and config.CtfVolumeEngine != 'numpy' and (config.CtfStarPerTomogram == False or config.SkipCTFCorrection == True):
+            raise ValueError('CtfVolumeStack = True needs CtfVolumeEngine = \'numpy\' or CtfStarPerTomogram = True (with CTF correction).')
+
+        # Cropped tilt images smaller than the CTFFIND box of the original images leave too little of the spectrum to fit
+        if config.CtffindFourierCrop == True and config.CtffindCropSize > 0 and config.CtffindCropSize < config.BoxSize:
+            raise ValueError('CtffindCropSize (' + str(config.CtffindCropSize) + ' px) must not be smaller than BoxSize (' + str(int(config.BoxSize)) + ' px).')
+
+        # If you do not want CTF correction, and only want to have a weighted missing wedge
+        if config.SkipCTFCorrection == True:
+            config.Cs = 0.0
+            config.AmpContrast = 1.0
+            config.UseOnlyLowerTiltDefoci = False
+        return config
+#
+
+#
+def project_dir(config):
+    # Folder of the project, with a trailing /
+    if config.ProjectDir is None:
+        return os.getcwd() + '/'
+    return os.path.abspath(config.ProjectDir) + '/'
+#
+
+#
+def open_metadata(filename):
+    # The metadata index, opened once per process (a connection can not be shared with forked pool workers)
+    key = (filename, os.getpid())
+    if key not in _metadata_indexes:
+        _metadata_indexes[key] = sta_index.open_index(filename)
+    return _metadata_indexes[key]
+#
+
+
+#
+def ensure_dir(f):
+    d = os.path.dirname(f)
+    if not os.path.exists(d):
+        #print 'Making directory'
+        # Another worker may create the same folder in between
+        try:
+            os.makedirs(d)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+#
+
+# To put the per-image outputs of relion_run_ctffind back into one STAR file, in the same format. All files need to have the same columns.
+#
+def merge_relion_stars(starnames, outname):
+    tables = [starfile.first_table(starname) for starname in starnames]
+    for starname, table in zip(starnames, tables):
+        if set(table.labels) != set(tables[0].labels):
+            raise ValueError(starname + ' has other columns than ' + starnames[0])
+    writer = starfile.StarWriter(outname, separator=CTFFIND_SEPARATOR)
+    writer.begin_block('', tables[0].labels)
+    for table in tables:
+        writer.write_rows(zip(*[table.column(label) for label in tables[0].labels]))
+    writer.close()
+#
+
+# The relion_run_ctffind (RELION 1.4) command line for all images in inputstar
+#
+def relion_ctffind_command(config, inputstar, outputstar, dpixsize=None, boxsize=None):
+    relion_ctffindline = config.PathToWrapper + ' --i ' + inputstar + ' --o ' + outputstar + ctffind_parameters(config, dpixsize, boxsize)
+    # If some are unfinished
+    if config.OnlyDoUnfinishedCTFs == True:
+        relion_ctffindline = relion_ctffindline + ' --only_do_unfinished'
+    return relion_ctffindline
+#
+
+# The CTFFIND parameters of relion_run_ctffind, everything that changes the fit. dpixsize and boxsize replace DPixSize and BoxSize
+# for Fourier cropped images.
+#
+def ctffind_parameters(config, dpixsize=None, boxsize=None):
+    if dpixsize is None:
+        dpixsize = config.DPixSize
+    if boxsize is None:
+        boxsize = config.BoxSize
+    return ' --CS ' + str(config.Cs) + ' --HT ' + str(config.Voltage) +  ' --ctfWin -1 --AmpCnst ' + str(config.AmpContrast) +  ' --DStep ' + str(dpixsize) +  ' --XMAG ' + str(config.Magnification) + ' --Box ' + str(boxsize) +  ' --dFMin ' + str(config.LowDefocusLimit) + ' --dFMax ' + str(config.HighDefocusLimit) + ' --FStep ' + str(config.DefocusStep) + ' --dAst ' + str(config.Astigmatism) + ' --ResMin ' + str(config.LowResLimit) + ' --ResMax ' + str(config.HighResLimit) + ' --ctffind_exe \"' + config.PathToCtffind + ' --old-school-input\"'
+#
+
+# Puts the rows of a relion_run_ctffind output file into the CTFFIND cache, keys are the cache keys of the images by name
+#
+def store_ctffind_results(config, outputstar, keys):
+    table = starfile.first_table(outputstar)
+    names = table.column('_rlnMicrographName')
+    for row in range(0, len(table)):
+        if names[row] in keys:
+            values = [table.column(label)[row] for label in table.labels]
+            ctffind_cache.store(config.CtffindCacheDir, keys[names[row]], table.labels, values, os.path.splitext(names[row])[0])
+    return table.labels
+#
+
+# The output row of a tilt image from its cache entry, in the order of labels
+#
+def cached_ctffind_row(config, key, entry, image_name, labels):
+    values = dict(zip(entry['labels'], ctffind_cache.restore(config.CtffindCacheDir, key, entry, os.path.splitext(image_name)[0])))
+    return [values.get(label, '') for label in labels]
+#
+
+# Runs relion_run_ctffind on a single tilt image, so that all images of a tilt series can be fitted at the same time.
+# An image that is found in the CTFFIND cache is not fitted again (unless use_cache is False), the command is then None.
+#
+def run_ctffind_image(config, image_name, dpixsize=None, boxsize=None, use_cache=True):
+    imageroot = os.path.splitext(image_name)[0]
+    imagestarname = imageroot + '_images.star'
+    imageoutputstarname = imageroot + '_ctffind.star'
+
+    if config.CtffindCacheDir != '':
+        key = ctffind_cache.image_key(image_name, ctffind_parameters(config, dpixsize, boxsize))
+        entry = ctffind_cache.lookup(config.CtffindCacheDir, key) if use_cache == True else None
+        if entry is not None:
+            imageoutputstarfile = starfile.StarWriter(imageoutputstarname, separator=CTFFIND_SEPARATOR)
+            imageoutputstarfile.begin_block('', entry['labels'])
+            imageoutputstarfile.write_row(cached_ctffind_row(config, key, entry, image_name, entry['labels']))
+            imageoutputstarfile.close()
+            return None, imageoutputstarname
+
+    imagestarfile = starfile.StarWriter(imagestarname)
+    imagestarfile.begin_block('', ['_rlnMicrographName'])
+    imagestarfile.write_row([image_name])
+    imagestarfile.close()
+
+    relion_ctffindline = relion_ctffind_command(config, imagestarname, imageoutputstarname, dpixsize, boxsize)
+    print(relion_ctffindline)
+    os.system(relion_ctffindline)
+    os.remove(imagestarname)
+    if config.CtffindCacheDir != '' and os.path.exists(imageoutputstarname):
+        store_ctffind_results(config, imageoutputstarname, {image_name: key})
+    return relion_ctffindline, imageoutputstarname
+#
+
+# Runs relion_run_ctffind on the tilt images of inputstar that are not in the CTFFIND cache and writes the results of all images
+# into outputstar, in the order of image_names. Returns the command, None if all images were found in the cache.
+# Cached entries with other columns than the fitted images (e.g. written by another RELION version) are fitted again.
+#
+def run_ctffind_cached(config, image_names, inputstar, outputstar, dpixsize, boxsize, timer):
+    parameters = ctffind_parameters(config, dpixsize, boxsize)
+    keys = dict((image_name, ctffind_cache.image_key(image_name, parameters)) for image_name in image_names)
+    entries = dict((image_name, ctffind_cache.lookup(config.CtffindCacheDir, keys[image_name])) for image_name in image_names)
+    missing = [image_name for image_name in image_names if entries[image_name] is None]
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + str(len(image_names) - len(missing)) + ' of ' + str(len(image_names)) + ' tilt images were found in the CTFFIND cache ' + config.CtffindCacheDir + '\n')
+
+    # Without any hits, relion_run_ctffind writes outputstar as usual
+    if len(missing) == len(image_names):
+        relion_ctffindline = relion_ctffind_command(config, inputstar, outputstar, dpixsize, boxsize)
+        timer.system(relion_ctffindline)
+        if os.path.exists(outputstar):
+            store_ctffind_results(config, outputstar, keys)
+        return relion_ctffindline
+
+    relion_ctffindline = None
+    fitted = {}
+    labels = None
+    if len(missing) == 0:
+        labels = entries[image_names[0]]['labels']
+        missing = [image_name for image_name in image_names if set(entries[image_name]['labels']) != set(labels)]
+    while len(missing) > 0:
+        # Only the images that were not found are fitted
+        outputroot = os.path.splitext(outputstar)[0]
+        missingstarname = outputroot + '_uncached_images.star'
+        missingstarfile = starfile.StarWriter(missingstarname)
+        missingstarfile.begin_block('', ['_rlnMicrographName'])
+        missingstarfile.write_rows([[image_name] for image_name in missing])
+        missingstarfile.close()
+        fittedstarname = outputroot + '_uncached.star'
+        relion_ctffindline = relion_ctffind_command(config, missingstarname, fittedstarname, dpixsize, boxsize)
+        timer.system(relion_ctffindline)
+        os.remove(missingstarname)
+        if not os.path.exists(fittedstarname):
+            raise IOError('relion_run_ctffind did not write ' + fittedstarname + ', see the output of: ' + relion_ctffindline)
+        labels = store_ctffind_results(config, fittedstarname, keys)
+        table = starfile.first_table(fittedstarname)
+        for row, image_name in enumerate(table.column('_rlnMicrographName')):
+            fitted[image_name] = [table.column(label)[row] for label in labels]
+        os.remove(fittedstarname)
+        # Cached entries with other columns than the fitted images are fitted as well
+        missing = [image_name for image_name in image_names if image_name not in fitted and set(entries[image_name]['labels']) != set(labels)]
+        if len(missing) > 0:
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + str(len(missing)) + ' cached CTFFIND results have other columns than the new ones and are fitted again' + '\n')
+
+    outputstarfile = starfile.StarWriter(outputstar, separator=CTFFIND_SEPARATOR)
+    outputstarfile.begin_block('', labels)
+    for image_name in image_names:
+        if image_name in fitted:
+            outputstarfile.write_row(fitted[image_name])
+        else:
+            outputstarfile.write_row(cached_ctffind_row(config, keys[image_name], entries[image_name], image_name, labels))
+    outputstarfile.close()
+    return relion_ctffindline
+#
+def process_tomogram(config, mic):
+    # Runs all steps for one tomogram (mic as listed in the tomogram STAR file, relative to the project folder).
+    # The lines for the master files are returned instead of written, so that tomograms can be processed in parallel
+    # and still be written out in the original order. Returns a dict with the tomogram name, its tilt angles,
+    # defoci and particles, the 3D CTF volumes of the particles and the lines for the master files.
+    # All inputs and outputs are relative to the project folder, whatever the current folder of the caller is.
+    config = config.normalized()
+    startdir = os.getcwd()
+    os.chdir(project_dir(config))
+    try:
+        return _process_tomogram_in_project(config, mic)
+    finally:
+        os.chdir(startdir)
+#
+
+#
+def _process_tomogram_in_project(config, mic):
+    # process_tomogram, in the project folder
+    ScriptDir = project_dir(config)
+    MetadataIndexName = ScriptDir + 'tomogram_metadata.sqlite'
+    subtomostarlines = []
+    ctfreconstlines = []
+    reliontextlines = []
+    timer = sta_timing.StageTimer()
+    timer.begin('tilt_angles')
+
+    # Parsing the micrograph names
+    micsplit = os.path.splitext(mic)
+    microot = micsplit[0]
+    dirsplit = microot.split('/')
+    MicDirName = ""
+    for dircount in range(0,(len(dirsplit)-1)):
+        MicDirName = MicDirName + dirsplit[dircount]
+        MicDirName = MicDirName + '/'
+    MicRootName = dirsplit[len(dirsplit)-1]
+
+    print('Processing ' + MicRootName + ' found in ' + MicDirName)
+
+    # Parsing the metadata files
+    micname = MicDirName + MicRootName + '.mrc'
+    stackname = MicDirName + MicRootName + '.mrcs'
+    ordername = MicDirName + MicRootName + '.order'
+    coordsname = MicDirName + MicRootName + '.coords'
+    alitiltname = MicDirName + MicRootName + '.tlt'
+    print(micname, stackname, ordername, coordsname, alitiltname)
+
+    #
+    #sys.exit()
+
+    ##### Running CTFFIND on all images of the tilt series  ##########
+
+    CtffindDirName = 'ctffind/'
+    OutputDir = ScriptDir + MicDirName + CtffindDirName
+    newstackroot = MicDirName + CtffindDirName + MicRootName +  '_image'
+    #print OutputDir
+
+    ## Making a new directory to output the results of CTFFIND
+    ensure_dir(OutputDir)
+
+    # Record of the inputs of the last run, for IncrementalUpdate
+    manifestname = OutputDir + MicRootName + '_manifest.json'
+    manifest = {}
+    if config.IncrementalUpdate == True:
+        manifest = sta_manifest.read_manifest(manifestname)
+
+    ## Extracting the tilt information with the IMOD command extracttilts
+    if not os.path.exists(alitiltname):
+        extracttile_scratchname = OutputDir + MicRootName + '_extracttilt_output.txt'
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Using IMOD extracttilts to get tilt angles' + '\n')
+        exttltline = 'extracttilts -InputFile ' + stackname + ' -tilts -OutputFile ' + OutputDir + MicRootName + '_tiltangles.txt > ' + extracttile_scratchname +  '\n'
+        print(exttltline)
+        timer.system(exttltline)
+        os.remove(extracttile_scratchname)
+    if os.path.exists(alitiltname):
+        outtiltnametemp = OutputDir + MicRootName + '_tiltangles.txt'
+        shutil.copyfile(alitiltname,outtiltnametemp)
+
+    #sys.exit()
+
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Tilt values extracted ' + '\n')
+
+    ##
+    tiltanglesfilename = OutputDir + MicRootName + '_tiltangles.txt'
+    tiltfile = open(tiltanglesfilename, 'r')
+    ctffindstarname = OutputDir + MicRootName + '_images.star'
+    ctffindstarfile = starfile.StarWriter(ctffindstarname)
+    ctffindstarfile.begin_block('', ['_rlnMicrographName'])
+
+    exttilts=[]
+    extracted_image_names=[]
+
+    # The tilt angles, tilt order, coordinates and tomogram header are read into the metadata index if they changed
+    if config.UseMetadataIndex == True:
+        metadata = open_metadata(MetadataIndexName)
+        ingested = sta_index.ingest_tomogram(metadata, micname, tiltanglesfilename, ordername, coordsname)
+        if len(ingested) > 0:
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Added ' + ', '.join(ingested) + ' of ' + MicRootName + ' to the metadata index ' + MetadataIndexName + '\n')
+        exttilts = sta_index.tilt_angles(metadata, micname)
+    else:
+        for line in tiltfile:
+            pair = line.split()
+            # Tilt of the stage for the current image
+            exttilts.append(float(pair[0]))
+
+    for i in range(0, len(exttilts)):
+        tilt = exttilts[i]
+        extracted_image_name = newstackroot + str(tilt) + '_' + str(i) + '.mrc'
+        extracted_image_names.append(extracted_image_name)
+        ctffindstarfile.write_row([extracted_image_name])
+
+    ctffindstarfile.close()
+    timer.count('tilts', len(exttilts))
+    timer.wrote(ctffindstarname)
+
+    # In incremental mode, extraction and CTFFIND are skipped if the stack, the tilt angles and the CTFFIND parameters did not change
+    outputstarname = OutputDir + MicRootName + '_ctffind.star'
+    extractionkey = [sta_manifest.file_signature(stackname), sta_manifest.file_sha1(tiltanglesfilename)]
+
+    # Tilt images can be Fourier cropped to the resolution CTFFIND fits, CTFFIND is then given the larger pixel size and
+    # a box smaller by the crop factor, so it fits the same spectrum (same frequency spacing and range)
+    ctffinddpixsize = config.DPixSize
+    ctffindboxsize = config.BoxSize
+    if config.CtffindFourierCrop == True:
+        stackheader = mrcio.read_header(stackname)
+        imageshape = (stackheader['ny'], stackheader['nx'])
+        cropshape = ctf_crop.crop_shape(imageshape, config.DPixSize * 10000.0 / config.Magnification, config.HighResLimit, config.CtffindCropSize)
+        ctffinddpixsize = ctf_crop.cropped_pixel_size(imageshape, cropshape, config.DPixSize)
+        ctffindboxsize = ctf_crop.cropped_box_size(config.BoxSize, imageshape, cropshape)
+        extractionkey = extractionkey + [list(cropshape)]
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Tilt images are Fourier cropped from ' + str(imageshape[1]) + ' x ' + str(imageshape[0]) + ' to ' + str(cropshape[1]) + ' x ' + str(cropshape[0]) + ' px for CTFFIND, DStep ' + str(ctffinddpixsize) + ', Box ' + str(ctffindboxsize) + '\n')
+    ctffindkey = extractionkey + [sta_manifest.text_sha1(relion_ctffind_command(config, ctffindstarname, outputstarname, ctffinddpixsize, ctffindboxsize))]
+    SkipExtraction = (config.IncrementalUpdate == True and manifest.get('extraction') == extractionkey and all([os.path.exists(name) for name in extracted_image_names]))
+    SkipCtffind = (config.IncrementalUpdate == True and manifest.get('ctffind') == ctffindkey and os.path.exists(outputstarname))
+    if SkipExtraction == True:
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Stack and tilt angles are unchanged, using the tilt series images extracted before ' + '\n')
+
+    # With more than one CTFFIND worker, every tilt image is queued for fitting as soon as it has been extracted
+    StreamCtffind = (config.SkipCTFCorrection == False and config.ReRunCtffindSkip == False and SkipCtffind == False and config.CtffindWorkers > 1)
+    if StreamCtffind == True:
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Fitting tilt images with ' + str(config.CtffindWorkers) + ' CTFFIND workers while extracting ' + '\n')
+        ctffindpool = ThreadPool(config.CtffindWorkers)
+        ctffindjobs = []
+
+    timer.begin('extraction')
+    # extracting each image using the IMOD command newstack
+    if config.ExtractTiltsInProcess == False and SkipExtraction == False:
+        for i in range(0, len(extracted_image_names)):
+            extracted_image_name = extracted_image_names[i]
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Extracting tilt series image ' + '\n')
+            newstack_scratchname = OutputDir + MicRootName + '_temp_newstack_out.txt'
+            newstackline = 'newstack -secs ' + str(i) + ' ' + stackname + ' ' +  extracted_image_name + ' > ' + newstack_scratchname +'\n'
+            print(newstackline)
+            timer.system(newstackline)
+            os.remove(newstack_scratchname)
+            if config.CtffindFourierCrop == True:
+                ctf_crop.crop_file(extracted_image_name, cropshape, ctffinddpixsize * 10000.0 / config.Magnification)
+            if StreamCtffind == True:
+                ctffindjobs.append(ctffindpool.apply_async(run_ctffind_image, (config, extracted_image_name, ctffinddpixsize, ctffindboxsize)))
+
+    # extracting all images in one pass over the memory-mapped stack
+    if config.ExtractTiltsInProcess == True and SkipExtraction == False:
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Extracting ' + str(len(extracted_image_names)) + ' tilt series images from ' + stackname + '\n')
+        if config.CtffindFourierCrop == True:
+            extracted = ctf_crop.iter_crop_sections(stackname, extracted_image_names, cropshape, ctffinddpixsize * 10000.0 / config.Magnification)
+        else:
+            extracted = mrcio.iter_write_sections(stackname, extracted_image_names)
+        for extracted_image_name in extracted:
+            timer.wrote(extracted_image_name)
+            if StreamCtffind == True:
+                ctffindjobs.append(ctffindpool.apply_async(run_ctffind_image, (config, extracted_image_name, ctffinddpixsize, ctffindboxsize)))
+
+    if SkipExtraction == True and StreamCtffind == True:
+        for extracted_image_name in extracted_image_names:
+            ctffindjobs.append(ctffindpool.apply_async(run_ctffind_image, (config, extracted_image_name, ctffinddpixsize, ctffindboxsize)))
+
+    timer.begin('ctffind')
+    # running CTFFIND using the RELION command relion_run_ctffind
+    # RELION 1.4
+    if config.SkipCTFCorrection == False:
+        outputstarname =  OutputDir + MicRootName +  '_ctffind.star'
+        outputstarname_read = outputstarname
+
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Running relion_run_ctffind ' + '\n')
+
+        # Waiting for the fits of the single tilt images and merging them into one file
+        if StreamCtffind == True:
+            ctffindpool.close()
+            ctffindpool.join()
+            results = [job.get() for job in ctffindjobs]
+            # Cached results with other columns than the fitted images (e.g. written by another RELION version) are fitted again,
+            # if all images were cached the columns of the first one are taken until an image has been fitted
+            while len(results) > 0:
+                fittedresults = [imageoutputstarname for relion_ctffindline, imageoutputstarname in results if relion_ctffindline is not None] + [results[0][1]]
+                labels = set(starfile.first_table(fittedresults[0]).labels)
+                stale = [j for j in range(0, len(results)) if results[j][0] is None and set(starfile.first_table(results[j][1]).labels) != labels]
+                if len(stale) == 0:
+                    break
+                print(':: RELION sub-tomogram averaging :: ' + '\n' + str(len(stale)) + ' cached CTFFIND results have other columns than the new ones and are fitted again' + '\n')
+                for j in stale:
+                    results[j] = run_ctffind_image(config, extracted_image_names[j], ctffinddpixsize, ctffindboxsize, False)
+            imageoutputstarnames = []
+            for relion_ctffindline, imageoutputstarname in results:
+                if relion_ctffindline is not None:
+                    timer.count('subprocesses')
+                    reliontextlines.append(relion_ctffindline + '\n')
+                imageoutputstarnames.append(imageoutputstarname)
+            merge_relion_stars(imageoutputstarnames, outputstarname)
+            timer.wrote(outputstarname)
+            for imageoutputstarname in imageoutputstarnames:
+                os.remove(imageoutputstarname)
+
+        if StreamCtffind == False:
+            relion_ctffindline = relion_ctffind_command(config, ctffindstarname, outputstarname, ctffinddpixsize, ctffindboxsize)
+            if config.OnlyDoUnfinishedCTFs == True:
+                print(relion_ctffindline)
+            if SkipCtffind == True:
+                print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Tilt series images and CTFFIND parameters are unchanged, using the CTFFIND results from before ' + '\n')
+            if config.ReRunCtffindSkip == False and SkipCtffind == False:
+                # Tilt images found in the CTFFIND cache are not fitted again
+                if config.CtffindCacheDir != '':
+                    relion_ctffindline = run_ctffind_cached(config, extracted_image_names, ctffindstarname, outputstarname, ctffinddpixsize, ctffindboxsize, timer)
+                else:
+                    timer.system(relion_ctffindline)
+                timer.wrote(outputstarname)
+                #
+                if relion_ctffindline is not None:
+                    reliontextlines.append(relion_ctffindline + '\n')
+
+        # The least recently used results are removed when the cache gets too large
+        if config.CtffindCacheDir != '':
+            ctffind_cache.evict(config.CtffindCacheDir, config.CtffindCacheSize * 1e6)
+
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'CTF Parameters of all tilt series images were estimated using RELION\'s  relion_run_ctffind ' + '\n')
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Parameters have been saved in ' + outputstarname_read + '\n')
+
+    if config.SkipCTFCorrection == True:
+        outputstarname_read =  OutputDir + MicRootName +  '_ctffind.star'
+        ctffindoutstarfile = starfile.StarWriter(outputstarname_read)
+        ctffindoutstarfile.begin_block('', ['_rlnMicrographName', '_rlnDefocusU', '_rlnDefocusV'])
+
+        micnames = starfile.read_star_column(ctffindstarname, '_rlnMicrographName')
+            #print micnames
+        for kk in range(0,len(micnames)):
+            ctffindoutstarfile.write_row([micnames[kk], '0.000', '0.000'])
+
+        ctffindoutstarfile.close()
+        timer.wrote(outputstarname_read)
+
+    tiltfile.close()
+
+    #sys.exit()
+
+    timer.begin('ctf_model')
+    ##### Making .star files for each 3D CTF Volume #################
+    RelionPartName = 'Particles/'
+    RelionPartDir = ScriptDir + RelionPartName
+    RelionRecDir = RelionPartDir + MicDirName
+    RelionRecFileName =  RelionPartName + MicDirName + MicRootName + '_rec_CTF_volumes.sh'
+    RelionRecFileName_for_script =  MicRootName + '_rec_CTF_volumes.sh'
+
+    ## Making a new directory to output the results of CTFFIND
+    ensure_dir(RelionRecDir)
+
+    relionfile = open(RelionRecFileName, 'w')
+
+    # Getting the tilt order
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Reading tilt series order file for dose dependent B-Factor weighting ' + '\n')
+    tiltorder=[]
+    accumulated_dose=[]
+
+    if config.UseMetadataIndex == True:
+        tiltorder, accumulated_dose = sta_index.tilt_order(metadata, micname)
+    else:
+        tiltorderfile = open(ordername, 'r')
+        for line in tiltorderfile:
+            emptycheck = line.isspace()
+            if(emptycheck):
+                #print 'empty line found'
+                continue
+            pair=line.split()
+            tiltorder.append(float(pair[0]))
+            accumulated_dose.append(float(pair[1]))
+
+        #print tiltorder, accumulated_dose
+        tiltorderfile.close()
+    #
+
+    # Reading the output of CTFFIND
+    if config.UseMetadataIndex == True:
+        sta_index.ingest_defoci(metadata, micname, outputstarname_read)
+        avgdefoci = sta_index.tilt_defoci(metadata, micname)
+    else:
+        ctffindtable = starfile.first_table(outputstarname_read)
+        avgdefoci = ctffindtable.column('_rlnDefocusU').tolist()
+    final_avgdefoci=[]
+
+    print('Using actual tilt images for CTF estimation' + '\n')
+    final_avgdefoci = avgdefoci
+    #print 'DEBUG', final_avgdefoci, exttilts
+
+    # If Higher tilts do not give reliable CTF estimations, then the lower tilts are used for CTF estimation
+    if config.UseOnlyLowerTiltDefoci == True:
+        print('Using only lower tilts for CTF correction with the upper limit of ' + str(config.UseOnlyLowerTiltDefociLimit) + '\n')
+
+        ct = 0.0
+        td = 0.0
+
+        for ii in range(0, len(final_avgdefoci)):
+            #print exttilts[ii], final_avgdefoci[ii]
+            if abs(exttilts[ii]) < config.UseOnlyLowerTiltDefociLimit:
+                td = td + float(final_avgdefoci[ii])
+                ct=ct+1
+                avg_lower_tilt_defocus = td/ct
+
+        print('Average defocus from the lower tilt images below ' + str(config.UseOnlyLowerTiltDefociLimit) + ' is ' + str(avg_lower_tilt_defocus) + '\n')
+
+        for ii in range(0, len(final_avgdefoci)):
+            #print exttilts[ii], final_avgdefoci[ii]
+            if abs(exttilts[ii]) > config.UseOnlyLowerTiltDefociLimit:
+                final_avgdefoci[ii] = avg_lower_tilt_defocus
+                #print 'DEBUG2', final_avgdefoci
+            print(len(final_avgdefoci))
+            #print exttilts
+            #print avgdefoci
+            #print len(exttilts), len(tiltorder)
+        #sys.exit()
+
+        if len(tiltorder) != len(exttilts):
+            raise ValueError('The number of images in the aligned stack file and the tilt order file of ' + MicRootName + ' are different.')
+
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + 'The number of images in the CTFFIND output file and the tilt order file are the same. Continuing.')
+
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Writing out .star files to make 3D CTF volumes ' + '\n')
+
+    # Size and pixel size of this tomogram, from its header if asked for and found
+    tomosize = config.TomoSize
+    pixelsize = config.PixelSize
+    headersize = None
+    if config.TomoSizeFromHeader == True and config.UseMetadataIndex == True:
+        headersize, headerpixelsize = sta_index.tomogram_geometry(metadata, micname)
+
+    if headersize is not None:
+        tomosize = headersize
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Using Tomogram Size (in px) from the header of ' + micname + '\n')
+        print(tomosize)
+        # Headers without a pixel size (cell dimensions of 0) keep the hardcoded one
+        if headerpixelsize is not None and headerpixelsize > 0:
+            pixelsize = float(headerpixelsize)
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Using Pixel Size (in A) from the header of ' + micname + '\n')
+        else:
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + 'No Pixel Size in the header of ' + micname + ', using Hardcoded Pixel Size (in A)' + '\n')
+        print(pixelsize)
+    else:
+        # PixelSize calculation
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Using Hardcoded Pixel Size (in A)' + '\n')
+        print(config.PixelSize)
+
+        # Using hardcoded header Size for Tomogram Size
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Using Hardcoded Tomogram Size (in px) ' + '\n')
+        print(config.TomoSize)
+
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Writing out .star files to make 3D CTF volumes ' + '\n')
+
+    # Everything that only depends on the tilt is computed once for the tomogram,
+    # the defocus of all particles in all tilt images is computed in one go.
+    if config.UseMetadataIndex == True:
+        coords = sta_index.particle_coords(metadata, micname)
+    else:
+        coords = sta_ctf.load_coords(coordsname)
+    coordlist = coords.tolist()
+    timer.count('particles', len(coordlist))
+    tiltdoses = sta_ctf.tilt_doses(exttilts, tiltorder, accumulated_dose)
+    ctfsuffixes = sta_ctf.ctf_line_suffixes(exttilts, tiltdoses, config.Voltage, config.Cs, config.AmpContrast, config.Bfactor)
+
+    if config.SkipCTFCorrection == False:
+        ptcldefoci = sta_ctf.particle_defoci(coords, exttilts, final_avgdefoci, tomosize, pixelsize)
+
+        # Particles with the same defocus profile (within DefocusQuantization) share one 3D CTF volume
+        if config.DefocusQuantization > 0 and len(coordlist) > 0:
+            ctfdefoci, ctfindex = sta_ctf.quantize_defoci(ptcldefoci, config.DefocusQuantization)
+            ctfnames = [MicRootName + '_ctfgroup' + str("%06d" % (ctfnum+1)) for ctfnum in range(0, len(ctfdefoci))]
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + str(len(coordlist)) + ' particles share ' + str(len(ctfnames)) + ' unique 3D CTF volumes with a defocus tolerance of ' + str(config.DefocusQuantization) + ' A' + '\n')
+        else:
+            ctfdefoci = ptcldefoci
+            ctfindex = range(0, len(coordlist))
+            ctfnames = [MicRootName + '_ctf' + str("%06d" % subtomonum) for subtomonum in range(1, len(coordlist)+1)]
+        ctfdefoci = ctfdefoci.tolist()
+
+    # Without CTF correction all particles share one 3D CTF model, the defocus should be 0.000
+    if config.SkipCTFCorrection == True:
+        ctfnames = []
+        ctfdefoci = []
+        ctfindex = [0] * len(coordlist)
+        if len(coordlist) > 0:
+            ctfnames = [MicRootName + '_ctf']
+            ctfdefoci = [[float(d) for d in final_avgdefoci]]
+
+    # Names the particles use for the 3D CTF volumes (_rlnCtfImage), volume N of the stack of the tomogram or one file per volume
+    ctfstackname = RelionPartName + MicDirName + MicRootName + '_ctf.mrcs'
+    ctfstackoptions = ''
+    if config.CtfVolumeStack == True:
+        ctfimagenames = [str(ctfnum+1) + '@' + ctfstackname for ctfnum in range(0, len(ctfnames))]
+        ctfstackoptions = ' --stack ' + ctfstackname + ' --stack-size ' + str(len(ctfnames))
+        # A stack from before is only kept for incremental updates with the same number of volumes
+        if os.path.exists(ctfstackname) and (config.IncrementalUpdate == False or ctf_stack.stack_shape(ctfstackname)[0] != len(ctfnames)):
+            os.remove(ctfstackname)
+        if os.path.exists(ctfstackname):
+            ctfstackwritten = ctf_stack.written_slots(ctfstackname)
+    else:
+        ctfimagenames = [RelionPartName + MicDirName + ctfname + '.mrc' for ctfname in ctfnames]
+
+    # Tilt tables of the 3D CTF volumes. In incremental mode only volumes whose tilt table changed or which
+    # were not reconstructed yet are written and scheduled.
+    ctftables = [sta_ctf.ctf_table(ctfdefoci[ctfnum], ctfsuffixes) for ctfnum in range(0, len(ctfnames))]
+    oldvolumehashes = manifest.get('volumes', {})
+    # The volumes also depend on the pixel size (--angpix of the reconstruction) and the CTF parameters, all are redone if one changed
+    volumesettings = [pixelsize, list(tomosize), config.Voltage, config.Cs, config.AmpContrast, config.Bfactor]
+    if manifest.get('volume_settings') != volumesettings:
+        oldvolumehashes = {}
+    volumehashes = {}
+    changedctfnums = []
+    for ctfnum in range(0, len(ctfnames)):
+        if config.IncrementalUpdate == True:
+            volumehashes[ctfnames[ctfnum]] = sta_manifest.text_sha1(ctftables[ctfnum])
+            if config.CtfVolumeStack == True:
+                volumedone = os.path.exists(ctfstackname) and ctfstackwritten[ctfnum]
+            else:
+                volumedone = os.path.exists(ctfimagenames[ctfnum])
+            if oldvolumehashes.get(ctfnames[ctfnum]) == volumehashes[ctfnames[ctfnum]] and volumedone:
+                continue
+        changedctfnums.append(ctfnum)
+    if config.IncrementalUpdate == True:
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + str(len(changedctfnums)) + ' of ' + str(len(ctfnames)) + ' 3D CTF volumes are new or changed' + '\n')
+
+    timer.begin('ctf_star_files')
+    # .star files of the 3D CTF volumes of this tomogram that need to be reconstructed, and the volumes each of them
+    # and each reconstruction command is for (to split the commands into shards). Commands for several volumes also
+    # get the command split into (start, one argument per volume, end), so the shards can each run it for their volumes.
+    ctfstarnames = []
+    ctfstarvolumes = []
+    ctfreconstvolumes = []
+    ctfreconstparts = []
+
+    if config.SkipCTFCorrection == False and config.CtfStarPerTomogram == True:
+        # One .star file for all particles of the tomogram, with one data block per 3D CTF volume
+        ctfstarname = RelionPartName + MicDirName + MicRootName + '_ctf.star'
+        if len(changedctfnums) > 0 or sorted(oldvolumehashes.keys()) != sorted(volumehashes.keys()) or not os.path.exists(ctfstarname):
+            ctfstarfile = starfile.StarWriter(ctfstarname)
+            for ctfnum in range(0, len(ctfnames)):
+                ctfstarfile.write_text(sta_ctf.ctf_star_block(ctfnames[ctfnum], ctftables[ctfnum]))
+            ctfstarfile.close()
+            timer.wrote(ctfstarname)
+
+        # The 3D CTF volumes of all particles of the tomogram are reconstructed by one call of reconstruct_ctfs.py,
+        # in incremental mode by a few calls for the data blocks that changed.
+        reconstructstart = 'python ' + CODE_DIR + 'reconstruct_ctfs.py ' + ctfstarname + ' $1 ' + str("%.2f" % pixelsize) + ctfstackoptions
+        if config.IncrementalUpdate == False:
+            ctfreconstlines.append(reconstructstart + '\n')
+            ctfreconstvolumes.append(range(0, len(ctfnames)))
+            ctfreconstparts.append((reconstructstart + ' --blocks ', list(ctfnames), '\n'))
+        if config.IncrementalUpdate == True:
+            for first in range(0, len(changedctfnums), 500):
+                ctfblocks = ' '.join([ctfnames[ctfnum] for ctfnum in changedctfnums[first:first+500]])
+                ctfreconstlines.append(reconstructstart + ' --blocks ' + ctfblocks + '\n')
+                ctfreconstvolumes.append(changedctfnums[first:first+500])
+                ctfreconstparts.append((reconstructstart + ' --blocks ', [ctfnames[ctfnum] for ctfnum in changedctfnums[first:first+500]], '\n'))
+        if len(changedctfnums) > 0:
+            ctfstarnames.append(ctfstarname)
+            ctfstarvolumes.append(range(0, len(ctfnames)))
+
+    if config.SkipCTFCorrection == True or config.CtfStarPerTomogram == False:
+        for ctfnum in changedctfnums:
+            outstarname = RelionPartName + MicDirName + ctfnames[ctfnum] + '.star'
+            outctfname = RelionPartName + MicDirName + ctfnames[ctfnum] + '.mrc'
+            sta_ctf.write_ctf_star(outstarname, ctftables[ctfnum])
+            timer.wrote(outstarname)
+            ctfstarnames.append(outstarname)
+            ctfstarvolumes.append([ctfnum])
+
+            # This is for parallilzation of the CTF reconstructions
+            reconstructline2 = 'relion_reconstruct --i ' + outstarname + ' --o ' + outctfname + ' --reconstruct_ctf ' + '$1' + ' --angpix ' + str("%.2f" % pixelsize) + '\n'
+            ctfreconstlines.append(reconstructline2)
+            ctfreconstvolumes.append([ctfnum])
+            ctfreconstparts.append(None)
+
+    # ctf_volume.py takes many .star files at once, the volumes of a tomogram are computed by a few calls
+    if config.CtfVolumeEngine == 'numpy':
+        ctfreconstlines = []
+        ctfreconstvolumes = []
+        ctfreconstparts = []
+        volumestart = 'python ' + CODE_DIR + 'ctf_volume.py --box $1 --angpix ' + str("%.2f" % pixelsize) + ctfstackoptions + ' '
+        if config.SkipCTFCorrection == False and config.CtfStarPerTomogram == True and config.IncrementalUpdate == True:
+            for first in range(0, len(changedctfnums), 500):
+                ctfblocks = ' '.join([ctfnames[ctfnum] for ctfnum in changedctfnums[first:first+500]])
+                ctfreconstlines.append(volumestart + ctfstarname + ' --blocks ' + ctfblocks + '\n')
+                ctfreconstvolumes.append(changedctfnums[first:first+500])
+                ctfreconstparts.append((volumestart + ctfstarname + ' --blocks ', [ctfnames[ctfnum] for ctfnum in changedctfnums[first:first+500]], '\n'))
+        else:
+            for first in range(0, len(ctfstarnames), 500):
+                reconstructline2 = volumestart + ' '.join(ctfstarnames[first:first+500]) + '\n'
+                ctfreconstlines.append(reconstructline2)
+                ctfreconstvolumes.append(sum(ctfstarvolumes[first:first+500], []))
+                # One .star file per volume, or the one of the tomogram with a data block per volume
+                if config.SkipCTFCorrection == False and config.CtfStarPerTomogram == True:
+                    ctfreconstparts.append((volumestart + ctfstarname + ' --blocks ', list(ctfnames), '\n'))
+                else:
+                    ctfreconstparts.append((volumestart, ctfstarnames[first:first+500], '\n'))
+
+    timer.begin('particle_star')
+    for subtomonum in range(1, len(coordlist)+1):
+        # Coordinates of the sub-tomogram in the tomogram
+        X, Y, Z = coordlist[subtomonum-1]
+
+        # 3D CTF volume of the particle
+        outctfname = ctfimagenames[ctfindex[subtomonum-1]]
+
+        # writing the .star file for refinement
+        currentsubtomoname = RelionPartName+ MicDirName +  MicRootName + '_' + config.RootName + str("%06d" % subtomonum) + '.mrc'
+        subtomostarline = micname + '\t' + str(X) + '\t' + str(Y) + '\t' + str(Z) + '\t' + currentsubtomoname + '\t' + outctfname + '\n'
+        subtomostarlines.append(subtomostarline)
+
+    relionfile.close()
+
+    #ctfreconstmasterfile.write('cd ' + RelionPartName + MicDirName + '\n')
+    #ctfreconstmasterfile.write( RelionRecFileName_for_script + ' $1''\n')
+    #ctfreconstmasterfile.write('cd ' + ScriptDir + '\n')
+
+    os.chmod(RelionRecFileName, stat.S_IRWXU)
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + '.star files to make 3D CTF volumes were written out in ' + RelionRecDir + '\n')
+    print(':: RELION sub-tomogram averaging :: ' + '\n' + 'shell script to reconstruct the 3D CTF volumes is ' + RelionRecFileName + '\n')
+
+    if config.IncrementalUpdate == True:
+        newmanifest = {}
+        newmanifest['extraction'] = extractionkey
+        if config.SkipCTFCorrection == False:
+            newmanifest['ctffind'] = ctffindkey
+        newmanifest['volume_settings'] = volumesettings
+        newmanifest['volumes'] = volumehashes
+        sta_manifest.write_manifest(manifestname, newmanifest)
+
+    ctfreconstvolumes = [[ctfimagenames[ctfnum] for ctfnum in ctfnums] for ctfnums in ctfreconstvolumes]
+
+    timer.end()
+    result = collections.OrderedDict()
+    result['tomogram'] = MicRootName
+    result['micname'] = micname
+    result['tilts'] = exttilts
+    result['defoci'] = [float(defocus) for defocus in final_avgdefoci]
+    result['tomo_size'] = list(tomosize)
+    result['pixel_size'] = pixelsize
+    result['particles'] = coordlist
+    result['ctf_images'] = [ctfimagenames[ctfindex[subtomonum]] for subtomonum in range(0, len(coordlist))]
+    result['subtomo_star_lines'] = subtomostarlines
+    result['reconstruct_lines'] = ctfreconstlines
+    result['reconstruct_volumes'] = ctfreconstvolumes
+    result['reconstruct_parts'] = ctfreconstparts
+    result['relion_command_lines'] = reliontextlines
+    result['stages'] = timer.stages
+    return result
+#
+
+
+#
+def run_tomogram(config, mic):
+    # process_tomogram, under cProfile with ProfileTomograms = True
+    if config.ProfileTomograms == True:
+        profilename = project_dir(config) + 'profile_' + os.path.basename(os.path.splitext(mic)[0]) + '.prof'
+        return sta_timing.profile_call(profilename, process_tomogram, config, mic)
+    return process_tomogram(config, mic)
+#
+
+#
+def _run_tomogram_in_pool(job):
+    # sys.exit() would silently kill a pool worker and leave the pool waiting, report it to the parent instead
+    config, mic = job
+    try:
+        return run_tomogram(config, mic)
+    except SystemExit:
+        raise RuntimeError('Processing of ' + mic + ' was stopped')
+#
+
+#
+def process_project(config):
+    # Runs all tomograms of the tomogram STAR file of a project and writes the particle .star file, do_all_reconstruct_ctfs.sh,
+    # relion_subtomo_commands.txt, the shards and the run report. Returns a dict with the names of these files, the results
+    # of all tomograms (see process_tomogram) and the time spent in each stage.
+    RunStartTime = time.time()
+    config = config.normalized()
+    ScriptDir = project_dir(config)
+
+    # All names in the tomogram STAR file and all outputs are relative to the project folder
+    startdir = os.getcwd()
+    os.chdir(ScriptDir)
+    try:
+        # Text file containing all RELION commands
+        reliontextfile = open('relion_subtomo_commands.txt', 'w')
+
+        ## Looping through the micrographs
+        print(ScriptDir)
+
+        micnames = starfile.read_star_column(config.TomogramStarFileName, '_rlnMicrographName').tolist()
+        print(micnames)
+
+        # Shell script to do 3D CTF model reconstruction
+        ctfreconstmastername = ScriptDir + 'do_all_reconstruct_ctfs.sh'
+        ctfreconstmasterfile = open(ctfreconstmastername, 'w')
+        os.chmod(ctfreconstmastername, stat.S_IRWXU)
+
+        # With several reconstruction workers the commands go into a job file that do_all_reconstruct_ctfs.sh hands to run_ctf_jobs.py
+        if config.ReconstructWorkers > 1:
+            ctfjobsname = ScriptDir + 'reconstruct_ctfs_jobs.sh'
+            ctfreconstmasterfile.write('python ' + CODE_DIR + 'run_ctf_jobs.py ' + ctfjobsname + ' $1 --workers ' + str(config.ReconstructWorkers) + ' --chunk ' + str(config.ReconstructChunk) + '\n')
+            ctfreconstmasterfile.close()
+            ctfreconstmasterfile = open(ctfjobsname, 'w')
+
+        #
+        # This is the master STAR file for refinement later on
+        subtomostarname = ScriptDir + 'particles_' + config.RootName + '.star'
+        subtomostarfile = starfile.StarWriter(subtomostarname)
+
+        # writing out the header of the list star file
+        subtomostarfile.begin_block('', sta_shards.PARTICLE_LABELS)
+        #
+
+        # Tomograms are independent of each other and can be processed in parallel.
+        # The results are collected in the order of the tomogram STAR file, so the output does not depend on NumberOfWorkers.
+        if config.NumberOfWorkers > 1:
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Processing ' + str(len(micnames)) + ' tomograms with ' + str(config.NumberOfWorkers) + ' workers' + '\n')
+            # A failing tomogram stops the run: the other workers are terminated instead of being waited for
+            pool = multiprocessing.Pool(config.NumberOfWorkers)
+            try:
+                results = pool.map_async(_run_tomogram_in_pool, [(config, mic) for mic in micnames], 1).get(POOL_TIMEOUT)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [run_tomogram(config, mic) for mic in micnames]
+
+        tomogramstages = collections.OrderedDict()
+        allsubtomostarlines = []
+        allctfreconstlines = []
+        allctfreconstvolumes = []
+        allctfreconstparts = []
+        particlecounts = []
+        for mic, result in zip(micnames, results):
+            subtomostarfile.write_text(''.join(result['subtomo_star_lines']))
+            ctfreconstmasterfile.writelines(result['reconstruct_lines'])
+            reliontextfile.writelines(result['relion_command_lines'])
+            tomogramstages[mic] = result['stages']
+            allsubtomostarlines.extend(result['subtomo_star_lines'])
+            allctfreconstlines.extend(result['reconstruct_lines'])
+            allctfreconstvolumes.extend(result['reconstruct_volumes'])
+            allctfreconstparts.extend(result['reconstruct_parts'])
+            particlecounts.append(len(result['subtomo_star_lines']))
+
+        # Particle .star files and reconstruction scripts of the shards
+        manifests = []
+        if config.NumberOfShards > 1:
+            if config.ShardBy == 'tomogram':
+                particleshards = sta_shards.shards_by_tomogram(particlecounts, config.NumberOfShards)
+            else:
+                particleshards = sta_shards.shards_by_particles(particlecounts, config.NumberOfShards)
+            shardsdir = ScriptDir + 'Shards/'
+            manifests = sta_shards.write_shards(shardsdir, allsubtomostarlines, particleshards, allctfreconstlines, allctfreconstvolumes, allctfreconstparts, config.NumberOfShards, config.ShardBy, config.RootName)
+            print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Particles were split into ' + str(config.NumberOfShards) + ' shards in ' + shardsdir + ' with ' + ', '.join([str(manifest['particles']) for manifest in manifests]) + ' particles' + '\n')
+
+        subtomostarfile.close()
+        ctfreconstmasterfile.close()
+        reliontextfile.close()
+    finally:
+        os.chdir(startdir)
+
+    # Time spent in each stage, summed over all tomograms
+    runstages = sta_timing.merge_stages(tomogramstages.values())
+    reportname = None
+    if config.WriteRunReport == True:
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + 'Time spent in each stage, summed over all tomograms' + '\n')
+        for line in sta_timing.format_stages(runstages):
+            print(line)
+        runsettings = {'NumberOfWorkers': config.NumberOfWorkers, 'CtffindWorkers': config.CtffindWorkers, 'ExtractTiltsInProcess': config.ExtractTiltsInProcess,
+                       'CtfStarPerTomogram': config.CtfStarPerTomogram, 'CtfVolumeEngine': config.CtfVolumeEngine, 'IncrementalUpdate': config.IncrementalUpdate,
+                       'DefocusQuantization': config.DefocusQuantization, 'tomograms': len(micnames)}
+        reportname = ScriptDir + 'run_report.json'
+        sta_timing.write_report(reportname, runstages, tomogramstages, time.time() - RunStartTime, runsettings)
+        print('Run report was written in ' + reportname)
+
+    project = collections.OrderedDict()
+    project['project_dir'] = ScriptDir
+    project['particle_star'] = subtomostarname
+    project['reconstruct_script'] = ctfreconstmastername
+    project['relion_commands'] = ScriptDir + 'relion_subtomo_commands.txt'
+    project['run_report'] = reportname
+    project['shards'] = manifests
+    project['stages'] = runstages
+    project['tomograms'] = results
+    return project
+#
+
+#
+def process_projects(config, projectdirs):
+    # Runs several projects one after the other with the same settings, returns the result of each project
+    return [process_project(config.copy(ProjectDir=projectdir)) for projectdir in projectdirs]
+#
+
+#
+def parse_setting(text):
+    # 'Name=Value' -> (Name, Value), the value is read as JSON if possible (numbers, true/false, lists) and kept as text otherwise
+    if '=' not in text:
+        raise ValueError('Settings are given as Name=Value, not ' + text)
+    name, value = text.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return name.strip(), value
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Setup for RELION sub-tomogram averaging of one or more projects (see relion_STA_updated.py)')
+    parser.add_argument('projects', nargs='+', help='project folders with the tomogram STAR file')
+    parser.add_argument('--config', help='JSON file with settings ({"PixelSize": 1.755, ...}), missing settings have their default')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='setting, overrides --config (can be given several times)')
+    args = parser.parse_args(argv)
+
+    settings = {}
+    if args.config is not None:
+        configfile = open(args.config, 'r')
+        settings.update(json.load(configfile))
+        configfile.close()
+    settings.update(dict(parse_setting(text) for text in args.set))
+    try:
+        config = StaConfig(**settings)
+        results = process_projects(config, args.projects)
+    except ValueError as error:
+        print(':: RELION sub-tomogram averaging :: ' + '\n' + str(error) + ' Exiting')
+        return 1
+    for project in results:
+        print(project['project_dir'] + ': ' + str(len(project['tomograms'])) + ' tomograms, particles in ' + project['particle_star'])
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# Sharded output for relion_STA_updated.py (NumberOfShards > 1).
+# The particles are split into shards that can be refined and reconstructed on different nodes. Every shard
+# gets its own folder Shards/shard_NNN/ with a particle .star file, a do_all_reconstruct_ctfs.sh with the
+# commands for the 3D CTF volumes of its particles, and a manifest.json that records which rows of the
+# global particles .star file the shard holds.
+# Shards are balanced by particle count: ShardBy = 'particles' splits the particle list into consecutive
+# parts of (almost) equal size, ShardBy = 'tomogram' keeps all particles of a tomogram in one shard.
+# A reconstruction command that covers the volumes of several particles (e.g. one reconstruct_ctfs.py call per
+# tomogram) is split: every shard runs it for the volumes of its own particles only (the data blocks or .star
+# files of the other volumes are left out). If all its volumes belong to one shard it is kept as it is.
+#
+# Merging the particle .star files of all shards back into one file, in the original order:
+#   sta_shards.py merge Shards particles_subtomo.star
+
+import os, sys, json, stat, argparse
+
+import starfile
+
+PARTICLE_LABELS = ['_rlnMicrographName', '_rlnCoordinateX', '_rlnCoordinateY', '_rlnCoordinateZ', '_rlnImageName', '_rlnCtfImage']
+
+
+#
+def shards_by_particles(counts, nshards):
+    # Shard of every particle, consecutive parts of equal size. counts is the number of particles of each tomogram.
+    total = sum(counts)
+    return [row * nshards // max(1, total) for row in range(0, total)]
+#
+
+#
+def shards_by_tomogram(counts, nshards):
+    # Shard of every particle, each tomogram goes to the shard with the fewest particles so far (largest tomograms first)
+    load = [0] * nshards
+    tomoshards = [0] * len(counts)
+    for tomonum in sorted(range(0, len(counts)), key=lambda tomonum: -counts[tomonum]):
+        shard = load.index(min(load))
+        tomoshards[tomonum] = shard
+        load[shard] = load[shard] + counts[tomonum]
+    particleshards = []
+    for tomonum in range(0, len(counts)):
+        particleshards.extend([tomoshards[tomonum]] * counts[tomonum])
+    return particleshards
+#
+
+#
+def row_ranges(rows):
+    # Sorted row numbers as [first, last+1] ranges, to keep the manifest small
+    ranges = []
+    for row in rows:
+        if len(ranges) > 0 and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return ranges
+#
+
+#
+def shard_dir(shardsdir, shard):
+    return os.path.join(shardsdir, 'shard_' + str("%03d" % (shard+1)))
+#
+
+#
+def shard_commands(commands, commandvolumes, commandparts, volumeshards, nshards):
+    # Reconstruction commands of every shard. A command for several volumes is split with its commandparts entry
+    # (start, one argument per volume, end): each shard gets start + the arguments of its volumes + end.
+    # Volumes no particle uses go with the first shard of the command.
+    shardcommands = [[] for shard in range(0, nshards)]
+    for j in range(0, len(commands)):
+        shards = [volumeshards.get(volume) for volume in commandvolumes[j]]
+        used = [shard for shard in shards if shard is not None]
+        if len(used) == 0:
+            shardcommands[0].append(commands[j])
+            continue
+        shards = [used[0] if shard is None else shard for shard in shards]
+        if commandparts[j] is None or len(set(shards)) == 1:
+            shardcommands[shards[0]].append(commands[j])
+            continue
+        start, arguments, end = commandparts[j]
+        if len(arguments) != len(shards):
+            raise ValueError('Command has ' + str(len(arguments)) + ' arguments for ' + str(len(shards)) + ' volumes: ' + commands[j])
+        for shard in sorted(set(shards)):
+            shardcommands[shard].append(start + ' '.join([arguments[k] for k in range(0, len(shards)) if shards[k] == shard]) + end)
+    return shardcommands
+#
+
+#
+def write_shards(shardsdir, particlelines, particleshards, commands, commandvolumes, commandparts, nshards, shardby, rootname):
+    # Writes the particle .star file, reconstruction script and manifest of every shard.
+    # particlelines are the data lines of the global particle .star file, commands the lines of do_all_reconstruct_ctfs.sh,
+    # commandvolumes the _rlnCtfImage volumes each command writes and commandparts how to split it (see shard_commands).
+    volumeshards = {}
+    for line, shard in zip(particlelines, particleshards):
+        volume = line.split()[-1]
+        if volume not in volumeshards:
+            volumeshards[volume] = shard
+    shardcommands = shard_commands(commands, commandvolumes, commandparts, volumeshards, nshards)
+
+    manifests = []
+    for shard in range(0, nshards):
+        outdir = shard_dir(shardsdir, shard)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        rows = [row for row in range(0, len(particlelines)) if particleshards[row] == shard]
+
+        particlestarname = os.path.join(outdir, 'particles_' + rootname + '.star')
+        writer = starfile.StarWriter(particlestarname)
+        writer.begin_block('', PARTICLE_LABELS)
+        writer.write_text(''.join([particlelines[row] for row in rows]))
+        writer.close()
+
+        scriptname = os.path.join(outdir, 'do_all_reconstruct_ctfs.sh')
+        scriptfile = open(scriptname, 'w')
+        scriptfile.writelines(shardcommands[shard])
+        scriptfile.close()
+        os.chmod(scriptname, stat.S_IRWXU)
+
+        manifest = {}
+        manifest['shard'] = shard + 1
+        manifest['shards'] = nshards
+        manifest['shard_by'] = shardby
+        manifest['particles'] = len(rows)
+        manifest['total_particles'] = len(particlelines)
+        manifest['rows'] = row_ranges(rows)
+        manifest['tomograms'] = sorted(set([particlelines[row].split()[0] for row in rows]))
+        manifest['commands'] = len(shardcommands[shard])
+        manifest['volumes'] = sorted(set([particlelines[row].split()[-1] for row in rows]))
+        manifest['particle_star'] = os.path.basename(particlestarname)
+        manifest['reconstruct_script'] = os.path.basename(scriptname)
+        manifestfile = open(os.path.join(outdir, 'manifest.json'), 'w')
+        json.dump(manifest, manifestfile, indent=1, sort_keys=True)
+        manifestfile.close()
+        manifests.append(manifest)
+    return manifests
+#
+
+#
+def merge_shards(shardsdir, outname):
+    # Rebuilds the global particle .star file from the shards in shardsdir, returns the number of particles
+    shardnames = sorted([name for name in os.listdir(shardsdir) if os.path.exists(os.path.join(shardsdir, name, 'manifest.json'))])
+    if len(shardnames) == 0:
+        raise IOError('No shards found in ' + shardsdir)
+
+    lines = None
+    labels = None
+    for shardname in shardnames:
+        manifestfile = open(os.path.join(shardsdir, shardname, 'manifest.json'), 'r')
+        manifest = json.load(manifestfile)
+        manifestfile.close()
+        if lines is None:
+            lines = [None] * manifest['total_particles']
+        table = starfile.first_table(os.path.join(shardsdir, shardname, manifest['particle_star']))
+        labels = table.labels
+        rows = []
+        for first, last in manifest['rows']:
+            rows.extend(range(first, last))
+        if len(rows) != len(table):
+            raise ValueError(shardname + ' has ' + str(len(table)) + ' particles but its manifest lists ' + str(len(rows)))
+        for row, line in zip(rows, table.lines()):
+            lines[row] = line
+
+    missing = len([line for line in lines if line is None])
+    if missing > 0:
+        raise ValueError(str(missing) + ' particles are missing, not all shards are in ' + shardsdir)
+    writer = starfile.StarWriter(outname)
+    writer.begin_block('', labels)
+    writer.write_text(''.join(lines))
+    writer.close()
+    return len(lines)
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge the particle .star files of shards written by relion_STA_updated.py')
+    subparsers = parser.add_subparsers(dest='command')
+    mergeparser = subparsers.add_parser('merge', help='rebuild the global particle .star file')
+    mergeparser.add_argument('shardsdir', help='folder with the shard_NNN folders')
+    mergeparser.add_argument('output', help='merged particle .star file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'merge':
+        nparticles = merge_shards(args.shardsdir, args.output)
+        print('Merged ' + str(nparticles) + ' particles into ' + args.output)
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# Stage timing for relion_STA_updated.py (WriteRunReport = True).
+# The script switches from one stage to the next with begin(), every stage records its wall time, CPU time
+# (including finished child processes like CTFFIND), the number of external commands, the files and bytes
+# written and the particles and tilt images it handled.
+# Every tomogram has its own StageTimer, so tomograms processed by pool workers report back to the parent,
+# which sums them up and writes run_report.json.
+# Note that with CtffindWorkers > 1 the CPU time of a stage includes the CTFFIND threads running at the same time.
+
+import os, time, json, collections, cProfile
+
+# Counters of every stage, all summed when stages or tomograms are merged
+STAGE_FIELDS = ['wall', 'cpu', 'calls', 'subprocesses', 'files', 'bytes', 'particles', 'tilts']
+
+
+#
+def cpu_time():
+    # User and system time of this process and of its finished child processes
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+#
+
+#
+def new_stage():
+    return collections.OrderedDict((field, 0) for field in STAGE_FIELDS)
+#
+
+#
+class StageTimer(object):
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.current = None
+        self.start_wall = 0.0
+        self.start_cpu = 0.0
+
+    def begin(self, name):
+        # Ends the running stage and starts the next one, stages that are entered again keep adding up
+        self.end()
+        if name not in self.stages:
+            self.stages[name] = new_stage()
+        self.current = name
+        self.stages[name]['calls'] += 1
+        self.start_wall = time.time()
+        self.start_cpu = cpu_time()
+
+    def end(self):
+        if self.current is None:
+            return
+        self.stages[self.current]['wall'] += time.time() - self.start_wall
+        self.stages[self.current]['cpu'] += cpu_time() - self.start_cpu
+        self.current = None
+
+    def count(self, field, number=1):
+        # Adds to a counter (e.g. 'particles', 'tilts', 'subprocesses') of the running stage
+        if self.current is not None:
+            self.stages[self.current][field] += number
+
+    def wrote(self, filenames):
+        # Counts files written by the running stage and their size
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        for filename in filenames:
+            if os.path.exists(filename):
+                self.count('files')
+                self.count('bytes', os.path.getsize(filename))
+
+    def system(self, command):
+        # os.system, counted as an external command of the running stage
+        self.count('subprocesses')
+        return os.system(command)
+#
+
+#
+def merge_stages(stagelist):
+    # Sums the stage counters of several timers (e.g. of all tomograms), stages in order of first appearance
+    merged = collections.OrderedDict()
+    for stages in stagelist:
+        for name in stages:
+            if name not in merged:
+                merged[name] = new_stage()
+            for field in STAGE_FIELDS:
+                merged[name][field] += stages[name][field]
+    return merged
+#
+
+#
+def stage_totals(stages):
+    total = new_stage()
+    for name in stages:
+        for field in STAGE_FIELDS:
+            total[field] += stages[name][field]
+    return total
+#
+
+#
+def profile_call(profilename, function, *args):
+    # Runs function under cProfile and writes the statistics to profilename (read with pstats or snakeviz)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(profilename)
+#
+
+#
+def write_report(filename, stages, tomograms, wall, settings):
+    # JSON report of a run: totals, all stages summed over the tomograms, and the stages of every tomogram
+    total = stage_totals(stages)
+    total['wall'] = wall
+    report = collections.OrderedDict()
+    report['total'] = total
+    if wall > 0:
+        report['particles_per_second'] = total['particles'] / wall
+        report['files_per_second'] = total['files'] / wall
+    report['settings'] = settings
+    report['stages'] = stages
+    report['tomograms'] = tomograms
+    reportfile = open(filename, 'w')
+    json.dump(report, reportfile, indent=1)
+    reportfile.close()
+#
+
+#
+def format_stages(stages):
+    # One line per stage for the log
+    lines = []
+    for name in stages:
+        stage = stages[name]
+        lines.append(str("%-20s %9.2f s wall %9.2f s cpu %6d commands %8d files %10.1f MB" % (name, stage['wall'], stage['cpu'], stage['subprocesses'], stage['files'], stage['bytes'] / 1e6)))
+    return lines
+#
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# Python version of star2average.m, without MATLAB and relion_preprocess.
+# Works in the Relion project folder. Inverts the contrast of the subtomograms of a particle .star file and normalizes them
+# (mean 0 and standard deviation 1 outside a sphere of radius bg_radius, like relion_preprocess --norm --no_ramp), writes
+# them to Particles_final/ (or back into the original files with --in-place) and a .star file that points to them, and
+# averages them into a template.
+# Every subtomogram is memory-mapped and processed on its own, the workers of a process pool each add their subtomograms
+# to one running sum, so memory does not grow with the number of particles. If the .star file has prior angles
+# (_rlnAngleRotPrior, ...) or angles (_rlnAngleRot, ...), the subtomograms are rotated into the reference frame before
+# they are added, like relion_reconstruct --3d_rot.
+# Like star2average.m (relion_preprocess --part_dir Particles_final/), the normalized subtomograms are new files and the
+# original subtomograms are not changed unless --in-place is given. Unlike star2average.m, the input .star file is not deleted.
+#
+# Usage: star2average.py imod2star.star --angpix 1.755 [--part_dir Particles_final] [--o average_preprocessed.mrc] [--workers 8]
+
+import os, sys, argparse, multiprocessing
+
+import numpy as np
+
+import mrcio
+import starfile
+
+PRIOR_LABELS = ['_rlnAngleRotPrior', '_rlnAngleTiltPrior', '_rlnAnglePsiPrior']
+ANGLE_LABELS = ['_rlnAngleRot', '_rlnAngleTilt', '_rlnAnglePsi']
+
+# Number of z planes of the average that are interpolated at a time, to keep the memory of a rotation small
+ROTATION_PLANES = 16
+
+
+#
+def background_mask(boxsize, radius):
+    # Voxels outside the sphere of radius (in px) around the center of the box
+    center = boxsize // 2
+    z, y, x = np.ogrid[0:boxsize, 0:boxsize, 0:boxsize]
+    return (x - center)**2 + (y - center)**2 + (z - center)**2 > radius**2
+#
+
+#
+def normalize_invert(volume, mask, invert=True):
+    # Normalizes volume in place to mean 0 and standard deviation 1 in the background, and inverts its contrast
+    background = volume[mask].astype(np.float64)
+    mean = background.mean()
+    std = background.std()
+    if std <= 0:
+        std = 1.0
+    volume -= mean
+    volume *= (-1.0 if invert else 1.0) / std
+    return volume
+#
+
+#
+def euler_matrix(rot, tilt, psi):
+    # RELION's rotation matrix (ZYZ, angles in degrees)
+    alpha, beta, gamma = np.radians([rot, tilt, psi])
+    ca, sa = np.cos(alpha), np.sin(alpha)
+    cb, sb = np.cos(beta), np.sin(beta)
+    cg, sg = np.cos(gamma), np.sin(gamma)
+    cc = cb * ca
+    cs = cb * sa
+    sc = sb * ca
+    ss = sb * sa
+    return np.array([[cg * cc - sg * sa, cg * cs + sg * ca, -cg * sb],
+                     [-sg * cc - cg * sa, -sg * cs + cg * ca, sg * sb],
+                     [sc, ss, cb]])
+#
+
+#
+def add_rotated(average, volume, matrix):
+    # Adds volume, rotated into the reference frame (reference(r) = volume(matrix r)), to average with trilinear
+    # interpolation. Voxels taken from outside the box are 0.
+    boxsize = volume.shape[0]
+    center = boxsize // 2
+    y, x = np.mgrid[0:boxsize, 0:boxsize] - center
+    for first in range(0, boxsize, ROTATION_PLANES):
+        z = np.arange(first, min(boxsize, first + ROTATION_PLANES)) - center
+        r = [x[np.newaxis].astype(np.float64), y[np.newaxis].astype(np.float64), z[:, np.newaxis, np.newaxis].astype(np.float64)]
+        # Coordinates (x, y, z) in the subtomogram of the voxels of these planes of the average
+        coords = [matrix[i, 0] * r[0] + matrix[i, 1] * r[1] + matrix[i, 2] * r[2] + center for i in range(0, 3)]
+        low = [np.floor(c).astype(np.int64) for c in coords]
+        frac = [coords[i] - low[i] for i in range(0, 3)]
+        planes = np.zeros(coords[0].shape, dtype=np.float64)
+        for dz in (0, 1):
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    ix, iy, iz = low[0] + dx, low[1] + dy, low[2] + dz
+                    inside = (ix >= 0) & (ix < boxsize) & (iy >= 0) & (iy < boxsize) & (iz >= 0) & (iz < boxsize)
+                    weight = (frac[0] if dx else 1 - frac[0]) * (frac[1] if dy else 1 - frac[1]) * (frac[2] if dz else 1 - frac[2])
+                    planes += np.where(inside, weight * volume[np.clip(iz, 0, boxsize-1), np.clip(iy, 0, boxsize-1), np.clip(ix, 0, boxsize-1)], 0.0)
+        average[first:first + len(z)] += planes
+#
+
+#
+def update_statistics(filename, header, data):
+    # Writes the new min, max, mean and rms of data into the header of a file that was changed in place
+    raw = bytearray(header['raw'])
+    mrcio.set_statistics(raw, data)
+    mrcfile = open(filename, 'r+b')
+    mrcfile.write(raw[:mrcio.HEADER_BYTES])
+    mrcfile.close()
+#
+
+#
+def process_particles(job):
+    # Normalizes and inverts the subtomograms of one chunk of particles and returns their sum and number
+    imagenames, outnames, angles, radius, invert, pixelsize = job
+    average = None
+    mask = None
+    for j in range(0, len(imagenames)):
+        header, data = mrcio.open_mrc(imagenames[j], mode='r+' if outnames[j] == imagenames[j] else 'r')
+        if average is None:
+            average = np.zeros(data.shape, dtype=np.float64)
+            mask = background_mask(data.shape[0], radius)
+        if data.shape != average.shape:
+            raise ValueError(imagenames[j] + ' has a different box size than ' + imagenames[0])
+        if outnames[j] == imagenames[j]:
+            if data.dtype != np.float32:
+                raise ValueError(imagenames[j] + ' is not float32, it can not be normalized in place')
+            volume = normalize_invert(data, mask, invert)
+            volume.flush()
+            update_statistics(imagenames[j], header, volume)
+        else:
+            volume = normalize_invert(np.array(data, dtype=np.float32), mask, invert)
+            mrcio.write_mrc(outnames[j], volume, template=header, pixelsize=pixelsize)
+
+        if angles is None:
+            average += volume
+        else:
+            add_rotated(average, volume, euler_matrix(*angles[j]))
+        del data, volume
+    return average, len(imagenames)
+#
+
+#
+def output_names(imagenames, partdir):
+    # Output file of every subtomogram in partdir, by file name (or by relative path if file names repeat)
+    basenames = [os.path.basename(imagename) for imagename in imagenames]
+    if len(set(basenames)) == len(basenames):
+        return [os.path.join(partdir, basename) for basename in basenames]
+    return [os.path.join(partdir, os.path.normpath(imagename).lstrip('/')) for imagename in imagenames]
+#
+
+#
+def particle_angles(table):
+    # (rot, tilt, psi) of every particle from the priors or the angles of the .star file, None if it has neither
+    for labels in (PRIOR_LABELS, ANGLE_LABELS):
+        if all([table.has_column(label) for label in labels]):
+            return np.column_stack([table.floats(label) for label in labels]).tolist()
+    return None
+#
+
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Invert and normalize subtomograms and average them into a template')
+    parser.add_argument('star', help='particle .star file (e.g. imod2star.star or particles_subtomo.star)')
+    parser.add_argument('--angpix', type=float, required=True, help='pixel size (in A)')
+    parser.add_argument('--part_dir', default='Particles_final', help='folder for the normalized subtomograms')
+    parser.add_argument('--in-place', action='store_true', help='overwrite the subtomograms instead of writing them to --part_dir')
+    parser.add_argument('--bg_radius', type=float, default=0, help='radius (in px) outside of which the background is normalized (default: half the box)')
+    parser.add_argument('--no-invert', action='store_true', help='only normalize')
+    parser.add_argument('--no-rotate', action='store_true', help='average without rotating the subtomograms by their (prior) angles')
+    parser.add_argument('--star_out', default='preprocessed_fixed.star', help='.star file with the normalized subtomograms')
+    parser.add_argument('--o', dest='output', default='average_preprocessed.mrc', help='average of all subtomograms')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of processes')
+    parser.add_argument('--chunk', type=int, default=100, help='subtomograms per task of a worker')
+    args = parser.parse_args(argv)
+
+    table = starfile.first_table(args.star)
+    imagenames = table.column('_rlnImageName').tolist()
+    if len(imagenames) == 0:
+        print('No particles in ' + args.star)
+        return 1
+    if args.in_place:
+        outnames = list(imagenames)
+    else:
+        outnames = output_names(imagenames, args.part_dir)
+        for outdir in set([os.path.dirname(outname) for outname in outnames]):
+            if not os.path.exists(outdir):
+                os.makedirs(outdir)
+    angles = None if args.no_rotate else particle_angles(table)
+
+    header = mrcio.read_header(imagenames[0])
+    radius = args.bg_radius if args.bg_radius > 0 else header['nx'] / 2.0
+    jobs = []
+    for first in range(0, len(imagenames), args.chunk):
+        last = first + args.chunk
+        jobs.append((imagenames[first:last], outnames[first:last], None if angles is None else angles[first:last], radius, not args.no_invert, args.angpix))
+
+    print('Normalizing ' + str(len(imagenames)) + ' subtomograms with ' + str(args.workers) + ' workers' + ('' if angles is None else ', rotated by their angles for the average'))
+    if args.in_place:
+        print('The subtomograms are overwritten (--in-place)')
+    else:
+        print('The normalized subtomograms are written to ' + args.part_dir + '/, the original subtomograms are not changed (use --in-place to overwrite them)')
+    total = None
+    done = 0
+    pool = multiprocessing.Pool(max(1, args.workers))
+    for average, count in pool.imap_unordered(process_particles, jobs):
+        if total is None:
+            total = average
+        else:
+            total += average
+        done = done + count
+        print(str(done) + ' of ' + str(len(imagenames)) + ' subtomograms done')
+    pool.close()
+    pool.join()
+
+    mrcio.write_mrc(args.output, (total / done).astype(np.float32), pixelsize=args.angpix)
+
+    columns = dict((label, table.column(label)) for label in table.labels)
+    columns['_rlnImageName'] = np.array(outnames)
+    writer = starfile.StarWriter(args.star_out)
+    writer.write_table(starfile.StarTable('', table.labels, columns))
+    writer.close()
+    print('Average of ' + str(done) + ' subtomograms written to ' + args.output + ', normalized subtomograms listed in ' + args.star_out)
+    return 0
+#
+
+if __name__ == '__main__':
+    sys.exit(main())
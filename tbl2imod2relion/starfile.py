@@ -0,0 +1,213 @@
+# STAR file reading and writing for relion_STA_updated.py and its helper scripts.
+# Loops are parsed into NumPy string columns in one go instead of line by line, so large particle
+# files can be read once and then sliced, filtered or merged by column. Values containing spaces
+# (quoted strings) are not supported, which is fine for the files RELION writes for sub-tomograms.
+#
+# Reading:   table = first_table('particles_subtomo.star')   (or blocks = read_star(...) for all data blocks)
+#            names = table.column('_rlnImageName'); x = table.floats('_rlnCoordinateX')
+# Writing:   writer = StarWriter('out.star'); writer.begin_block('', labels); writer.write_row(values); writer.close()
+
+import collections
+
+import numpy as np
+
+# Lines kept in memory by StarWriter before they are written to disk
+WRITE_BUFFER_LINES = 10000
+
+
+#
+class StarTable(object):
+    # One data block: column labels in file order and one NumPy string array per column
+
+    def __init__(self, name, labels, columns, unlabelled=None):
+        self.name = name
+        self.labels = list(labels)
+        self.columns = columns
+        # Extra columns after the labelled ones, e.g. the tilt scale of the 3D CTF model files
+        self.unlabelled = list(unlabelled) if unlabelled is not None else []
+
+    def __len__(self):
+        if len(self.labels) == 0:
+            return 0
+        return len(self.columns[self.labels[0]])
+
+    def has_column(self, label):
+        return label in self.columns
+
+    def column(self, label):
+        return self.columns[label]
+
+    def floats(self, label):
+        return self.columns[label].astype(np.float64)
+
+    def rows(self, indices):
+        # New table with a subset of the rows, e.g. from a boolean mask or an index array
+        return StarTable(self.name, self.labels, dict((label, self.columns[label][indices]) for label in self.labels),
+                         [column[indices] for column in self.unlabelled])
+
+    def lines(self, separator='\t'):
+        # Data lines as text, the values separated by separator
+        if len(self.labels) == 0:
+            return []
+        columns = [self.columns[label] for label in self.labels] + self.unlabelled
+        return [separator.join(values) + '\n' for values in zip(*columns)]
+#
+
+#
+def _split_blocks(text):
+    # (blockname, text) for every data block of a STAR file, text excludes the data_ line
+    starts = []
+    if text.startswith('data_'):
+        starts.append(0)
+    pos = text.find('\ndata_')
+    while pos >= 0:
+        starts.append(pos + 1)
+        pos = text.find('\ndata_', pos + 1)
+    blocks = []
+    for j in range(0, len(starts)):
+        end = len(text)
+        if j+1 < len(starts):
+            end = starts[j+1]
+        lineend = text.find('\n', starts[j], end)
+        if lineend < 0:
+            lineend = end
+        blocks.append((text[starts[j]+5:lineend].strip(), text[lineend+1:end]))
+    return blocks
+#
+
+#
+def _parse_block(blockname, blocktext):
+    # The header (loop_ and labels) is read line by line, the data rows are split in one go
+    labels = []
+    values = []
+    isloop = False
+    pos = 0
+    while pos < len(blocktext):
+        lineend = blocktext.find('\n', pos)
+        if lineend < 0:
+            lineend = len(blocktext)
+        stripped = blocktext[pos:lineend].strip()
+        if len(stripped) == 0 or stripped[0] == '#':
+            pos = lineend + 1
+            continue
+        if stripped.startswith('loop_'):
+            isloop = True
+        elif stripped[0] == '_':
+            fields = stripped.split()
+            labels.append(fields[0])
+            # Simple blocks have label and value on one line
+            if not isloop and len(fields) > 1:
+                values.append(fields[1])
+        else:
+            break
+        pos = lineend + 1
+
+    if not isloop:
+        return StarTable(blockname, labels, dict((label, np.array([value])) for label, value in zip(labels, values)))
+
+    ncolumns = len(labels)
+    datatext = blocktext[pos:]
+    fields = datatext.split()
+    # Every non-blank line is one row
+    nrows = len([line for line in datatext.splitlines() if line.strip()])
+    # Rows can have unlabelled values after the labelled columns
+    width = len(fields) // nrows if nrows > 0 else ncolumns
+    if ncolumns == 0 or width < ncolumns or width * nrows != len(fields):
+        raise ValueError('Data block ' + blockname + ' has rows that do not match its ' + str(ncolumns) + ' columns')
+    columns = {}
+    for j in range(0, ncolumns):
+        columns[labels[j]] = np.array(fields[j::width])
+    return StarTable(blockname, labels, columns, [np.array(fields[j::width]) for j in range(ncolumns, width)])
+#
+
+#
+def read_star(filename):
+    # All data blocks of a STAR file as an ordered dictionary of StarTables, keyed by block name
+    starfile = open(filename, 'r')
+    text = starfile.read()
+    starfile.close()
+    blocks = collections.OrderedDict()
+    for blockname, blocktext in _split_blocks(text):
+        blocks[blockname] = _parse_block(blockname, blocktext)
+    return blocks
+#
+
+#
+def first_table(filename):
+    # The first data block of a STAR file
+    blocks = read_star(filename)
+    if len(blocks) == 0:
+        raise ValueError('No data block in ' + filename)
+    return next(iter(blocks.values()))
+#
+
+#
+def read_star_column(filename, label):
+    # Values of one column, taken from the first data block that has it
+    for table in read_star(filename).values():
+        if table.has_column(label):
+            return table.column(label)
+    raise KeyError('No column ' + label + ' in ' + filename)
+#
+
+#
+def loop_header(labels):
+    # loop_ line and column labels, numbered like RELION does
+    return 'loop_' + '\n' + ''.join([labels[j] + ' #' + str(j+1) + '\n' for j in range(0, len(labels))])
+#
+
+#
+def block_header(blockname, labels):
+    return 'data_' + blockname + '\n' + '\n' + loop_header(labels)
+#
+
+#
+class StarWriter(object):
+    # Buffered streaming writer, rows are written as they come without keeping the file in memory.
+    # Values are tab separated, separator=' ' writes rows like relion_run_ctffind does.
+
+    def __init__(self, filename, separator='\t'):
+        self.filename = filename
+        self.separator = separator
+        self.outfile = open(filename, 'w')
+        self.buffer = []
+
+    def begin_block(self, blockname, labels):
+        self.write_text(block_header(blockname, labels))
+
+    def write_row(self, values):
+        self.write_text(self.separator.join([str(value) for value in values]) + '\n')
+
+    def write_rows(self, rows):
+        for values in rows:
+            self.write_row(values)
+
+    def write_text(self, text):
+        # Pre-formatted lines, e.g. whole tables
+        self.buffer.append(text)
+        if len(self.buffer) >= WRITE_BUFFER_LINES:
+            self.flush()
+
+    def write_table(self, table, blockname=None):
+        # blockname replaces the name of the table, e.g. to write a block of a larger file on its own
+        self.begin_block(table.name if blockname is None else blockname, table.labels)
+        self.buffer.extend(table.lines(self.separator))
+        self.flush()
+
+    def flush(self):
+        self.outfile.write(''.join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+#
+
+#
+def write_star(filename, tables):
+    # Writes StarTables as one file
+    writer = StarWriter(filename)
+    for table in tables:
+        writer.write_table(table)
+    writer.close()
+#
@@ -0,0 +1,132 @@
+# Agreement of ctf_volume.py with the analytic 3D CTF model (the same convention as relion_reconstruct --reconstruct_ctf).
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, shutil, tempfile, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ctf_volume
+import mrcio
+
+BOXSIZE = 32
+ANGPIX = 2.0
+VOLTAGE = 300.0
+CS = 2.7
+AMPCONTRAST = 0.07
+DEFOCUS = 30000.0
+# Defocus with Thon rings far enough apart to be resolved by the voxels of a BOXSIZE box
+RING_DEFOCUS = 5000.0
+
+
+#
+def analytic_ctf(u, defocus=DEFOCUS):
+    # RELION's CTF at spatial frequency u (in 1/A) for an underfocus defocus (in A), no B-factor
+    wavelength = ctf_volume.electron_wavelength(VOLTAGE)
+    k1 = np.pi * wavelength
+    k2 = np.pi / 2 * CS * 1e7 * wavelength**3
+    k3 = np.arctan(AMPCONTRAST / np.sqrt(1 - AMPCONTRAST**2))
+    return -np.sin(-k1 * defocus * u**2 + k2 * u**4 - k3)
+#
+
+#
+def analytic_volume(defocus=DEFOCUS):
+    # 3D CTF of the tilts 0 and 90 degrees: the 2D CTF on the planes z = 0 and x = 0 inside the Nyquist circle, zero elsewhere
+    half = BOXSIZE // 2
+    freqs = np.arange(-half, BOXSIZE - half)
+    fy, fx = np.meshgrid(freqs, freqs, indexing='ij')
+    plane = np.where((fx**2 + fy**2) < half**2, analytic_ctf(np.sqrt(fx**2 + fy**2) / (BOXSIZE * ANGPIX), defocus), 0.0)
+    volume = np.zeros((BOXSIZE, BOXSIZE, BOXSIZE), dtype=np.float32)
+    volume[half] = plane
+    volume[:, :, half] = plane
+    return volume
+#
+
+#
+def write_ctf_star(filename, tilts, defocus=DEFOCUS, scale=1.0):
+    # 3D CTF model .star file as relion_STA_updated.py writes it, with the unlabelled tilt scale column
+    starfile = open(filename, 'w')
+    starfile.write('data_images\nloop_\n_rlnDefocusU #1 \n_rlnVoltage #2 \n_rlnSphericalAberration #3 \n_rlnAmplitudeContrast #4 \n'
+                   '_rlnAngleRot #5 \n_rlnAngleTilt #6\n_rlnAnglePsi #7 \n_rlnBfactor #8 \n')
+    for tilt in tilts:
+        starfile.write(str("%.2f" % defocus) + '\t' + str(VOLTAGE) + '\t' + str(CS) + '\t' + str(AMPCONTRAST) + '\t0.0\t'
+                       + str("%.2f" % tilt) + '\t0.0\t0.0\t' + str("%.2f" % scale) + '\n')
+    starfile.close()
+#
+
+
+class CtfVolumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratchdir = tempfile.mkdtemp(prefix='test_ctf_volume_')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratchdir)
+
+    def compute(self, tilts, defocus=DEFOCUS):
+        geometry = ctf_volume.slice_geometry(tilts, BOXSIZE)
+        defoci = [np.ones(len(tilts)) * defocus]
+        return ctf_volume.ctf_volumes(geometry, defoci, ANGPIX, VOLTAGE, CS, AMPCONTRAST, np.zeros(len(tilts)), np.ones(len(tilts)))[0]
+
+    def test_centre_is_amplitude_contrast(self):
+        # At 0 and 90 degrees every slice sample falls on a voxel, nothing else is interpolated into the centre
+        volume = self.compute([0.0, 90.0])
+        half = BOXSIZE // 2
+        self.assertAlmostEqual(volume[half, half, half], AMPCONTRAST, places=5)
+
+    def test_grid_slices_match_analytic_ctf(self):
+        # The slice at 0 degrees is the plane z = 0, the one at 90 degrees the plane x = 0, both hold the 2D CTF exactly
+        volume = self.compute([0.0, 90.0])
+        half = BOXSIZE // 2
+        freqs = np.arange(-half, BOXSIZE - half)
+        fy, fx = np.meshgrid(freqs, freqs, indexing='ij')
+        inside = (fx**2 + fy**2) < half**2
+        expected = analytic_ctf(np.sqrt(fx**2 + fy**2) / (BOXSIZE * ANGPIX))
+        np.testing.assert_allclose(volume[half][inside], expected[inside], atol=1e-5)
+        np.testing.assert_allclose(volume[:, :, half][inside], expected[inside], atol=1e-5)
+        self.assertTrue(np.all(volume[half][~inside] == 0))
+
+    def test_zeros_at_defocus_rings(self):
+        # The CTF changes sign between the voxels around every Thon ring of the underfocus along the x axis
+        volume = self.compute([0.0], defocus=RING_DEFOCUS)
+        half = BOXSIZE // 2
+        profile = volume[half, half, half:]
+        u = np.arange(0, half) / float(BOXSIZE * ANGPIX)
+        fine = np.linspace(0, u[-1], 100000)
+        rings = fine[1:][np.diff(np.sign(analytic_ctf(fine, RING_DEFOCUS))) != 0]
+        # Only rings more than two voxels away from the next ones can be seen on the grid
+        spacing = np.diff(np.concatenate([[0], rings, [np.inf]])) * BOXSIZE * ANGPIX
+        rings = rings[(spacing[:-1] > 2) & (spacing[1:] > 2)]
+        self.assertTrue(len(rings) >= 2)
+        for ring in rings:
+            below = int(np.floor(ring * BOXSIZE * ANGPIX))
+            self.assertTrue(profile[below] * profile[below + 1] <= 0, 'no sign change at ring ' + str(1 / ring) + ' A')
+
+    def test_tilt_scale_ignored_by_default(self):
+        starname = os.path.join(self.scratchdir, 'particle_ctf.star')
+        write_ctf_star(starname, [0.0, 90.0], scale=0.5)
+        half = BOXSIZE // 2
+        self.assertEqual(ctf_volume.main(['--box', str(BOXSIZE), '--angpix', str(ANGPIX), starname]), 0)
+        header, volume = mrcio.open_mrc(os.path.join(self.scratchdir, 'particle_ctf.mrc'))
+        self.assertAlmostEqual(float(volume[half, half, half]), AMPCONTRAST, places=5)
+        np.testing.assert_allclose(volume, self.compute([0.0, 90.0]), atol=1e-6)
+        del volume
+        self.assertEqual(ctf_volume.main(['--box', str(BOXSIZE), '--angpix', str(ANGPIX), '--tilt-scale', starname]), 0)
+        header, volume = mrcio.open_mrc(os.path.join(self.scratchdir, 'particle_ctf.mrc'))
+        self.assertAlmostEqual(float(volume[half, half, half]), 0.5 * AMPCONTRAST, places=5)
+        del volume
+
+    def test_reference_check(self):
+        # The reference is the analytic CTF on the planes z = 0 and x = 0, not something computed by ctf_volume.py
+        starname = os.path.join(self.scratchdir, 'particle_ctf.star')
+        write_ctf_star(starname, [0.0, 90.0])
+        referencename = os.path.join(self.scratchdir, 'reference.mrc')
+        mrcio.write_mrc(referencename, analytic_volume(), pixelsize=ANGPIX)
+        self.assertEqual(ctf_volume.main(['--box', str(BOXSIZE), '--angpix', str(ANGPIX), '--reference', referencename, starname]), 0)
+        mrcio.write_mrc(referencename, analytic_volume(defocus=20000.0), pixelsize=ANGPIX)
+        self.assertEqual(ctf_volume.main(['--box', str(BOXSIZE), '--angpix', str(ANGPIX), '--reference', referencename, starname]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# Resolution at an FSC threshold (fsc_plot.resolution_at).
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fsc_plot
+
+BOXSIZE = 64
+PIXELSIZE = 2.0
+
+
+class ResolutionTest(unittest.TestCase):
+
+    def test_crossing_interpolated(self):
+        # Crossing halfway between shells 8 and 9
+        fsc = np.ones(BOXSIZE // 2 + 1)
+        fsc[8] = 0.243
+        fsc[9:] = 0.043
+        self.assertAlmostEqual(fsc_plot.resolution_at(fsc, BOXSIZE, PIXELSIZE, 0.143), BOXSIZE * PIXELSIZE / 8.5)
+
+    def test_nyquist_if_never_below(self):
+        fsc = np.ones(BOXSIZE // 2 + 1)
+        self.assertEqual(fsc_plot.resolution_at(fsc, BOXSIZE, PIXELSIZE, 0.143), 2.0 * PIXELSIZE)
+
+    def test_drop_before_shell_1_not_resolved(self):
+        # Shell 0 always correlates, a drop to shell 1 would give a resolution coarser than the box
+        fsc = np.zeros(BOXSIZE // 2 + 1)
+        fsc[0] = 1.0
+        fsc[1] = 0.1
+        self.assertEqual(fsc_plot.resolution_at(fsc, BOXSIZE, PIXELSIZE, 0.143), None)
+        self.assertEqual(fsc_plot.format_resolution(None), 'not resolved')
+
+    def test_crossing_after_shell_1_within_box(self):
+        fsc = np.zeros(BOXSIZE // 2 + 1)
+        fsc[0] = 1.0
+        fsc[1] = 0.2
+        resolution = fsc_plot.resolution_at(fsc, BOXSIZE, PIXELSIZE, 0.143)
+        self.assertTrue(resolution <= BOXSIZE * PIXELSIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Headers written by mrcio.py from a template, in particular from a big endian file.
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, struct, shutil, tempfile, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mrcio
+
+PIXELSIZE = 2.5
+ORIGIN = (10.0, -20.0, 30.5)
+LABEL = b'big endian tilt series'
+
+
+#
+def write_big_endian(filename, data):
+    # MRC file as written on a big endian machine: machine stamp 0x11 0x11, every number big endian
+    nz, ny, nx = data.shape
+    raw = bytearray(mrcio.HEADER_BYTES)
+    struct.pack_into('>4i', raw, 0, nx, ny, nz, 2)
+    struct.pack_into('>3i', raw, 28, nx, ny, nz)
+    struct.pack_into('>3f', raw, 40, nx * PIXELSIZE, ny * PIXELSIZE, nz * PIXELSIZE)
+    struct.pack_into('>3f', raw, 52, 90.0, 90.0, 90.0)
+    struct.pack_into('>3i', raw, 64, 1, 2, 3)
+    struct.pack_into('>i', raw, 108, 20140)
+    struct.pack_into('>3f', raw, 196, ORIGIN[0], ORIGIN[1], ORIGIN[2])
+    raw[208:212] = b'MAP '
+    raw[212:216] = b'\x11\x11\x00\x00'
+    struct.pack_into('>i', raw, 220, 1)
+    raw[224:224+len(LABEL)] = LABEL
+    outfile = open(filename, 'wb')
+    outfile.write(raw)
+    outfile.write(data.astype('>f4').tobytes())
+    outfile.close()
+#
+
+
+class BigEndianTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratchdir = tempfile.mkdtemp(prefix='test_mrcio_')
+        self.data = np.arange(4 * 6 * 8, dtype=np.float32).reshape(4, 6, 8)
+        self.stackname = os.path.join(self.scratchdir, 'stack.mrc')
+        write_big_endian(self.stackname, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratchdir)
+
+    def test_read_big_endian(self):
+        header, stack = mrcio.open_mrc(self.stackname)
+        self.assertEqual(header['endian'], '>')
+        self.assertAlmostEqual(mrcio.pixel_size(header), PIXELSIZE, places=5)
+        np.testing.assert_array_equal(stack, self.data)
+        del stack
+
+    def test_sections_are_little_endian(self):
+        outnames = [os.path.join(self.scratchdir, 'section' + str(i) + '.mrc') for i in range(0, 4)]
+        mrcio.write_sections(self.stackname, outnames)
+        for section, outname in enumerate(outnames):
+            header, image = mrcio.open_mrc(outname)
+            self.assertEqual(header['endian'], '<')
+            self.assertEqual((header['nx'], header['ny'], header['nz']), (8, 6, 1))
+            self.assertAlmostEqual(mrcio.pixel_size(header), PIXELSIZE, places=5)
+            np.testing.assert_array_equal(image[0], self.data[section])
+            raw = header['raw']
+            # The fields copied from the template are little endian as well
+            self.assertEqual(struct.unpack('<3i', raw[64:76]), (1, 2, 3))
+            self.assertEqual(struct.unpack('<i', raw[108:112])[0], 20140)
+            np.testing.assert_allclose(struct.unpack('<3f', raw[196:208]), ORIGIN)
+            self.assertEqual(raw[208:212], b'MAP ')
+            self.assertEqual(struct.unpack('<i', raw[220:224])[0], 1)
+            self.assertEqual(raw[224:224+len(LABEL)], LABEL)
+            self.assertAlmostEqual(struct.unpack('<f', raw[84:88])[0], self.data[section].mean(), places=3)
+            del image
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# run_ctf_jobs.py with a stub relion_reconstruct: skipping of existing volumes, retries and validation of the outputs.
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, shutil, tempfile, unittest
+
+import numpy as np
+
+CODEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODEDIR)
+sys.path.insert(0, os.path.join(CODEDIR, 'benchmarks'))
+
+import bench_pipeline
+import mrcio
+import run_ctf_jobs
+
+BOXSIZE = 8
+
+# Writes a BOXSIZE^3 volume to --o. Volumes named flaky_* fail the first time, broken_* are always cut short.
+# Every call is recorded in calls.txt next to the volumes.
+STUB_CODE = '''import os, sys
+sys.path.insert(0, %r)
+import numpy as np
+import mrcio
+args = sys.argv[1:]
+output = args[args.index('--o') + 1]
+boxsize = int(args[args.index('--subtomo') + 1])
+callsfile = open(os.path.join(os.path.dirname(output), 'calls.txt'), 'a')
+callsfile.write(os.path.basename(output) + '\\n')
+callsfile.close()
+marker = output + '.tried'
+if os.path.basename(output).startswith('flaky_') and not os.path.exists(marker):
+    open(marker, 'w').close()
+    sys.exit(1)
+mrcio.write_mrc(output, np.ones((boxsize, boxsize, boxsize), dtype=np.float32))
+if os.path.basename(output).startswith('broken_'):
+    volumefile = open(output, 'r+b')
+    volumefile.truncate(mrcio.HEADER_BYTES + 10)
+    volumefile.close()
+''' % CODEDIR
+
+
+class RunJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratchdir = tempfile.mkdtemp(prefix='test_run_ctf_jobs_')
+        self.stub = bench_pipeline.write_stub(self.scratchdir, 'stub_reconstruct', STUB_CODE)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratchdir)
+
+    def volume(self, name):
+        return os.path.join(self.scratchdir, name + '.mrc')
+
+    def write_jobfile(self, names):
+        # One relion_reconstruct line per volume, with $1 for the box size as in do_all_reconstruct_ctfs.sh
+        jobname = os.path.join(self.scratchdir, 'do_all_reconstruct_ctfs.sh')
+        jobfile = open(jobname, 'w')
+        for name in names:
+            jobfile.write('relion_reconstruct --i ' + name + '.star --o ' + self.volume(name) + ' --reconstruct_ctf $1 --subtomo $1\n')
+        jobfile.close()
+        return jobname
+
+    def calls(self):
+        callsname = os.path.join(self.scratchdir, 'calls.txt')
+        if not os.path.exists(callsname):
+            return []
+        callsfile = open(callsname, 'r')
+        calls = [line.strip() for line in callsfile]
+        callsfile.close()
+        return calls
+
+    def run_jobfile(self, jobname, *options):
+        return run_ctf_jobs.main([jobname, str(BOXSIZE), '--relion-reconstruct', self.stub, '--workers', '2', '--chunk', '2'] + list(options))
+
+    def test_all_written(self):
+        jobname = self.write_jobfile(['a', 'b', 'c'])
+        self.assertEqual(self.run_jobfile(jobname), 0)
+        self.assertEqual(sorted(self.calls()), ['a.mrc', 'b.mrc', 'c.mrc'])
+        for name in ['a', 'b', 'c']:
+            self.assertTrue(run_ctf_jobs.valid_output(self.volume(name), BOXSIZE))
+        self.assertFalse(os.path.exists(jobname + '.failed'))
+
+    def test_existing_volumes_skipped(self):
+        # A complete volume of the right size is kept, one of another box size or cut short is written again
+        mrcio.write_mrc(self.volume('done'), np.zeros((BOXSIZE, BOXSIZE, BOXSIZE), dtype=np.float32))
+        mrcio.write_mrc(self.volume('other_size'), np.zeros((BOXSIZE+2, BOXSIZE+2, BOXSIZE+2), dtype=np.float32))
+        mrcio.write_mrc(self.volume('cut'), np.zeros((BOXSIZE, BOXSIZE, BOXSIZE), dtype=np.float32))
+        cutfile = open(self.volume('cut'), 'r+b')
+        cutfile.truncate(mrcio.HEADER_BYTES + 100)
+        cutfile.close()
+        jobname = self.write_jobfile(['done', 'other_size', 'cut'])
+        self.assertEqual(self.run_jobfile(jobname), 0)
+        self.assertEqual(sorted(self.calls()), ['cut.mrc', 'other_size.mrc'])
+        header, volume = mrcio.open_mrc(self.volume('done'))
+        self.assertEqual(float(volume.max()), 0.0)
+        del volume
+        ncalls = len(self.calls())
+        self.assertEqual(self.run_jobfile(jobname, '--no-skip'), 0)
+        self.assertEqual(len(self.calls()), ncalls + 3)
+
+    def test_failed_first_attempt_retried(self):
+        jobname = self.write_jobfile(['a', 'flaky_b', 'c'])
+        self.assertEqual(self.run_jobfile(jobname), 0)
+        self.assertEqual(self.calls().count('flaky_b.mrc'), 2)
+        self.assertEqual(self.calls().count('a.mrc'), 1)
+        self.assertTrue(run_ctf_jobs.valid_output(self.volume('flaky_b'), BOXSIZE))
+        self.assertFalse(os.path.exists(jobname + '.failed'))
+
+    def test_incomplete_output_fails(self):
+        # The stub exits with 0, but the volume it leaves is not complete: retried, then written to the .failed file
+        jobname = self.write_jobfile(['a', 'broken_b'])
+        self.assertEqual(self.run_jobfile(jobname, '--retries', '2'), 1)
+        self.assertEqual(self.calls().count('broken_b.mrc'), 3)
+        failedfile = open(jobname + '.failed', 'r')
+        failed = failedfile.readlines()
+        failedfile.close()
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].startswith(self.stub + ' ') and 'broken_b.mrc' in failed[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
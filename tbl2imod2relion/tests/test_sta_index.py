@@ -0,0 +1,80 @@
+# Tomograms in the metadata index (sta_index.py) are told apart by the path of their .mrc file.
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, shutil, sqlite3, tempfile, unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mrcio
+import sta_index
+
+
+class MetadataIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.startdir = os.getcwd()
+        self.scratchdir = tempfile.mkdtemp(prefix='test_sta_index_')
+        os.chdir(self.scratchdir)
+        self.indexname = 'tomogram_metadata.sqlite'
+
+    def tearDown(self):
+        os.chdir(self.startdir)
+        shutil.rmtree(self.scratchdir)
+
+    def write_tomogram(self, folder, ntilts, nparticles, pixelsize):
+        # TS_01 with its tilt angles, tilt order and coordinates in folder, returns the file names
+        os.makedirs(folder)
+        root = os.path.join(folder, 'TS_01')
+        tiltfile = open(root + '.tlt', 'w')
+        orderfile = open(root + '.order', 'w')
+        for j in range(0, ntilts):
+            tiltfile.write(str(3.0 * j) + '\n')
+            orderfile.write(str(3.0 * j) + ' ' + str(2.0 * j) + '\n')
+        tiltfile.close()
+        orderfile.close()
+        coordsfile = open(root + '.coords', 'w')
+        for j in range(0, nparticles):
+            coordsfile.write(str(j) + ' ' + str(j + 1) + ' ' + str(j + 2) + '\n')
+        coordsfile.close()
+        mrcio.write_mrc(root + '.mrc', np.zeros((4, 6, 8), dtype=np.float32), pixelsize=pixelsize)
+        return root + '.mrc', root + '.tlt', root + '.order', root + '.coords'
+
+    def test_same_name_in_two_folders(self):
+        index = sta_index.open_index(self.indexname)
+        first = self.write_tomogram('set1', 3, 2, 2.0)
+        second = self.write_tomogram('set2', 5, 4, 0.0)
+        sta_index.ingest_tomogram(index, *first)
+        sta_index.ingest_tomogram(index, *second)
+        self.assertEqual(len(sta_index.tilt_angles(index, first[0])), 3)
+        self.assertEqual(len(sta_index.tilt_angles(index, second[0])), 5)
+        self.assertEqual(sta_index.particle_coords(index, first[0]).shape, (2, 3))
+        self.assertEqual(sta_index.particle_coords(index, second[0]).shape, (4, 3))
+        self.assertEqual(sta_index.tomogram_geometry(index, first[0]), ([8, 6, 4], 2.0))
+        self.assertEqual(sta_index.tomogram_geometry(index, second[0]), ([8, 6, 4], 0.0))
+        # Nothing is read again as long as the files do not change
+        self.assertEqual(sta_index.ingest_tomogram(index, *first), [])
+        index.close()
+
+    def test_old_index_rebuilt(self):
+        # An index from before the tomograms were keyed on their path is emptied and filled again
+        old = sqlite3.connect(self.indexname)
+        old.executescript('CREATE TABLE tomograms (name TEXT PRIMARY KEY, micname TEXT, nx INTEGER, ny INTEGER, nz INTEGER, pixelsize REAL);'
+                          'CREATE TABLE tilts (tomogram TEXT, idx INTEGER, angle REAL, PRIMARY KEY (tomogram, idx));'
+                          "INSERT INTO tilts VALUES ('TS_01', 0, 0.0);")
+        old.close()
+        index = sta_index.open_index(self.indexname)
+        self.assertEqual(index.execute('SELECT COUNT(*) FROM tilts').fetchone()[0], 0)
+        first = self.write_tomogram('set1', 3, 2, 2.0)
+        self.assertEqual(sta_index.ingest_tomogram(index, *first), ['tilts', 'order', 'coords', 'header'])
+        self.assertEqual(sta_index.tomogram_geometry(index, first[0]), ([8, 6, 4], 2.0))
+        index.close()
+        # Opening it again keeps what is in it
+        index = sta_index.open_index(self.indexname)
+        self.assertEqual(sta_index.ingest_tomogram(index, *first), [])
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# sta_pipeline.process_tomogram called as a library function, from outside the project folder.
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, shutil, tempfile, unittest
+
+CODEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODEDIR)
+sys.path.insert(0, os.path.join(CODEDIR, 'benchmarks'))
+
+import bench_pipeline
+import sta_pipeline
+
+NPARTICLES = 20
+NTILTS = 5
+
+
+class ProcessTomogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.startdir = os.getcwd()
+        self.scratchdir = tempfile.mkdtemp(prefix='test_sta_pipeline_')
+        self.projectdir = os.path.join(self.scratchdir, 'project')
+        self.otherdir = os.path.join(self.scratchdir, 'elsewhere')
+        os.makedirs(self.projectdir)
+        os.makedirs(self.otherdir)
+        # CTFFIND results come with the data, the tilt images are extracted in-process: no external programs are needed
+        bench_pipeline.generate_project(self.projectdir, 1, NPARTICLES, NTILTS, 16, True, 1)
+
+    def tearDown(self):
+        os.chdir(self.startdir)
+        shutil.rmtree(self.scratchdir)
+
+    def config(self, projectdir):
+        return sta_pipeline.StaConfig(ProjectDir=projectdir, TomoSize=bench_pipeline.TOMOSIZE, PixelSize=bench_pipeline.PIXELSIZE,
+                                      ReRunCtffindSkip=True, ExtractTiltsInProcess=True)
+
+    def check_outputs(self, result):
+        self.assertEqual(result['tomogram'], 'TS_001')
+        self.assertEqual(len(result['tilts']), NTILTS)
+        self.assertEqual(len(result['particles']), NPARTICLES)
+        self.assertTrue(os.path.exists(os.path.join(self.projectdir, 'TS_001', 'ctffind', 'TS_001_tiltangles.txt')))
+        self.assertTrue(os.path.isdir(os.path.join(self.projectdir, 'Particles', 'TS_001')))
+        # Names in the returned lines stay relative to the project folder, nothing is written where the caller is
+        self.assertTrue(result['ctf_images'][0].startswith('Particles/TS_001/'))
+        self.assertEqual(os.listdir(self.otherdir), [])
+
+    def test_from_other_folder(self):
+        os.chdir(self.otherdir)
+        result = sta_pipeline.process_tomogram(self.config(self.projectdir), 'TS_001/TS_001.mrc')
+        self.assertEqual(os.path.realpath(os.getcwd()), os.path.realpath(self.otherdir))
+        self.check_outputs(result)
+
+    def test_relative_project_dir(self):
+        os.chdir(self.otherdir)
+        result = sta_pipeline.process_tomogram(self.config(os.path.join('..', 'project')), 'TS_001/TS_001.mrc')
+        self.check_outputs(result)
+
+    def test_folder_restored_on_error(self):
+        os.chdir(self.otherdir)
+        self.assertRaises(IOError, sta_pipeline.process_tomogram, self.config(self.projectdir), 'TS_002/TS_002.mrc')
+        self.assertEqual(os.path.realpath(os.getcwd()), os.path.realpath(self.otherdir))
+
+
+if __name__ == '__main__':
+    unittest.main()
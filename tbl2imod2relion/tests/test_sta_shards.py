@@ -0,0 +1,38 @@
+# Reconstruction commands for several volumes are split between the shards of their particles (sta_shards.py).
+# Run from tbl2imod2relion/: python -m unittest discover tests
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sta_shards
+
+
+class ShardCommandsTest(unittest.TestCase):
+
+    def test_batched_command_split(self):
+        # One command for the blocks v1 ... v4, whose particles are in shards 0, 0, 1 and 1
+        commands = ['run --blocks v1 v2 v3 v4\n']
+        volumeshards = {'v1.mrc': 0, 'v2.mrc': 0, 'v3.mrc': 1, 'v4.mrc': 1}
+        parts = [('run --blocks ', ['v1', 'v2', 'v3', 'v4'], '\n')]
+        shardcommands = sta_shards.shard_commands(commands, [['v1.mrc', 'v2.mrc', 'v3.mrc', 'v4.mrc']], parts, volumeshards, 3)
+        self.assertEqual(shardcommands, [['run --blocks v1 v2\n'], ['run --blocks v3 v4\n'], []])
+
+    def test_single_shard_command_kept(self):
+        commands = ['run all\n', 'single v5\n']
+        volumeshards = {'v1.mrc': 1, 'v2.mrc': 1, 'v5.mrc': 0}
+        parts = [('run --blocks ', ['v1', 'v2'], '\n'), None]
+        shardcommands = sta_shards.shard_commands(commands, [['v1.mrc', 'v2.mrc'], ['v5.mrc']], parts, volumeshards, 2)
+        self.assertEqual(shardcommands, [['single v5\n'], ['run all\n']])
+
+    def test_unused_volumes_stay_with_the_command(self):
+        # v3 is not used by any particle, it goes with v1, the first volume of the command that is used
+        commands = ['run a b c\n']
+        volumeshards = {'v1.mrc': 1, 'v2.mrc': 0}
+        parts = [('run ', ['a', 'b', 'c'], '\n')]
+        shardcommands = sta_shards.shard_commands(commands, [['v1.mrc', 'v2.mrc', 'v3.mrc']], parts, volumeshards, 2)
+        self.assertEqual(shardcommands, [['run b\n'], ['run a c\n']])
+
+
+if __name__ == '__main__':
+    unittest.main()